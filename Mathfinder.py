@@ -1,6 +1,9 @@
 import streamlit as st
 
+import app_setup
+
 st.set_page_config(page_title="Mathfinder")
+app_setup.set_up_process()
 
 st.write("# Welcome to Mathfinder! 👋")
 st.sidebar.success("Select a page above.")
@@ -9,7 +12,7 @@ st.markdown(
     Mathfinder enables you to discover the math that links your data together using AI!
 
     **👈 Use the sidebar to start using Mathfinder**. Two pages are available:
-    - On the 'train' page, you can upload data in CSV format. You will then be asked to define what value in your table you want to predict, and which ones should be used in order to do so. Afterwards, Mathfinder will train an AI model that will give you the math formula linking your data together. The trained model is stored in the app and can be reused to make predictions later. 
+    - On the 'train' page, you can upload data in CSV format. You will then be asked to define what value in your table you want to predict, or several values, and which ones should be used in order to do so. Afterwards, Mathfinder will train an AI model that will give you the math formula linking your data together. Your data is checked before the training starts: missing, infinite or non-numerical values can either be rejected, dropped with their row, or replaced by the median of their column. The trained model is stored in the app and can be reused to make predictions later. 
     - On the 'predict' page, you can use an already trained model to predict values based on your data. In order to do so, upload a CSV file containing your data and specify the name of the model that should be used. You can download the results in CSV format.
     - The 'test' page allows you to test a model by uploading test data. An automated testing feature is also available (see below).
     
@@ -0,0 +1,28 @@
+"""
+Sets up the resources shared by the Streamlit pages.
+
+Streamlit runs the script of a page again after every interaction, so the
+resources that only need to be set up once per process are cached with
+st.cache_resource.
+"""
+import os
+
+import streamlit as st
+
+import metrics
+
+
+# Address of the MLflow tracking server
+TRACKING_URI = "http://127.0.0.1:8080"
+
+
+@st.cache_resource(show_spinner=False)
+def set_up_process():
+    """
+    Sets up the MLflow tracking server and the metrics endpoint, once per process.
+    """
+    # Setting the tracking server through the environment does not import mlflow,
+    # which is only imported once a page needs it
+    os.environ.setdefault("MLFLOW_TRACKING_URI", TRACKING_URI)
+    if metrics.METRICS_PORT:
+        metrics.start_server(metrics.METRICS_PORT)
@@ -0,0 +1,209 @@
+"""
+Keeps track of the test files dropped in the 'autotest' folder.
+
+Each model has its own subfolder, 'autotest/<model name>', where users drop data
+files (CSV, Parquet or Arrow). A manifest records the modification time, size
+and hash of every file, whether it is pending, processed or invalid, and the
+results of its test. Once tested, files are moved to the 'processed' subfolder
+instead of being deleted.
+
+The subfolder is only listed again when its modification time has changed,
+i.e. when files were added, removed or renamed, or when one of the files of the
+manifest that is still in the subfolder was modified: a file overwritten in
+place does not change the modification time of the subfolder. The manifest is
+stored in the 'processed' subfolder so that writing it does not change that
+time. Archiving files does, so the subfolder is listed again after a run that
+tested files. Files that hold the same data as a file already processed are
+archived without being tested.
+"""
+import os
+import json
+import hashlib
+import time
+import logging
+from datetime import datetime
+
+import datasets
+
+
+AUTOTEST_DIR = "./autotest"
+MANIFEST_FILE = ".manifest.json"
+PROCESSED_DIR = "processed"
+# Modification times of directories are only trusted after that many nanoseconds
+MTIME_RESOLUTION_NS = 2 * 10**9
+
+PENDING = "pending"
+PROCESSED = "processed"
+INVALID = "invalid"
+DUPLICATE = "duplicate"
+
+
+def get_file_hash(path: str) -> str:
+    """
+    Returns the SHA-256 hash of the file at path.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class TestFiles:
+    """
+    The test files of the model referenced by model_name.
+    """
+
+    __test__ = False  # Not a test class, despite its name
+
+    def __init__(self, model_name: str, root: str = AUTOTEST_DIR):
+        self.model_name = model_name
+        self.directory = os.path.join(root, model_name)
+        self.manifest_path = os.path.join(self.directory, PROCESSED_DIR, MANIFEST_FILE)
+        self.manifest = {"directory_mtime_ns": None, "scanned_at_ns": None, "files": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    @property
+    def files(self) -> dict:
+        return self.manifest["files"]
+
+    def pending(self) -> list:
+        """
+        Returns the names of the files that have not been tested yet, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        pending = self._get_pending()
+        if pending is None or not self._is_scan_current(directory_mtime):
+            self.manifest["directory_mtime_ns"] = directory_mtime
+            self.manifest["scanned_at_ns"] = time.time_ns()
+            self._scan()
+            self.save()
+            pending = self._get_pending() or []
+        return sorted(pending, key=lambda filename: self.files[filename]["mtime"])
+
+    def _is_scan_current(self, directory_mtime: int) -> bool:
+        """
+        Returns True if the directory has not changed since its last scan.
+
+        Modification times have a limited resolution, so a file added just
+        after a scan might not change that of the directory. The last scan is
+        only trusted if it happened long enough after the last modification.
+        """
+        return (
+            directory_mtime == self.manifest["directory_mtime_ns"]
+            and self.manifest["scanned_at_ns"] - directory_mtime > MTIME_RESOLUTION_NS
+        )
+
+    def _get_pending(self) -> list:
+        """
+        Returns the names of the pending files in the manifest, or None if one
+        of the files that are not archived yet was modified since it was added,
+        e.g. an invalid file that was corrected.
+        """
+        pending = []
+        for filename, entry in self.files.items():
+            if filename.startswith(PROCESSED_DIR + "/"):
+                continue
+            if not self._is_unchanged(filename, entry):
+                return None
+            if entry["status"] == PENDING:
+                pending.append(filename)
+        return pending
+
+    def _scan(self):
+        """
+        Lists the data files of the directory and adds the new or modified ones
+        to the manifest.
+        """
+        processed_hashes = {
+            entry["hash"]: filename
+            for filename, entry in self.files.items()
+            if entry["status"] == PROCESSED
+        }
+        found = set()
+        duplicates = []
+        with os.scandir(self.directory) as entries:
+            for file in entries:
+                if not (file.is_file() and datasets.is_supported(file.name)):
+                    continue
+                found.add(file.name)
+                stat = file.stat()
+                entry = self.files.get(file.name)
+                if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                    continue
+
+                file_hash = get_file_hash(file.path)
+                entry = {"mtime": stat.st_mtime, "size": stat.st_size, "hash": file_hash, "status": PENDING}
+                if file_hash in processed_hashes:
+                    # The same data was already used to test the model
+                    entry["status"] = DUPLICATE
+                    entry["duplicate_of"] = processed_hashes[file_hash]
+                    logging.info(f"Test file {file.name} of model {self.model_name} was already processed as {processed_hashes[file_hash]}")
+                    duplicates.append(file.name)
+                self.files[file.name] = entry
+
+        # Forgetting the files that were removed by the user
+        for filename in list(self.files):
+            if not filename.startswith(PROCESSED_DIR + "/") and filename not in found:
+                del self.files[filename]
+        for filename in duplicates:
+            self._archive(filename)
+
+    def _is_unchanged(self, filename: str, entry: dict) -> bool:
+        """
+        Returns True if the file still has the modification time and size
+        recorded in the manifest, i.e. it is not being written.
+        """
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            return False
+        return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _archive(self, filename: str) -> dict:
+        """
+        Moves a file to the 'processed' subfolder, and returns its entry in the manifest.
+        """
+        os.makedirs(os.path.join(self.directory, PROCESSED_DIR), exist_ok=True)
+        archived_name = f"{PROCESSED_DIR}/{datetime.now():%Y%m%d_%H%M%S}_{filename}"
+        os.replace(self.path(filename), self.path(archived_name))
+
+        entry = self.files.pop(filename)
+        entry["processed_at"] = datetime.now().isoformat(timespec="seconds")
+        self.files[archived_name] = entry
+        return entry
+
+    def mark_processed(self, filename: str, result: dict):
+        """
+        Stores the result of the test of a file, and moves it to the 'processed' subfolder.
+        """
+        entry = self._archive(filename)
+        entry["status"] = PROCESSED
+        entry["result"] = result
+
+    def mark_invalid(self, filename: str, reason: str):
+        """
+        Marks a file that could not be used to test the model. It is tried
+        again once it is modified, see _get_pending.
+        """
+        self.files[filename]["status"] = INVALID
+        self.files[filename]["reason"] = reason
+
+    def save(self):
+        """
+        Writes the manifest.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        os.makedirs(os.path.join(self.directory, PROCESSED_DIR), exist_ok=True)
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(temporary_path, self.manifest_path)
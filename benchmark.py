@@ -0,0 +1,324 @@
+"""
+Measures the time spent in Mathfinder's hot paths.
+
+The benchmark runs on synthetic datasets whose target is computed with a known
+formula, so it does not need any user data. It times:
+- the fit of a SymbolicRegressor
+- the predictions of the trained model, pickled and compiled
+- the ingestion of a CSV file by the train page
+- a full monitoring run over several models
+- the import of the monitoring script and of the Streamlit pages
+
+MLflow is replaced by a file store and the MySQL database by SQLite, both
+created in a temporary directory, so the benchmark can run anywhere. The
+results are written as JSON so successive runs can be compared, e.g.:
+
+    python benchmark.py --rows 10000 --features 3 --models 20 --output before.json
+"""
+import os
+import sys
+import shutil
+import json
+import time
+import argparse
+import subprocess
+import logging
+import platform
+import statistics
+import tempfile
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import mlflow
+import sklearn
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import mean_absolute_error
+
+import autotest
+import database
+import formula
+import metrics
+import model_cache
+import model_metadata
+import monitoring
+import training_queue
+from pages import train
+
+
+# Formulas used to compute the target of the synthetic datasets, depending on
+# their number of features. Features beyond those used by the formula are noise.
+GROUND_TRUTH_FORMULAS = {
+    1: "y0 = 3*x0 + 2",
+    2: "y0 = x0*x1 + 3*x0",
+    3: "y0 = x0*x1 - 2*x2 + 5",
+}
+
+
+# Maximum time allowed to import the scripts that are started often, in seconds
+IMPORT_BUDGETS = {
+    "monitoring": 0.5,
+    "pages.train": 2.0,
+    "pages.predict": 2.0,
+    "pages.test": 2.0,
+}
+# Modules that are too slow to import to be imported before they are needed
+HEAVY_MODULES = ["mlflow", "sklearn", "sblearn", "scipy"]
+# Pages that only display their form once a file is uploaded: they are also
+# imported with a CSV file uploaded, to check the form without heavy modules
+UPLOAD_PAGES = ["pages.train", "pages.predict", "pages.test"]
+
+
+def make_dataset(rows: int, features: int, seed: int = 42) -> tuple:
+    """
+    Returns a tuple (dataframe, feature column names, target column name, ground
+    truth formula) for a synthetic dataset of rows x features values.
+    """
+    rng = np.random.default_rng(seed)
+    feature_names = [f"feature_{i}" for i in range(features)]
+    X = pd.DataFrame(rng.uniform(1, 10, size=(rows, features)), columns=feature_names)
+    ground_truth = GROUND_TRUTH_FORMULAS[min(features, max(GROUND_TRUTH_FORMULAS))]
+    dataframe = X.copy()
+    dataframe["target"] = formula.CompiledFormulas([ground_truth]).predict(X)
+    return dataframe, feature_names, "target", ground_truth
+
+
+def measure(function, repeat: int, setup=None) -> tuple:
+    """
+    Calls 'function' 'repeat' times, after calling 'setup' if given.
+
+    Returns a tuple (timings, result of the last call), where timings gives the
+    minimum, median and mean durations in seconds.
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    timings = {
+        "runs": repeat,
+        "min_seconds": min(durations),
+        "median_seconds": statistics.median(durations),
+        "mean_seconds": statistics.mean(durations),
+    }
+    return timings, result
+
+
+def benchmark_ingest(dataframe: pd.DataFrame, feature_names: list, target_name: str, directory: str, repeat: int) -> dict:
+    """
+    Times the loading of a CSV file as done by the train page.
+    """
+    path = os.path.join(directory, "dataset.csv")
+    dataframe.to_csv(path)  # The index is written, as spreadsheets usually do
+
+    def ingest():
+        df = pd.read_csv(path)
+        df = df.loc[:, ~df.columns.str.contains("^Unnamed")]
+        return train.prepare_data(df, ";".join(feature_names), target_name)
+
+    timings, _ = measure(ingest, repeat)
+    timings["bytes"] = os.path.getsize(path)
+    timings["rows_per_second"] = len(dataframe) / timings["median_seconds"]
+    return timings
+
+
+def benchmark_fit(X: pd.DataFrame, y: pd.DataFrame, profile: str, repeat: int) -> tuple:
+    """
+    Times the fit of a SymbolicRegressor. Returns a tuple (timings, trained model).
+    """
+    # Only one fit of a multi-start profile is timed
+    params = training_queue.get_candidates(training_queue.get_profile_params(profile, max_workers=1))[0]
+    params.setdefault("random_state", 42)
+    timings, model = measure(lambda: training_queue.fit_model(X, y, params), repeat)
+    timings["params"] = params
+    timings["rows_per_second"] = len(X) / timings["median_seconds"]
+    return timings, model
+
+
+def benchmark_predict(model, X: pd.DataFrame, y: pd.DataFrame, repeat: int) -> dict:
+    """
+    Times the predictions of the pickled model and of its compiled formulas.
+    """
+    compiled = formula.compile_model(model, X, y)
+    results = {}
+    for name, predictor in (("pickled", model), ("compiled", compiled)):
+        timings, y_pred = measure(lambda: predictor.predict(X), repeat)
+        timings["rows_per_second"] = len(X) / timings["median_seconds"]
+        timings["mae"] = float(mean_absolute_error(y, y_pred))
+        results[name] = timings
+    return results
+
+
+def measure_import(module_name: str, upload: bool = False) -> dict:
+    """
+    Times the import of a module in a new Python process, and lists the heavy
+    modules it imported. If 'upload' is True, the file uploaders of the
+    Streamlit page return a small CSV file.
+    """
+    setup = ""
+    if upload:
+        setup = """
+import io, streamlit
+class Upload(io.BytesIO):
+    name = "data.csv"
+    file_id = "benchmark"
+streamlit.file_uploader = lambda *args, **kwargs: Upload(b"a,b\\n1,2\\n3,4\\n")
+"""
+    code = f"""
+import sys, time, json
+{setup}
+start = time.perf_counter()
+import {module_name}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy_modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+    process = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["budget_seconds"] = IMPORT_BUDGETS.get(module_name)
+    if result["budget_seconds"] is not None and result["seconds"] > result["budget_seconds"]:
+        logging.warning(f"Importing {module_name} took {result['seconds']:.2f} s, over its budget of {result['budget_seconds']} s")
+    return result
+
+
+def benchmark_imports() -> dict:
+    """
+    Times the import of the monitoring script and of the Streamlit pages.
+    """
+    results = {module_name: measure_import(module_name) for module_name in IMPORT_BUDGETS}
+    for module_name in UPLOAD_PAGES:
+        results[f"{module_name} (upload)"] = measure_import(module_name, upload=True)
+    return results
+
+
+class DiscardedReports:
+    """
+    Stands in for the ReportSender of the monitoring script, so that no email is sent.
+    """
+
+    def add(self, result: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+def benchmark_monitoring(model, X: pd.DataFrame, y: pd.DataFrame, dataframe: pd.DataFrame, models: int, workers: int, repeat: int) -> dict:
+    """
+    Times a full monitoring run over 'models' models that are all due for
+    testing, each with one test file of the size of 'dataframe'.
+
+    Must be run from a temporary directory, where the monitoring script looks
+    for the test files. No report is sent.
+    """
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    model_names = [f"benchmark_{i}" for i in range(models)]
+    for model_name in model_names:
+        train.update_mlflow(model, model_name, X_test, y_test, X_train, y_train)
+        os.makedirs(os.path.join("autotest", model_name), exist_ok=True)
+
+    db = database.create_sqlite_database("mathfinder.db")
+    today = date.today()
+
+    def setup():
+        # Every run starts like a new monitoring process, with empty caches
+        model_cache.cache = model_cache.ModelCache()
+        model_metadata.cache = model_metadata.MetadataCache()
+        for model_name in model_names:
+            # Removing the files and manifest of the previous run, which would
+            # make the new test files look like duplicates
+            shutil.rmtree(os.path.join("autotest", model_name))
+            os.makedirs(os.path.join("autotest", model_name))
+            dataframe.to_csv(os.path.join("autotest", model_name, "test.csv"), index=False)
+            db.save_model(model_name, "benchmark@test.com", 7, today - timedelta(days=30))
+
+    timings, _ = measure(
+        lambda: monitoring.run_monitoring(db, today, workers=workers, report_sender=DiscardedReports()),
+        repeat,
+        setup,
+    )
+    timings["models"] = models
+    timings["workers"] = workers
+    timings["models_per_second"] = models / timings["median_seconds"]
+    timings["tested_models"] = sum(1 for model_name in model_names if not autotest.TestFiles(model_name).pending())
+    return timings
+
+
+def run_benchmark(rows: int, features: int, models: int, profile: str, workers: int, repeat: int) -> dict:
+    """
+    Runs every benchmark and returns their results.
+    """
+    dataframe, feature_names, target_name, ground_truth = make_dataset(rows, features)
+    X = dataframe[feature_names]
+    y = dataframe[[target_name]]
+
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "scikit-learn": sklearn.__version__,
+            "mlflow": mlflow.__version__,
+            "numexpr": formula.numexpr is not None,
+        },
+        "parameters": {
+            "rows": rows,
+            "features": features,
+            "models": models,
+            "profile": profile,
+            "workers": workers,
+            "repeat": repeat,
+        },
+        "ground_truth": ground_truth,
+    }
+
+    results["imports"] = benchmark_imports()
+    metrics.registry.reset()
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            mlflow.set_tracking_uri(f"file:{os.path.join(directory, 'mlruns')}")
+            results["ingest"] = benchmark_ingest(dataframe, feature_names, target_name, directory, repeat)
+            results["fit"], model = benchmark_fit(X, y, profile, repeat)
+            results["formulas"] = list(model.formulas)
+            results["predict"] = benchmark_predict(model, X, y, repeat)
+            if models:
+                results["monitoring"] = benchmark_monitoring(model, X, y, dataframe, models, workers, repeat)
+        finally:
+            os.chdir(working_directory)
+    # Time spent in each step over all the benchmarks
+    results["metrics"] = metrics.registry.summary()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the time spent in Mathfinder's hot paths.")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of rows of the synthetic dataset.")
+    parser.add_argument("--features", type=int, default=3, help="Number of features of the synthetic dataset.")
+    parser.add_argument("--models", type=int, default=10, help="Number of models tested by the monitoring benchmark (0 to skip it).")
+    parser.add_argument("--profile", default="fast", help="Training profile used to fit the model.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used by the monitoring benchmark.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times each benchmark is run.")
+    parser.add_argument("--output", help="File the JSON results are written to. They are printed if it is not set.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmark(args.rows, args.features, args.models, args.profile, args.workers, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
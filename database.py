@@ -0,0 +1,233 @@
+"""
+Access to Mathfinder's database.
+
+The connections come from a pool shared by the whole process instead of being
+opened for every query, and every query is parameterized. The MySQL server can
+be replaced by SQLite, which is what the tests do.
+"""
+import os
+import time
+import sqlite3
+from contextlib import closing, contextmanager
+from datetime import date, timedelta
+from threading import Lock
+
+import mysql.connector
+from mysql.connector.pooling import MySQLConnectionPool
+
+import metrics
+
+
+# Number of connections kept open by each process
+POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 5))
+# Maximum time to wait for a free connection, in seconds
+POOL_TIMEOUT = 10
+
+_UPSERT_MODEL = {
+    "mysql": """INSERT INTO Models (name, email, test_every_nth_day, last_testing_date, next_testing_date) VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE email=VALUES(email), test_every_nth_day=VALUES(test_every_nth_day), last_testing_date=VALUES(last_testing_date), next_testing_date=VALUES(next_testing_date);""",
+    "sqlite": """INSERT INTO Models (name, email, test_every_nth_day, last_testing_date, next_testing_date) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT(name) DO UPDATE SET email=excluded.email, test_every_nth_day=excluded.test_every_nth_day, last_testing_date=excluded.last_testing_date, next_testing_date=excluded.next_testing_date;""",
+}
+# A model is tested once more than test_every_nth_day days have elapsed since its last test
+_NEXT_TESTING_DATE = {
+    "mysql": "DATE_ADD(%s, INTERVAL test_every_nth_day + 1 DAY)",
+    "sqlite": "date(%s, '+' || (test_every_nth_day + 1) || ' days')",
+}
+_MODEL_COLUMNS = "name, email, test_every_nth_day, last_testing_date"
+# The schema of mysql_dump.sql, for SQLite
+_SQLITE_SCHEMA = (
+    """CREATE TABLE Models (
+        name varchar(100) NOT NULL PRIMARY KEY,
+        email varchar(100) NOT NULL,
+        test_every_nth_day int NOT NULL,
+        last_testing_date date NOT NULL,
+        next_testing_date date NOT NULL
+    );""",
+    """CREATE INDEX idx_next_testing_date ON Models (next_testing_date, name);""",
+)
+
+
+class Database:
+    """
+    Runs Mathfinder's queries on the connections returned by 'connect'.
+
+    Closing a connection must give it back to its pool. 'dialect' is either
+    'mysql' or 'sqlite'. Queries are written with %s placeholders, which are
+    converted for SQLite.
+    """
+
+    def __init__(self, connect, dialect: str = "mysql"):
+        self._connect = connect
+        self.dialect = dialect
+
+    @contextmanager
+    def cursor(self):
+        """
+        Yields a cursor, then commits and gives the connection back to the pool.
+        """
+        connection = self._connect()
+        try:
+            if self.dialect == "mysql":
+                cursor = connection.cursor(prepared=True)
+            else:
+                cursor = connection.cursor()
+            try:
+                yield cursor
+                connection.commit()
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    @metrics.span("db_write")
+    def execute(self, query: str, params: tuple = ()):
+        with self.cursor() as c:
+            c.execute(self._convert(query), params)
+
+    @metrics.span("db_read")
+    def fetchall(self, query: str, params: tuple = ()) -> list:
+        with self.cursor() as c:
+            c.execute(self._convert(query), params)
+            return c.fetchall()
+
+    def get_models(self) -> list:
+        """
+        Returns the rows (name, email, test_every_nth_day, last_testing_date) of every model.
+        """
+        return self.fetchall(f"""SELECT {_MODEL_COLUMNS} FROM Models;""")
+
+    def has_due_models(self, today: date) -> bool:
+        """
+        Returns True if at least one model is due for testing on 'today'.
+        """
+        rows = self.fetchall(
+            """SELECT 1 FROM Models WHERE next_testing_date <= %s LIMIT 1;""", (today.strftime("%Y-%m-%d"),)
+        )
+        return bool(rows)
+
+    def get_due_models(self, today: date, page_size: int = 100):
+        """
+        Yields lists of at most 'page_size' rows (name, email, test_every_nth_day,
+        last_testing_date) for the models that are due for testing on 'today'.
+
+        The range query on next_testing_date uses its index, so the models that
+        are not due are never read. Pages are retrieved after the last row of the
+        previous page rather than with an offset, which keeps them consistent
+        while the testing dates of the models already retrieved are updated.
+        """
+        today = today.strftime("%Y-%m-%d")
+        rows = self.fetchall(
+            f"""SELECT {_MODEL_COLUMNS}, next_testing_date FROM Models WHERE next_testing_date <= %s
+                ORDER BY next_testing_date, name LIMIT %s;""",
+            (today, page_size),
+        )
+        while rows:
+            yield [row[:4] for row in rows]
+            if len(rows) < page_size:
+                return
+            last_date = _to_date(rows[-1][4]).strftime("%Y-%m-%d")
+            last_name = rows[-1][0]
+            rows = self.fetchall(
+                f"""SELECT {_MODEL_COLUMNS}, next_testing_date FROM Models WHERE next_testing_date <= %s
+                    AND (next_testing_date > %s OR (next_testing_date = %s AND name > %s))
+                    ORDER BY next_testing_date, name LIMIT %s;""",
+                (today, last_date, last_date, last_name, page_size),
+            )
+
+    def save_model(self, model_name: str, email: str, test_every_nth_day: int, last_testing_date: date):
+        """
+        Adds a model to the database, or updates it if it already exists.
+        """
+        next_testing_date = last_testing_date + timedelta(days=test_every_nth_day + 1)
+        self.execute(
+            _UPSERT_MODEL[self.dialect],
+            (
+                model_name,
+                email,
+                test_every_nth_day,
+                last_testing_date.strftime("%Y-%m-%d"),
+                next_testing_date.strftime("%Y-%m-%d"),
+            ),
+        )
+
+    def update_testing_dates(self, model_names: list, testing_date: date):
+        """
+        Updates the last and next testing dates of several models in a single query.
+        """
+        if not model_names:
+            return
+        testing_date = testing_date.strftime("%Y-%m-%d")
+        placeholders = ", ".join(["%s"] * len(model_names))
+        self.execute(
+            f"""UPDATE Models SET last_testing_date=%s, next_testing_date={_NEXT_TESTING_DATE[self.dialect]}
+                WHERE name IN ({placeholders});""",
+            (testing_date, testing_date, *model_names),
+        )
+
+    def _convert(self, query: str) -> str:
+        if self.dialect == "sqlite":
+            return query.replace("%s", "?")
+        return query
+
+
+def _to_date(value) -> date:
+    """
+    Converts a date read from the database, which SQLite might return as a string.
+    """
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+def _connect_from_pool(pool: MySQLConnectionPool):
+    """
+    Returns a connection from the pool, waiting for one to be given back if
+    they are all in use.
+    """
+    deadline = time.monotonic() + POOL_TIMEOUT
+    while True:
+        try:
+            return pool.get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def create_sqlite_database(path: str) -> Database:
+    """
+    Creates a SQLite database with the schema of Mathfinder's MySQL database,
+    used by the tests and the benchmark.
+    """
+    connect = lambda: sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    with closing(connect()) as connection:
+        for statement in _SQLITE_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+    return Database(connect, dialect="sqlite")
+
+
+_database = None
+_lock = Lock()
+
+
+def get_database() -> Database:
+    """
+    Returns the Database of the process, creating its connection pool on first use.
+
+    MYSQL username and password need to be set as environment variables.
+    """
+    global _database
+    with _lock:
+        if _database is None:
+            pool = MySQLConnectionPool(
+                pool_name="mathfinder",
+                pool_size=POOL_SIZE,
+                host="localhost",
+                user=os.environ["MYSQL_USER"],
+                password=os.environ["MYSQL_PWD"],
+                database=os.environ.get("MYSQL_DB_NAME", "mathfinder"),
+            )
+            _database = Database(lambda: _connect_from_pool(pool))
+    return _database
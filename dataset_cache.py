@@ -0,0 +1,255 @@
+"""
+Keeps the parsed content of the files uploaded on the Streamlit pages.
+
+Streamlit runs the script of a page again each time the user interacts with
+it, e.g. for every text field filled in, and each run used to parse the
+uploaded file again. The parsed DataFrames are now cached:
+- in the session of the user, which remembers the hash of each upload so it
+  is only computed once, and the preview of the file
+- in a cache shared by all the sessions of the process, keyed by the hash of
+  the content of the file, so a file uploaded again (by the same user or by
+  another one) is not parsed again
+
+The shared cache keeps at most MAX_BYTES of DataFrames in memory, evicting the
+least recently used ones first. Evicted DataFrames, and those too large for the
+memory budget, are written to Parquet files in CACHE_DIR, which are much faster
+to read than the original file. At most MAX_DISK_BYTES of Parquet files are kept.
+The uploaded data can be confidential, and a Parquet file placed in CACHE_DIR by
+someone else would be returned as the content of an upload, so the directory is
+created with permissions that only let the user running Mathfinder access it,
+and the files are only read or written if nobody else can write to it.
+
+The cached DataFrames are shared by every session, so they must not be
+modified in place.
+"""
+import os
+import uuid
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import pandas as pd
+
+import datasets
+import metrics
+import private_dirs
+
+
+# Maximum size of the DataFrames kept in memory, in bytes (1 GB by default)
+MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_BYTES", 1024**3))
+# Directory of the DataFrames written to disk, which must not be shared with other users
+CACHE_DIR = os.environ.get("DATASET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mathfinder", "datasets"))
+# Maximum size of the DataFrames written to disk, in bytes (10 GB by default)
+MAX_DISK_BYTES = int(os.environ.get("DATASET_CACHE_MAX_DISK_BYTES", 10 * 1024**3))
+
+# Keys of the session state where the hashes of the uploads and the previews are kept
+SESSION_HASHES_KEY = "dataset_cache_hashes"
+SESSION_PREVIEW_KEY = "dataset_cache_preview"
+# Maximum number of upload hashes kept in the session of a user
+MAX_SESSION_HASHES = 20
+
+
+def get_dataframe_size(dataframe: pd.DataFrame) -> int:
+    """
+    Returns the memory used by a DataFrame, in bytes.
+    """
+    return int(dataframe.memory_usage(deep=True).sum())
+
+
+class DatasetCache:
+    """
+    A least recently used cache for parsed DataFrames, bounded by 'max_bytes'
+    in memory, with a second tier of Parquet files in 'directory' bounded by
+    'max_disk_bytes'.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES, directory: str = CACHE_DIR, max_disk_bytes: int = MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()  # key -> (dataframe, size)
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key: str) -> pd.DataFrame:
+        """
+        Returns the DataFrame cached under 'key', or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                metrics.increment("dataset_cache_hits", tier="memory")
+                return self._frames[key][0]
+
+        path = self._get_path(key)
+        dataframe = None
+        if private_dirs.is_private(self.directory):
+            try:
+                dataframe = datasets.read(path)
+                # Marking the file as recently used
+                os.utime(path)
+            except (OSError, ValueError):
+                # ValueError also covers the errors raised by pyarrow on invalid files
+                dataframe = None
+        if dataframe is None:
+            with self._lock:
+                self.misses += 1
+            metrics.increment("dataset_cache_misses")
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        metrics.increment("dataset_cache_hits", tier="disk")
+        self._add(key, dataframe, get_dataframe_size(dataframe))
+        return dataframe
+
+    def put(self, key: str, dataframe: pd.DataFrame):
+        """
+        Caches a DataFrame under 'key'. If it is larger than the memory
+        budget, it is only written to disk.
+        """
+        size = get_dataframe_size(dataframe)
+        if size > self.max_bytes:
+            self._spill(key, dataframe)
+        else:
+            self._add(key, dataframe, size)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "frames": len(self._frames),
+                "size": self._size,
+            }
+
+    def _add(self, key: str, dataframe: pd.DataFrame, size: int):
+        if size > self.max_bytes:
+            return
+        evicted = []
+        with self._lock:
+            if key not in self._frames:
+                self._frames[key] = (dataframe, size)
+                self._size += size
+            while self._size > self.max_bytes:
+                evicted_key, (evicted_frame, evicted_size) = self._frames.popitem(last=False)
+                self._size -= evicted_size
+                evicted.append((evicted_key, evicted_frame))
+        # Writing to disk outside of the lock, so other sessions are not blocked
+        for evicted_key, evicted_frame in evicted:
+            self._spill(evicted_key, evicted_frame)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def _spill(self, key: str, dataframe: pd.DataFrame):
+        """
+        Writes a DataFrame to disk, then removes the least recently used files
+        if the disk budget is exceeded.
+        """
+        path = self._get_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            if not private_dirs.make_private(self.directory):
+                logging.warning(f"Dataset {key} is not written to disk, as other users can write to {self.directory}")
+                return
+        except OSError:
+            logging.warning(f"Could not create the cache directory {self.directory}", exc_info=True)
+            return
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with metrics.span("dataset_cache_spill"):
+                dataframe.to_parquet(temporary_path, index=False)
+            os.replace(temporary_path, path)
+        except Exception:
+            # Some DataFrames cannot be written to Parquet, e.g. with columns of mixed types
+            logging.warning(f"Could not write dataset {key} to the cache directory", exc_info=True)
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        self._enforce_disk_budget()
+
+    def _enforce_disk_budget(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        disk_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if disk_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            disk_size -= size
+
+
+cache = DatasetCache()
+
+
+def get_upload_hash(uploaded_file) -> str:
+    """
+    Returns the SHA-256 hash of the content of an uploaded file.
+    """
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+
+def _parse(uploaded_file, nrows: int = None) -> pd.DataFrame:
+    uploaded_file.seek(0)
+    dataframe = datasets.read(uploaded_file, nrows=nrows)
+    return dataframe.loc[:, ~dataframe.columns.str.contains("^Unnamed")]  # Dropping unnamed columns
+
+
+def read_upload(uploaded_file, session=None) -> pd.DataFrame:
+    """
+    Returns the content of a file uploaded on Streamlit, without its unnamed
+    columns, parsing it only if it is not cached yet.
+
+    'session' is the session state of the user, where the hash of the file
+    is kept so that it is only computed once per upload.
+    """
+    hashes = session.setdefault(SESSION_HASHES_KEY, {}) if session is not None else {}
+    content_hash = hashes.get(uploaded_file.file_id)
+    if content_hash is None:
+        with metrics.span("hash_upload"):
+            content_hash = get_upload_hash(uploaded_file)
+        hashes[uploaded_file.file_id] = content_hash
+        # Forgetting the oldest uploads, which are unlikely to be on the page anymore
+        while len(hashes) > MAX_SESSION_HASHES:
+            del hashes[next(iter(hashes))]
+    # The same content could be parsed differently depending on the extension
+    key = f"{content_hash}_{datasets.get_format(uploaded_file.name)}"
+
+    dataframe = cache.get(key)
+    if dataframe is None:
+        dataframe = _parse(uploaded_file)
+        cache.put(key, dataframe)
+    return dataframe
+
+
+def read_preview(uploaded_file, session=None, nrows: int = 20) -> pd.DataFrame:
+    """
+    Returns the first rows of a file uploaded on Streamlit, without its unnamed
+    columns. They are kept in 'session' while the same file is uploaded.
+    """
+    if session is not None:
+        preview = session.get(SESSION_PREVIEW_KEY)
+        if preview is not None and preview[0] == (uploaded_file.file_id, nrows):
+            metrics.increment("dataset_cache_hits", tier="session")
+            return preview[1]
+    dataframe = _parse(uploaded_file, nrows)
+    if session is not None:
+        session[SESSION_PREVIEW_KEY] = ((uploaded_file.file_id, nrows), dataframe)
+    return dataframe
@@ -0,0 +1,177 @@
+"""
+Reads the data files used by Mathfinder, whatever their format.
+
+CSV, Parquet and Arrow IPC (also known as Feather) files are accepted, the
+format being given by the extension of the file name. When the columns needed
+are known, e.g. from the signature of a model, only these columns are read:
+Parquet and Arrow files store each column separately, so the other ones are
+never loaded. Local Parquet and Arrow files are memory-mapped, and Arrow files
+are read without copying their data until it is converted to pandas.
+"""
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+import metrics
+
+
+CSV = "csv"
+PARQUET = "parquet"
+ARROW = "arrow"
+
+EXTENSIONS = {
+    ".csv": CSV,
+    ".parquet": PARQUET,
+    ".pq": PARQUET,
+    ".arrow": ARROW,
+    ".feather": ARROW,
+    ".ipc": ARROW,
+}
+
+# Default number of rows of each chunk returned by iter_chunks
+CHUNK_SIZE = 100000
+
+
+def get_format(name: str) -> str:
+    """
+    Returns the format of the file called 'name', or None if it is not supported.
+    """
+    return EXTENSIONS.get(os.path.splitext(str(name))[1].lower())
+
+
+def is_supported(name: str) -> bool:
+    return get_format(name) is not None
+
+
+def parse_column_names(columns: str) -> list:
+    """
+    Returns the list of column names entered by a user, separated by semicolons.
+    """
+    return [column.strip() for column in columns.split(";")]
+
+
+def _get_name(source, name: str = None) -> str:
+    """
+    Returns the name used to find the format of source, a path or a file
+    object such as the files uploaded on Streamlit.
+    """
+    if name is not None:
+        return name
+    return str(getattr(source, "name", source))
+
+
+def _is_path(source) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+def _check_columns(available: list, columns: list):
+    missing = [column for column in columns if column not in available]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in the file.")
+
+
+def _open_arrow(source):
+    """
+    Returns a tuple (record batches, schema) for an Arrow IPC file or stream.
+    """
+    if _is_path(source):
+        source = pa.memory_map(str(source))
+    else:
+        source = pa.BufferReader(source.read())
+    try:
+        reader = pa.ipc.open_file(source)
+        return [reader.get_batch(i) for i in range(reader.num_record_batches)], reader.schema
+    except pa.ArrowInvalid:
+        # Not a file, but maybe a stream
+        source.seek(0)
+        reader = pa.ipc.open_stream(source)
+        return reader, reader.schema
+
+
+def iter_chunks(source, columns: list = None, chunk_size: int = CHUNK_SIZE, name: str = None):
+    """
+    Yields the content of a data file as DataFrames of at most chunk_size rows.
+
+    If 'columns' is given, only these columns are read, in that order. Raises a ValueError if
+    the file is not in a supported format or if a column is missing.
+    """
+    file_format = get_format(_get_name(source, name))
+    chunks = _iter_chunks(source, file_format, columns, chunk_size)
+    try:
+        while True:
+            # Only the time spent reading each chunk is recorded, not the time spent by the caller on it
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            metrics.observe("read", time.perf_counter() - start, format=file_format)
+            metrics.increment("rows_read", len(chunk), format=file_format)
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def _iter_chunks(source, file_format: str, columns: list, chunk_size: int):
+    if file_format == CSV:
+        with pd.read_csv(source, usecols=columns, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                # usecols keeps the order of the columns in the file
+                yield chunk if columns is None else chunk[columns]
+
+    elif file_format == PARQUET:
+        parquet_file = pq.ParquetFile(source, memory_map=_is_path(source))
+        if columns is not None:
+            _check_columns(parquet_file.schema_arrow.names, columns)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+
+    elif file_format == ARROW:
+        batches, schema = _open_arrow(source)
+        if columns is not None:
+            _check_columns(schema.names, columns)
+        for batch in batches:
+            if columns is not None:
+                batch = batch.select(columns)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas()
+
+    else:
+        raise ValueError(f"Unsupported file format, use one of {', '.join(EXTENSIONS)}.")
+
+
+def read(source, columns: list = None, nrows: int = None, name: str = None) -> pd.DataFrame:
+    """
+    Reads a whole data file, or its first 'nrows' rows, into a DataFrame.
+
+    If 'columns' is given, only these columns are read.
+    """
+    file_format = get_format(_get_name(source, name))
+    with metrics.span("read", format=file_format):
+        dataframe = _read(source, file_format, columns, nrows)
+    metrics.increment("rows_read", len(dataframe), format=file_format)
+    return dataframe
+
+
+def _read(source, file_format: str, columns: list, nrows: int) -> pd.DataFrame:
+    if file_format == CSV:
+        dataframe = pd.read_csv(source, usecols=columns, nrows=nrows)
+        return dataframe if columns is None else dataframe[columns]
+    if file_format == PARQUET and nrows is None:
+        table = pq.read_table(source, columns=columns, memory_map=_is_path(source))
+        return table.to_pandas()
+
+    chunks = []
+    rows = 0
+    for chunk in _iter_chunks(source, file_format, columns, nrows or CHUNK_SIZE):
+        chunks.append(chunk)
+        rows += len(chunk)
+        if nrows is not None and rows >= nrows:
+            break
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    dataframe = pd.concat(chunks, ignore_index=True)
+    return dataframe if nrows is None else dataframe.head(nrows)
@@ -0,0 +1,181 @@
+"""
+Detects the drift of the features of a model without keeping its training data.
+
+When a model is trained, the distribution of each of its features is summarized
+by a sketch, stored next to the model as a small JSON artifact:
+- the percentiles of the feature, from 0 to 100, with the share of the
+  training values below or equal to each of them, which give its cumulative
+  distribution for the Kolmogorov-Smirnov (KS) statistic
+- the number of training rows in each decile, for the Population Stability
+  Index (PSI)
+
+The test files are compared to these sketches one chunk at a time, by counting
+the values that fall between the training percentiles, so the memory used
+depends neither on the size of the training data nor on that of the test files.
+Both statistics are approximate, as the test values are only located between
+two training percentiles.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+SKETCHES_ARTIFACT = "feature_sketches.json"
+# Number of quantiles of each sketch, minus one
+QUANTILES = 100
+# Number of bins used by the PSI, each holding a tenth of the training rows
+PSI_BINS = 10
+# The feature is considered to have drifted beyond these values (0.2 is the
+# usual threshold of a significant shift for the PSI)
+PSI_THRESHOLD = float(os.environ.get("DRIFT_PSI_THRESHOLD", 0.2))
+KS_THRESHOLD = float(os.environ.get("DRIFT_KS_THRESHOLD", 0.1))
+# Proportion used instead of 0 for the empty bins, whose logarithm is undefined
+EPSILON = 1e-4
+
+
+def _get_psi_edges(quantiles: np.ndarray) -> np.ndarray:
+    """
+    Returns the inner edges of the PSI bins, i.e. the training deciles.
+    """
+    step = QUANTILES // PSI_BINS
+    return quantiles[step:-1:step]
+
+
+def _to_float(values) -> np.ndarray:
+    values = np.asarray(values, dtype="float64")
+    return values[np.isfinite(values)]
+
+
+def build_sketch(values) -> dict:
+    """
+    Returns the sketch of the distribution of a feature.
+    """
+    values = np.asarray(values, dtype="float64")
+    finite = _to_float(values)
+    if not len(finite):
+        return {"rows": len(values), "missing": len(values), "quantiles": [], "cdf": [], "psi_counts": []}
+    finite = np.sort(finite)
+    quantiles = np.quantile(finite, np.linspace(0, 1, QUANTILES + 1))
+    # With repeated values, the share of values below a percentile can be much higher than its rank
+    cdf = np.searchsorted(finite, quantiles, side="right") / len(finite)
+    bins = np.searchsorted(_get_psi_edges(quantiles), finite, side="right")
+    return {
+        "rows": len(values),
+        "missing": len(values) - len(finite),
+        "quantiles": quantiles.tolist(),
+        "cdf": cdf.tolist(),
+        "psi_counts": np.bincount(bins, minlength=PSI_BINS).tolist(),
+    }
+
+
+def build_sketches(X: pd.DataFrame) -> dict:
+    """
+    Returns the sketches of the features X, which can be logged as a JSON artifact.
+    """
+    return {"features": {str(column): build_sketch(X[column]) for column in X.columns}}
+
+
+def load_sketches(model_path: str) -> dict:
+    """
+    Returns the sketches stored next to the model at model_path, or None if
+    the model was trained before they were added.
+    """
+    sketches_path = os.path.join(os.path.dirname(model_path), SKETCHES_ARTIFACT)
+    if not os.path.exists(sketches_path):
+        return None
+    try:
+        with open(sketches_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.warning(f"Could not read the feature sketches at {sketches_path}", exc_info=True)
+        return None
+
+
+def get_psi(expected_counts, actual_counts) -> float:
+    """
+    Returns the Population Stability Index between two histograms with the same bins.
+    """
+    expected = np.asarray(expected_counts, dtype="float64")
+    actual = np.asarray(actual_counts, dtype="float64")
+    expected = np.clip(expected / max(expected.sum(), 1), EPSILON, None)
+    actual = np.clip(actual / max(actual.sum(), 1), EPSILON, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+class StreamingDrift:
+    """
+    Compares the features of a test file to their training sketches, one chunk at a time.
+    """
+
+    def __init__(self, sketches: dict):
+        self.sketches = {
+            name: sketch for name, sketch in sketches["features"].items() if sketch["quantiles"]
+        }
+        self.rows = 0
+        self.missing = {name: 0 for name in self.sketches}
+        # Number of values below each training percentile, and in each PSI bin
+        self.quantile_counts = {name: np.zeros(QUANTILES + 2, dtype="int64") for name in self.sketches}
+        self.psi_counts = {name: np.zeros(PSI_BINS, dtype="int64") for name in self.sketches}
+        self._quantiles = {name: np.asarray(sketch["quantiles"]) for name, sketch in self.sketches.items()}
+
+    def update(self, chunk: pd.DataFrame):
+        """
+        Adds the values of a chunk of test data.
+        """
+        self.rows += len(chunk)
+        for name, quantiles in self._quantiles.items():
+            if name not in chunk:
+                continue
+            values = np.asarray(chunk[name], dtype="float64")
+            finite = values[np.isfinite(values)]
+            self.missing[name] += len(values) - len(finite)
+            # Index of the first training percentile above or equal to each value
+            self.quantile_counts[name] += np.bincount(
+                np.searchsorted(quantiles, finite, side="left"), minlength=QUANTILES + 2
+            )
+            self.psi_counts[name] += np.bincount(
+                np.searchsorted(_get_psi_edges(quantiles), finite, side="right"), minlength=PSI_BINS
+            )
+
+    def merge(self, other: "StreamingDrift"):
+        """
+        Adds the values counted by another StreamingDrift with the same sketches.
+        """
+        self.rows += other.rows
+        for name in self.sketches:
+            self.missing[name] += other.missing[name]
+            self.quantile_counts[name] += other.quantile_counts[name]
+            self.psi_counts[name] += other.psi_counts[name]
+
+    def get_ks(self, name: str) -> float:
+        """
+        Returns the largest gap between the cumulative distributions of the
+        training and test values of a feature, measured at the training percentiles.
+        """
+        counts = self.quantile_counts[name]
+        total = counts.sum()
+        if not total:
+            return float("nan")
+        test_cdf = np.cumsum(counts)[:QUANTILES + 1] / total
+        return float(np.max(np.abs(test_cdf - np.asarray(self.sketches[name]["cdf"]))))
+
+    def to_dict(self) -> dict:
+        """
+        Returns the PSI and KS statistics of each feature, and whether it drifted.
+        """
+        results = {}
+        for name, sketch in self.sketches.items():
+            if not self.psi_counts[name].sum():
+                continue
+            psi = get_psi(sketch["psi_counts"], self.psi_counts[name])
+            ks = self.get_ks(name)
+            results[name] = {
+                "psi": psi,
+                "ks": ks,
+                "missing": self.missing[name],
+                "drifted": bool(psi > PSI_THRESHOLD or ks > KS_THRESHOLD),
+            }
+        return results
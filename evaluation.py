@@ -0,0 +1,134 @@
+"""
+Evaluates the models on test files of any size.
+
+Test files (CSV, Parquet or Arrow) are read in chunks of CHUNK_SIZE rows,
+keeping only the feature and target columns of the model. The error metrics are computed from running sums,
+so the memory used does not depend on the size of the file. The time spent on
+each chunk is recorded, which gives the throughput of the evaluation.
+"""
+import os
+import time
+import logging
+
+import numpy as np
+
+import datasets
+import metrics
+
+
+# Number of rows read at once from a test file
+CHUNK_SIZE = int(os.environ.get("EVALUATION_CHUNK_SIZE", 100000))
+
+
+class StreamingErrors:
+    """
+    Error metrics updated one chunk of predictions at a time.
+
+    With several targets, the error of a row is the mean of its errors on
+    each target, as in sklearn's mean_absolute_error.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.absolute_sum = 0.0
+        self.squared_sum = 0.0
+        self.max_error = 0.0
+        self.seconds = 0.0
+        self.chunks = 0
+        self.min_rows_per_second = None
+
+    def update(self, y_true, y_pred, seconds: float = None):
+        """
+        Adds the errors of a chunk of predictions. 'seconds' is the time spent
+        reading and predicting that chunk.
+        """
+        if not len(y_true):
+            return
+        y_true = np.asarray(y_true, dtype="float64").reshape(len(y_true), -1)
+        y_pred = np.asarray(y_pred, dtype="float64").reshape(len(y_true), -1)
+        errors = np.abs(y_true - y_pred)
+        self.count += len(errors)
+        self.absolute_sum += float(errors.mean(axis=1).sum())
+        self.squared_sum += float((errors**2).mean(axis=1).sum())
+        self.max_error = max(self.max_error, float(errors.max()))
+
+        if seconds is not None:
+            self.seconds += seconds
+            self.chunks += 1
+            rows_per_second = len(errors) / seconds if seconds > 0 else float("inf")
+            if self.min_rows_per_second is None or rows_per_second < self.min_rows_per_second:
+                self.min_rows_per_second = rows_per_second
+
+    def merge(self, other: "StreamingErrors"):
+        """
+        Adds the errors computed by another StreamingErrors.
+        """
+        self.count += other.count
+        self.absolute_sum += other.absolute_sum
+        self.squared_sum += other.squared_sum
+        self.max_error = max(self.max_error, other.max_error)
+        self.seconds += other.seconds
+        self.chunks += other.chunks
+        if other.min_rows_per_second is not None and (
+            self.min_rows_per_second is None or other.min_rows_per_second < self.min_rows_per_second
+        ):
+            self.min_rows_per_second = other.min_rows_per_second
+
+    @property
+    def mae(self) -> float:
+        return self.absolute_sum / self.count if self.count else float("nan")
+
+    @property
+    def rmse(self) -> float:
+        return (self.squared_sum / self.count) ** 0.5 if self.count else float("nan")
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.count / self.seconds if self.seconds > 0 else float("nan")
+
+    def to_dict(self) -> dict:
+        return {
+            "mae": self.mae,
+            "rmse": self.rmse,
+            "max_error": self.max_error,
+            "rows": self.count,
+            "chunks": self.chunks,
+            "seconds": self.seconds,
+            "rows_per_second": self.rows_per_second,
+            "min_rows_per_second": self.min_rows_per_second,
+        }
+
+
+def evaluate_file(
+    model,
+    source,
+    feature_names: list,
+    target_names: list,
+    chunk_size: int = CHUNK_SIZE,
+    name: str = None,
+    drift=None,
+) -> StreamingErrors:
+    """
+    Computes the errors of the model on the data file at source (a path or a
+    file object), reading it one chunk at a time. 'name' is used to find the
+    format of the file when source does not have a name. If 'drift' (a
+    drift.StreamingDrift) is given, the features of each chunk are added to it.
+
+    Raises a ValueError if the file does not contain the columns of the model.
+    """
+    errors = StreamingErrors()
+    columns = list(dict.fromkeys(feature_names + target_names))
+    start = time.perf_counter()
+    for chunk in datasets.iter_chunks(source, columns, chunk_size, name):
+        with metrics.span("predict"):
+            y_pred = model.predict(chunk[feature_names])
+        metrics.increment("rows_processed", len(chunk), stage="evaluate")
+        end = time.perf_counter()
+        with metrics.span("mae"):
+            errors.update(chunk[target_names], y_pred, end - start)
+        if drift is not None:
+            with metrics.span("drift"):
+                drift.update(chunk[feature_names])
+        logging.debug(f"Evaluated {len(chunk)} rows at {len(chunk) / max(end - start, 1e-9):.0f} rows/s")
+        start = end
+    return errors
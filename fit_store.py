@@ -0,0 +1,196 @@
+"""
+Keeps the results of the fits, so an identical training request is not run again.
+
+Searching a formula can take several minutes, and the same request is often
+submitted again, e.g. after the page was refreshed. Each fit is identified by
+a fingerprint of its training data (the values, names and types of the
+selected columns), of the parameters of the search and of the version of
+symbolic-learn. The model found is stored under this fingerprint, along with
+the MLflow run and model version it was registered as.
+
+The results are pickled in STORE_DIR, which holds at most MAX_BYTES of them:
+the least recently used ones are removed first. Loading a pickle can run any
+code, so the directory is created with permissions that only let the user
+running Mathfinder access it, and the results are only read or written if
+nobody else can write to it.
+"""
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import logging
+from importlib import metadata
+from threading import Lock
+
+import pandas as pd
+
+import metrics
+import private_dirs
+
+
+# Maximum size of the stored fits, in bytes (256 MB by default)
+MAX_BYTES = int(os.environ.get("FIT_STORE_MAX_BYTES", 256 * 1024 * 1024))
+# Directory of the stored fits, which must not be shared with other users
+STORE_DIR = os.environ.get("FIT_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mathfinder", "fits"))
+
+# Parameters that do not change the formula found
+IGNORED_PARAMS = ("n_jobs", "verbose")
+
+
+def get_library_version() -> str:
+    """
+    Returns the version of symbolic-learn, as a new version could find other formulas.
+    """
+    try:
+        return metadata.version("symbolic-learn")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _hash_data(digest, data: pd.DataFrame):
+    digest.update(json.dumps([[str(name), str(dtype)] for name, dtype in data.dtypes.items()]).encode())
+    # hash_pandas_object hashes each row in a vectorized way, without converting the values to text
+    digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+
+
+def get_fingerprint(X: pd.DataFrame, y: pd.DataFrame, params: dict, *args) -> str:
+    """
+    Returns the fingerprint of a fit of X and y with the given search
+    parameters. 'args' are the other arguments of the fit, e.g. the maximum
+    number of rows and the sampling method, which must be JSON serializable.
+    """
+    with metrics.span("fingerprint"):
+        digest = hashlib.sha256()
+        _hash_data(digest, X)
+        _hash_data(digest, y)
+        params = {key: value for key, value in params.items() if key not in IGNORED_PARAMS}
+        digest.update(json.dumps([params, list(args), get_library_version()], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class FitStore:
+    """
+    Stores the results of the fits in 'directory', which holds at most
+    'max_bytes' of them.
+
+    Each result is a dict with the trained model under 'model', and the
+    information added with update, e.g. the MLflow run of the model.
+    """
+
+    def __init__(self, directory: str = STORE_DIR, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def is_private(self) -> bool:
+        """
+        Returns True if the directory of the store belongs to the user running
+        Mathfinder and nobody else can write to it, so its pickles can be trusted.
+        """
+        return private_dirs.is_private(self.directory)
+
+    def read(self, key: str) -> dict:
+        """
+        Returns the result stored under 'key', or None if there is none.
+        """
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        if not self.is_private():
+            logging.warning(f"The fits stored in {self.directory} are ignored, as other users can write to this directory")
+            return None
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            # Marking the result as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # E.g. a result pickled with another version of a library
+            logging.warning(f"Could not read the stored fit {key}", exc_info=True)
+            return None
+        return result
+
+    def get(self, key: str) -> dict:
+        """
+        Returns the result stored under 'key' to reuse it instead of fitting
+        again, or None if there is none.
+        """
+        result = self.read(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.increment("fit_store_hits" if result is not None else "fit_store_misses")
+        return result
+
+    def put(self, key: str, model, **info):
+        """
+        Stores a trained model under 'key', with some information about it.
+        """
+        with self._lock:
+            self._write(key, {"model": model, **info})
+
+    def update(self, key: str, **info):
+        """
+        Adds information to the result stored under 'key', if it still exists.
+        """
+        with self._lock:
+            result = self.read(key)
+            if result is None:
+                return
+            result.update(info)
+            self._write(key, result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _write(self, key: str, result: dict):
+        """
+        Writes a result to disk, then removes the least recently used ones if
+        the store is full. Runs with the lock held.
+        """
+        path = self._get_path(key)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if not private_dirs.make_private(self.directory):
+                logging.warning(f"The fit {key} is not stored, as other users can write to {self.directory}")
+                return
+            with open(temporary_path, "wb") as f:
+                pickle.dump(result, f)
+            os.replace(temporary_path, path)
+        except Exception:
+            # The fit is not lost, only the next identical request will run it again
+            logging.warning(f"Could not store the fit {key}", exc_info=True)
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+
+
+store = FitStore()
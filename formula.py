@@ -0,0 +1,299 @@
+"""
+Compiles the formulas found by the symbolic regression models.
+
+The formulas in SymbolicRegressor.formulas only use additions, subtractions,
+multiplications, divisions and powers of the input values x0, x1... They are
+parsed once and evaluated with NumPy on whole columns, which makes it possible
+to use a trained model without unpickling it, and therefore without sblearn.
+numexpr is used to evaluate the formulas when it is installed.
+
+The constants of a formula can also be refined on a dataset, which is how the
+formulas searched on a sample of a large dataset are fitted to all its rows.
+"""
+import ast
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.utils.validation import check_is_fitted
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+# Name of the MLflow artifact that stores the formulas next to the model
+FORMULAS_ARTIFACT = "formulas.json"
+
+# Special values that sympy can write in a simplified formula
+_SPECIAL_VALUES = {"oo": "inf", "zoo": "inf", "nan": "nan"}
+_ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+_MIN_FLOAT = np.finfo(np.float32).min
+_MAX_FLOAT = np.finfo(np.float32).max
+
+
+class _FormulaChecker(ast.NodeTransformer):
+    """
+    Makes sure a parsed formula only contains arithmetic on input values and
+    constants, and renames the special values written by sympy.
+    """
+
+    def __init__(self):
+        self.input_indices = set()
+
+    def visit_Name(self, node):
+        if node.id in _SPECIAL_VALUES:
+            return ast.copy_location(ast.Name(id=_SPECIAL_VALUES[node.id], ctx=node.ctx), node)
+        if node.id.startswith("x") and node.id[1:].isdigit():
+            self.input_indices.add(int(node.id[1:]))
+            return node
+        raise ValueError(f"Unknown variable '{node.id}' in formula.")
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"Invalid constant {node.value!r} in formula.")
+        return node
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load) + _ALLOWED_OPERATORS):
+            raise ValueError(f"Unsupported expression '{type(node).__name__}' in formula.")
+        return super().generic_visit(node)
+
+
+def parse_formula(formula: str) -> tuple:
+    """
+    Parses a formula such as 'y0 = 2*x0 + x1'.
+
+    Returns a tuple (target name, expression tree, indices of the input values used).
+    """
+    target, _, expression = formula.partition("=")
+    if not expression:
+        target, expression = "", formula
+    checker = _FormulaChecker()
+    tree = checker.visit(ast.parse(expression.strip(), mode="eval"))
+    ast.fix_missing_locations(tree)
+    return target.strip(), tree, checker.input_indices
+
+
+class _ConstantExtractor(ast.NodeTransformer):
+    """
+    Replaces the constants of a parsed formula by the variables c0, c1...
+    The exponents are left untouched.
+    """
+
+    def __init__(self):
+        self.values = []
+
+    def visit_BinOp(self, node):
+        node.left = self.visit(node.left)
+        if not isinstance(node.op, ast.Pow):
+            node.right = self.visit(node.right)
+        return node
+
+    def visit_Constant(self, node):
+        self.values.append(float(node.value))
+        return ast.copy_location(ast.Name(id=f"c{len(self.values) - 1}", ctx=ast.Load()), node)
+
+
+class _ConstantSetter(ast.NodeTransformer):
+    """
+    Replaces the variables c0, c1... of a formula by the given values.
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def visit_Name(self, node):
+        if not (node.id.startswith("c") and node.id[1:].isdigit()):
+            return node
+        value = float(self.values[int(node.id[1:])])
+        if value < 0:
+            # Writing -1.5 as a unary operation keeps the priorities right in '(-1.5) ** 2'
+            return ast.UnaryOp(op=ast.USub(), operand=ast.Constant(-value))
+        return ast.Constant(value)
+
+
+def evaluate_mae(formula: str, X: np.ndarray, y: np.ndarray) -> float:
+    """
+    Returns the Mean Absolute Error of a single formula on X and y.
+    """
+    y_pred = CompiledFormulas([formula]).predict(X)
+    return float(np.mean(np.abs(y_pred.reshape(-1) - np.asarray(y).reshape(-1))))
+
+
+def refine_constants(formula: str, X: np.ndarray, y: np.ndarray, max_evaluations: int = 100) -> str:
+    """
+    Fits the constants of a formula to X and y with a least squares regression,
+    and returns the formula with the new constants.
+
+    The formula is evaluated on all the rows at once, so each step of the
+    regression only costs a few vectorized operations.
+    """
+    target, tree, _ = parse_formula(formula)
+    extractor = _ConstantExtractor()
+    tree = ast.fix_missing_locations(extractor.visit(tree))
+    if not extractor.values:
+        return formula
+
+    X = np.asarray(X, dtype="float64")
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    y = np.asarray(y, dtype="float64").reshape(-1)
+    code = compile(tree, "<formula>", "eval")
+    variables = {f"x{i}": X[:, i] for i in range(X.shape[1])}
+    variables["inf"] = np.inf
+    variables["nan"] = np.nan
+
+    def residuals(constants):
+        variables.update({f"c{i}": value for i, value in enumerate(constants)})
+        with np.errstate(all="ignore"):
+            output = np.broadcast_to(eval(code, {"__builtins__": {}}, variables), y.shape)
+        return np.nan_to_num(output - y, nan=_MAX_FLOAT, posinf=_MAX_FLOAT, neginf=_MIN_FLOAT)
+
+    result = least_squares(residuals, np.array(extractor.values), max_nfev=max_evaluations)
+    expression = ast.unparse(_ConstantSetter(result.x).visit(tree))
+    return f"{target} = {expression}" if target else expression
+
+
+class CompiledFormulas:
+    """
+    The formulas of a model, compiled so they can be evaluated on a whole batch of rows.
+
+    Predictions follow the behaviour of SymbolicRegressor.predict: they are computed
+    in float32, infinite values are clipped and the output is squeezed when there
+    is only one target.
+    """
+
+    def __init__(self, formulas: list, feature_names: list = None, target_names: list = None):
+        self.formulas = list(formulas)
+        self.feature_names = feature_names
+        self.target_names = target_names
+        self._expressions = []
+        self._code = []
+        for formula in self.formulas:
+            _, tree, _ = parse_formula(formula)
+            self._expressions.append(ast.unparse(tree))
+            self._code.append(compile(tree, "<formula>", "eval"))
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Evaluates the formulas for every row of X.
+        """
+        if isinstance(X, pd.DataFrame):
+            if self.feature_names and set(self.feature_names) <= set(X.columns):
+                X = X[self.feature_names]
+            X = X.to_numpy()
+        X = np.asarray(X, dtype="float32")
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+
+        variables = {f"x{i}": X[:, i] for i in range(X.shape[1])}
+        variables["inf"] = np.float32(np.inf)
+        variables["nan"] = np.float32(np.nan)
+        outputs = []
+        with np.errstate(all="ignore"):
+            for expression, code in zip(self._expressions, self._code):
+                if numexpr is not None:
+                    output = numexpr.evaluate(expression, local_dict=variables)
+                else:
+                    output = eval(code, {"__builtins__": {}}, variables)
+                outputs.append(np.broadcast_to(np.asarray(output, dtype="float32"), (len(X),)))
+
+        y_pred = np.column_stack(outputs)
+        np.nan_to_num(y_pred, copy=False, posinf=_MAX_FLOAT, neginf=_MIN_FLOAT)
+        return np.squeeze(y_pred)
+
+    def to_dict(self) -> dict:
+        return {
+            "formulas": self.formulas,
+            "feature_names": self.feature_names,
+            "target_names": self.target_names,
+        }
+
+
+def compile_model(model, X: pd.DataFrame, y: pd.DataFrame) -> CompiledFormulas:
+    """
+    Compiles the formulas of a trained model, remembering the names of the
+    columns it was trained on.
+    """
+    return CompiledFormulas(model.formulas, list(X.columns), list(y.columns))
+
+
+def load_formulas(path: str) -> CompiledFormulas:
+    """
+    Loads the compiled formulas stored in the JSON file at path.
+    """
+    with open(path) as f:
+        content = json.load(f)
+    return CompiledFormulas(**content)
+
+
+class FormulaRegressor(BaseEstimator, RegressorMixin):
+    """
+    A regressor that predicts with formulas found by a symbolic regression.
+
+    Fitting it refines the constants of 'initial_formulas' on the data. The
+    refined formula is only kept if it has a lower Mean Absolute Error than
+    the original one on that data.
+    """
+
+    def __init__(self, initial_formulas: list = None, max_evaluations: int = 100):
+        self.initial_formulas = initial_formulas
+        self.max_evaluations = max_evaluations
+
+    @property
+    def formulas(self) -> list:
+        check_is_fitted(self)
+        return self.formulas_
+
+    def fit(self, X, y):
+        if isinstance(X, pd.DataFrame):
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        X = np.asarray(X, dtype="float64")
+        y = np.asarray(y, dtype="float64")
+        if y.ndim == 1:
+            y = y.reshape(-1, 1)
+
+        self.formulas_ = []
+        for i, initial_formula in enumerate(self.initial_formulas):
+            candidates = [initial_formula]
+            try:
+                candidates.append(refine_constants(initial_formula, X, y[:, i], self.max_evaluations))
+            except (ValueError, ArithmeticError):
+                pass
+            errors = [evaluate_mae(candidate, X, y[:, i]) for candidate in candidates]
+            self.formulas_.append(candidates[int(np.argmin(errors))])
+        self.n_features_in_ = X.shape[1]
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        check_is_fitted(self)
+        feature_names = getattr(self, "feature_names_in_", None)
+        if feature_names is not None:
+            feature_names = list(feature_names)
+        return CompiledFormulas(self.formulas_, feature_names).predict(X)
+
+
+def set_target_index(formula: str, index: int) -> str:
+    """
+    Returns the formula with its target renamed to y<index>, e.g. to make
+    'y0 = 2*x0' the second output of a model.
+    """
+    _, _, expression = formula.partition("=")
+    return f"y{index} = {expression.strip()}"
+
+
+def combine_models(models: list, feature_names: list) -> FormulaRegressor:
+    """
+    Combines models trained on a single target each into one FormulaRegressor
+    that predicts all the targets at once, in the order of 'models'.
+    """
+    model = FormulaRegressor([set_target_index(model.formulas[0], i) for i, model in enumerate(models)])
+    # The formulas were already fitted on the data of each target
+    model.formulas_ = list(model.initial_formulas)
+    model.feature_names_in_ = np.asarray(feature_names, dtype=object)
+    model.n_features_in_ = len(feature_names)
+    return model
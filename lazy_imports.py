@@ -0,0 +1,54 @@
+"""
+Defers the import of heavy modules until they are used.
+
+Importing mlflow, scikit-learn or sblearn takes more than a second, which is
+paid by every launch of the monitoring script and by the first run of each
+Streamlit page, even when they end up not needing these modules. A module
+returned by lazy_import is only imported when one of its attributes is first
+accessed:
+
+    mlflow = lazy_import("mlflow")
+    ...
+    mlflow.set_experiment(name)  # mlflow is imported here
+
+Attributes are always read from the real module, so replacing them (e.g. in
+tests) works as with a regular import.
+"""
+import sys
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for a module until it is used.
+    """
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__.get("_module")
+        if module is None:
+            # import_module is thread-safe, so concurrent sessions can load it
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute: str, value):
+        setattr(self._load(), attribute, value)
+
+    def __delattr__(self, attribute: str):
+        delattr(self._load(), attribute)
+
+    def __dir__(self) -> list:
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Returns the module called 'name', which is only imported once it is used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,231 @@
+"""
+Measures the time spent in Mathfinder's hot paths.
+
+The code times its steps with spans, and counts what it processes with
+counters:
+
+    with metrics.span("predict"):
+        y_pred = model.predict(X)
+    metrics.increment("rows_processed", len(X), stage="predict")
+
+Spans and counters can have labels, given as keyword arguments. They are
+gathered by the registry of the process, which can be exported as JSON with
+summary(), or in the Prometheus text format with to_prometheus(). Long-running
+processes (the Streamlit app, the prediction server) expose the latter on an
+HTTP endpoint, see start_server. Worker processes send the snapshot of their
+registry back to the main process, which merges it.
+"""
+import os
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Prefix of the names of the metrics exported to Prometheus
+PREFIX = "mathfinder"
+# Port of the metrics endpoint of the Streamlit app. The endpoint is disabled if it is not set.
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+
+def _get_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+class Registry:
+    """
+    Gathers the spans and counters recorded in a process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+            self._counters = {}
+            self.started_at = time.time()
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records a span of 'seconds' seconds.
+        """
+        key = _get_key(name, labels)
+        with self._lock:
+            count, total, maximum = self._spans.get(key, (0, 0.0, 0.0))
+            self._spans[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """
+        Adds 'value' to a counter.
+        """
+        key = _get_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Records the time spent in the block, even if it raises an exception.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the content of the registry, which can be given to merge.
+        """
+        with self._lock:
+            return {"spans": dict(self._spans), "counters": dict(self._counters)}
+
+    def merge(self, snapshot: dict):
+        """
+        Adds the spans and counters of a snapshot, e.g. taken in a worker process.
+        """
+        with self._lock:
+            for key, (count, total, maximum) in snapshot["spans"].items():
+                current_count, current_total, current_maximum = self._spans.get(key, (0, 0.0, 0.0))
+                self._spans[key] = (current_count + count, current_total + total, max(current_maximum, maximum))
+            for key, value in snapshot["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def summary(self) -> dict:
+        """
+        Returns the spans and counters in a form that can be written as JSON.
+        """
+        snapshot = self.snapshot()
+        spans = [
+            {"name": name, "labels": dict(labels), "count": count, "total_seconds": total, "max_seconds": maximum}
+            for (name, labels), (count, total, maximum) in snapshot["spans"].items()
+        ]
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in snapshot["counters"].items()
+        ]
+        return {
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "spans": sorted(spans, key=lambda span: -span["total_seconds"]),
+            "counters": sorted(counters, key=lambda counter: counter["name"]),
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the spans and counters in the Prometheus text format.
+
+        Spans are exported as a summary, mathfinder_span_seconds, with the name
+        of the span as the 'span' label. Each counter is exported as
+        mathfinder_<name>_total.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {PREFIX}_span_seconds Time spent in the steps of Mathfinder.",
+            f"# TYPE {PREFIX}_span_seconds summary",
+        ]
+        for (name, labels), (count, total, maximum) in sorted(snapshot["spans"].items()):
+            labels = _format_labels((("span", name),) + labels)
+            lines.append(f"{PREFIX}_span_seconds_count{labels} {count}")
+            lines.append(f"{PREFIX}_span_seconds_sum{labels} {total}")
+        lines.append(f"# TYPE {PREFIX}_span_seconds_max gauge")
+        for (name, labels), (count, total, maximum) in sorted(snapshot["spans"].items()):
+            lines.append(f"{PREFIX}_span_seconds_max{_format_labels((('span', name),) + labels)} {maximum}")
+
+        names = sorted({name for name, _ in snapshot["counters"]})
+        for counter_name in names:
+            lines.append(f"# TYPE {PREFIX}_{counter_name}_total counter")
+            for (name, labels), value in sorted(snapshot["counters"].items()):
+                if name == counter_name:
+                    lines.append(f"{PREFIX}_{name}_total{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    values = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        values.append(f'{key}="{value}"')
+    return "{" + ",".join(values) + "}"
+
+
+registry = Registry()
+
+
+def span(name: str, **labels):
+    """
+    Records the time spent in a block, see Registry.span.
+    """
+    return registry.span(name, **labels)
+
+
+def observe(name: str, seconds: float, **labels):
+    registry.observe(name, seconds, **labels)
+
+
+def increment(name: str, value: float = 1, **labels):
+    registry.increment(name, value, **labels)
+
+
+def get_total_seconds(snapshot: dict, name: str) -> float:
+    """
+    Returns the time spent in the spans called 'name' of a snapshot, whatever their labels.
+    """
+    return sum(total for (span_name, _), (_, total, _) in snapshot["spans"].items() if span_name == name)
+
+
+def write_summary(path: str):
+    """
+    Writes the summary of the registry to a JSON file.
+    """
+    with open(path, "w") as f:
+        json.dump(registry.summary(), f, indent=2)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the content of the registry in the Prometheus text format on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves the metrics of this process on http://<host>:<port>/metrics, in a
+    background thread. The server is only started once per process.
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+            except OSError:
+                logging.exception(f"Could not serve the metrics on port {port}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return _server
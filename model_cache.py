@@ -0,0 +1,184 @@
+"""
+Loads the models registered on MLflow and keeps them in memory.
+
+The Streamlit pages and the monitoring script all load their models through
+this module, so a model is only deserialized again when a new version of it
+has been registered. The cache is bounded by the size of the model artifacts
+and evicts the least recently used models first.
+
+The last version of a model is checked in the registry at most once every
+VERSION_CHECK_SECONDS, and the cached model keeps being used while the
+registry cannot be reached.
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import mlflow
+
+import formula
+import metrics
+import model_metadata
+
+
+# Maximum size of the cached models, in bytes (512 MB by default)
+MAX_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Number of seconds a cached model is used before its last version is checked again
+VERSION_CHECK_SECONDS = float(os.environ.get("MODEL_VERSION_CHECK_SECONDS", 10))
+
+
+def get_model_size(model_path: str) -> int:
+    """
+    Returns the size of the model artifacts on disk, used as an estimate of
+    the memory the model takes once loaded.
+    """
+    if not os.path.isdir(model_path):
+        return 0
+    size = 0
+    for root, _, filenames in os.walk(model_path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
+def load_predictor(model_path: str):
+    """
+    Loads the model stored at model_path.
+
+    If the compiled formulas of the model were stored next to it, they are
+    used instead of the pickled model, which is slower to load and to use.
+    """
+    formulas_path = os.path.join(os.path.dirname(model_path), formula.FORMULAS_ARTIFACT)
+    if os.path.exists(formulas_path):
+        return formula.load_formulas(formulas_path)
+    return mlflow.pyfunc.load_model(model_path)
+
+
+class ModelCache:
+    """
+    A least recently used cache for loaded models, keyed by (model name, version).
+
+    Only the last version of each model is kept: loading a new version
+    replaces the previous one. 'loader' is the function used to load a model
+    from its local path.
+    """
+
+    def __init__(self, max_size: int = MAX_CACHE_SIZE, loader=None):
+        self.max_size = max_size
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._models = OrderedDict()  # (name, version) -> (model, size)
+        self._checked_at = {}  # name -> time at which its version was last checked
+        self._size = 0
+        self._lock = Lock()
+
+    def get_cached(self, model_name: str, max_age: float = None):
+        """
+        Returns the cached version of the model referenced by model_name, or
+        None if it is not in the cache. If 'max_age' is set, None is also
+        returned when its version was checked more than 'max_age' seconds ago.
+        """
+        with self._lock:
+            key = next((cached_key for cached_key in self._models if cached_key[0] == model_name), None)
+            if key is None:
+                return None
+            if max_age is not None and time.monotonic() - self._checked_at.get(model_name, -float("inf")) >= max_age:
+                return None
+            self._models.move_to_end(key)
+            self.hits += 1
+        metrics.increment("model_cache_hits")
+        return self._models[key][0]
+
+    def get(self, model_name: str, version: str, model_path: str):
+        """
+        Returns the model stored at model_path, loading it only if this
+        version of the model is not already in the cache. 'version' must be
+        the last version of the model, just retrieved from the registry.
+        """
+        key = (model_name, version)
+        with self._lock:
+            self._checked_at[model_name] = time.monotonic()
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                metrics.increment("model_cache_hits")
+                return self._models[key][0]
+            self.misses += 1
+        metrics.increment("model_cache_misses")
+
+        logging.debug(f"Loading version {version} of model {model_name} from {model_path}")
+        loader = self.loader or load_predictor
+        with metrics.span("model_load"):
+            model = loader(model_path)
+        size = get_model_size(model_path)
+
+        with self._lock:
+            # Older versions of the model are stale now
+            for cached_key in list(self._models):
+                if cached_key[0] == model_name and cached_key != key:
+                    self._remove(cached_key)
+            if key not in self._models:
+                self._models[key] = (model, size)
+                self._size += size
+            while self._size > self.max_size and len(self._models) > 1:
+                self._remove(next(iter(self._models)))
+        return model
+
+    def invalidate(self, model_name: str):
+        """
+        Removes every version of the model referenced by model_name from the cache.
+        """
+        with self._lock:
+            for cached_key in list(self._models):
+                if cached_key[0] == model_name:
+                    self._remove(cached_key)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "models": len(self._models),
+                "size": self._size,
+            }
+
+    def _remove(self, key: tuple):
+        _, size = self._models.pop(key)
+        self._size -= size
+        self.evictions += 1
+        metrics.increment("model_cache_evictions")
+
+
+cache = ModelCache()
+
+
+def load_model(model_name: str):
+    """
+    Loads the last version of the model referenced by model_name.
+
+    The last version is requested from the registry rather than read from the
+    metadata cache, at most once every VERSION_CHECK_SECONDS, so a model
+    retrained by another process is used soon after it is registered. If the
+    registry cannot be reached, the cached version of the model is used.
+    """
+    model = cache.get_cached(model_name, VERSION_CHECK_SECONDS)
+    if model is not None:
+        return model
+    try:
+        version, source = model_metadata.get_latest_version(model_name)
+    except Exception:
+        model = cache.get_cached(model_name)
+        if model is None:
+            raise
+        logging.warning(f"Could not check the last version of model {model_name}, the cached version is used", exc_info=True)
+        return model
+    model_metadata.cache.check_version(model_name, version)
+    return cache.get(model_name, str(version), model_metadata.get_local_model_path(source))
@@ -0,0 +1,236 @@
+"""
+Caches the information about the registered models that is read from MLflow.
+
+Testing a model needs its last version, the location of its artifacts, the
+names of its feature and target columns and the Mean Absolute Error of its
+first run. Each of these used to cost one or two requests to the tracking
+server every time a model was tested. They are now kept in memory for
+METADATA_TTL seconds, and can be retrieved for every model at once.
+"""
+import os
+import time
+import logging
+from threading import Lock
+from urllib.parse import unquote, urlparse
+
+import mlflow
+
+import metrics
+
+
+# Number of seconds the metadata of a model are kept before being retrieved again
+METADATA_TTL = float(os.environ.get("MODEL_METADATA_TTL", 300))
+# Only the runs of the models have this metric: the candidates of a multi-start
+# search, logged as child runs, are ignored
+MODEL_RUNS_FILTER = "metrics.`mean absolute error` >= 0"
+
+
+@metrics.span("mlflow_lookup", call="get_latest_version")
+def get_latest_version(model_name: str) -> tuple:
+    """
+    Returns a tuple (version, source URI) for the last version of the model
+    referenced by model_name.
+
+    Only one model version is requested from the registry, so this is cheap
+    enough to be called every time a model is needed.
+    """
+    client = mlflow.MlflowClient()
+    model_versions = client.search_model_versions(
+        f"name='{model_name}'", max_results=1, order_by=["version_number DESC"]
+    )
+    return model_versions[0].version, model_versions[0].source
+
+
+def get_local_model_path(model_uri: str) -> str:
+    """
+    Converts the URI of a model stored by the MLflow server, or in a local
+    file store, into its local path.
+    """
+    if model_uri.startswith("file:"):
+        return unquote(urlparse(model_uri).path)
+    if not model_uri.startswith("mlflow-artifacts:"):
+        return model_uri
+    # Reconstituting the model local path
+    splitted_uri = model_uri.split("/")[1:]
+    return "mlartifacts/" + "/".join(splitted_uri)
+
+
+class ModelMetadata:
+    """
+    The information about the last version of a registered model.
+    """
+
+    def __init__(self, name: str, version: str, source: str, feature_names: list, target_names: list, original_mae: float):
+        self.name = name
+        self.version = version
+        self.source = source
+        self.feature_names = feature_names
+        self.target_names = target_names
+        self.original_mae = original_mae
+        self.retrieved_at = time.monotonic()
+
+    @property
+    def local_path(self) -> str:
+        return get_local_model_path(self.source)
+
+
+@metrics.span("mlflow_lookup", call="get_signature_names")
+def get_signature_names(source: str) -> tuple:
+    """
+    Returns the names of the feature and target columns in the signature of
+    the model stored at source.
+
+    The MLmodel file is read from the disk when the artifacts are stored locally.
+    """
+    local_path = get_local_model_path(source)
+    if os.path.exists(os.path.join(local_path, "MLmodel")):
+        signature = mlflow.models.Model.load(local_path).signature
+    else:
+        signature = mlflow.models.get_model_info(source).signature
+    return signature.inputs.input_names(), signature.outputs.input_names()
+
+
+@metrics.span("mlflow_lookup", call="get_original_mae")
+def get_original_mae(model_name: str) -> float:
+    """
+    Retrieves and returns the Mean Absolute Error of the model's first run.
+    """
+    client = mlflow.MlflowClient()
+    experiment = client.get_experiment_by_name(f"/{model_name}")
+    runs = client.search_runs(
+        experiment.experiment_id, filter_string=MODEL_RUNS_FILTER, order_by=["end_time"], max_results=1
+    )
+    first_run = runs[0].data.to_dictionary()
+    return first_run["metrics"]["mean absolute error"]
+
+
+def _get_all_pages(search, **kwargs) -> list:
+    """
+    Returns the results of an MLflow search method over all pages.
+    """
+    results = []
+    page_token = None
+    while True:
+        page = search(page_token=page_token, **kwargs)
+        results.extend(page)
+        page_token = page.token
+        if not page_token:
+            return results
+
+
+class MetadataCache:
+    """
+    Keeps the metadata of the registered models for 'ttl' seconds.
+    """
+
+    def __init__(self, ttl: float = METADATA_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, model_name: str) -> ModelMetadata:
+        """
+        Returns the metadata of the model referenced by model_name.
+        """
+        with self._lock:
+            metadata = self._entries.get(model_name)
+        if metadata is not None and time.monotonic() - metadata.retrieved_at < self.ttl:
+            metrics.increment("metadata_cache_hits")
+            return metadata
+        metrics.increment("metadata_cache_misses")
+
+        version, source = get_latest_version(model_name)
+        feature_names, target_names = get_signature_names(source)
+        metadata = ModelMetadata(
+            model_name, version, source, feature_names, target_names, get_original_mae(model_name)
+        )
+        with self._lock:
+            self._entries[model_name] = metadata
+        return metadata
+
+    def invalidate(self, model_name: str):
+        """
+        Forgets the metadata of a model, which must be done when it is retrained.
+        """
+        with self._lock:
+            self._entries.pop(model_name, None)
+
+    def check_version(self, model_name: str, version: str):
+        """
+        Forgets the metadata of a model if they are not those of 'version', its
+        last version: the model was retrained since they were retrieved.
+        """
+        with self._lock:
+            metadata = self._entries.get(model_name)
+            if metadata is not None and str(metadata.version) != str(version):
+                del self._entries[model_name]
+
+    @metrics.span("mlflow_lookup", call="warm")
+    def warm(self) -> int:
+        """
+        Retrieves the metadata of every registered model with a few bulk requests.
+
+        Returns the number of models found.
+        """
+        client = mlflow.MlflowClient()
+
+        last_versions = {}
+        for model_version in _get_all_pages(client.search_model_versions):
+            last_version = last_versions.get(model_version.name)
+            if last_version is None or int(model_version.version) > int(last_version.version):
+                last_versions[model_version.name] = model_version
+
+        experiment_ids = {}
+        for experiment in _get_all_pages(client.search_experiments):
+            experiment_ids[experiment.experiment_id] = experiment.name
+        original_maes = {}
+        if experiment_ids:
+            runs = _get_all_pages(
+                client.search_runs,
+                experiment_ids=list(experiment_ids),
+                filter_string=MODEL_RUNS_FILTER,
+                order_by=["end_time"],
+            )
+            for run in runs:
+                experiment_name = experiment_ids[run.info.experiment_id]
+                # Runs are sorted, so the first one found for an experiment is its first run
+                if experiment_name not in original_maes:
+                    original_maes[experiment_name] = run.data.metrics.get("mean absolute error")
+
+        entries = {}
+        for model_name, model_version in last_versions.items():
+            try:
+                feature_names, target_names = get_signature_names(model_version.source)
+            except Exception:
+                logging.exception(f"Could not read the signature of model {model_name}")
+                continue
+            entries[model_name] = ModelMetadata(
+                model_name,
+                model_version.version,
+                model_version.source,
+                feature_names,
+                target_names,
+                original_maes.get(f"/{model_name}"),
+            )
+
+        with self._lock:
+            self._entries.update(entries)
+        logging.info(f"Retrieved the metadata of {len(entries)} model(s)")
+        return len(entries)
+
+    def export(self) -> dict:
+        """
+        Returns the cached metadata, so they can be loaded in another process.
+        """
+        with self._lock:
+            return dict(self._entries)
+
+    def load(self, entries: dict):
+        """
+        Adds metadata exported from another process to the cache.
+        """
+        with self._lock:
+            self._entries.update(entries)
+
+
+cache = MetadataCache()
@@ -1,30 +1,41 @@
 """
 This script monitors all the models registered in Mathfinder's database.
 
-It is intended to be run every day, using the CSV files stored 
+It is intended to be run every day, using the data files stored 
 in the 'autotest' folder to test the models and make sure their performance 
 is still within a reasonable range away from the performance obtained with
 the first version of the model.
 """
 import os
-import json
+import argparse
 import logging
 from datetime import date, datetime
-import smtplib
-from email.mime.text import MIMEText
+from concurrent.futures import ProcessPoolExecutor
 
-import mysql.connector
-import mlflow
-import pandas as pd
-from sklearn.metrics import mean_absolute_error
+import database
+import metrics
+import reports
+from lazy_imports import lazy_import
 
+# Most runs test few models, or none: the modules that import mlflow and
+# scikit-learn are only imported once a model has to be tested
+mlflow = lazy_import("mlflow")
+autotest = lazy_import("autotest")
+drift = lazy_import("drift")
+evaluation = lazy_import("evaluation")
+model_cache = lazy_import("model_cache")
+model_metadata = lazy_import("model_metadata")
 
 
-def setup_logging():
+# Number of models retrieved from the database at once
+PAGE_SIZE = 100
+
+
+def setup_logging() -> str:
     """
     Sets up everything required in order to log enable logging in a .log file.
 
-    Logs are located in the 'logs' subfolder.
+    Logs are located in the 'logs' subfolder. Returns the path of the log file.
     """
     if not (os.path.exists("./logs") and os.path.isdir("./logs")):
         os.mkdir("./logs")
@@ -33,214 +44,288 @@ def setup_logging():
     now = datetime.now()
     filename = now.strftime("%Y_%m_%d_%H_%M_%S.log")
     logging.basicConfig(filename=os.path.join("./logs", filename), level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    return os.path.join("./logs", filename)
     
 
     
 
-def testing_is_necessary(last_testing_date, test_frequency: int) -> bool:
+def evaluate_test_files(model_name: str, test_files: "autotest.TestFiles") -> tuple:
     """
-    Decides if a test should be performed based on the date of the last date.
+    Evaluates the model on every pending test file, reading them one chunk at a time.
+
+    Returns a tuple of dicts (errors, drifts) mapping the name of each file to
+    its StreamingErrors, and to its StreamingDrift if the feature sketches of
+    the model are available. Files that do not contain the right columns are
+    marked as invalid.
     """
-    today = date(2024, 6, 16)
-    #today = date.today()
-    days_elapsed = today - last_testing_date
 
-    if days_elapsed.days > test_frequency:
-        return True
-    return False
+    # First we retrieve the name of each feature and target values so we know ehat columns we should use in the CSV
+    metadata = model_metadata.cache.get(model_name)
+    feature_names = metadata.feature_names
+    target_names = metadata.target_names
+
+    model = None
+    sketches = None
+    file_errors = {}
+    file_drifts = {}
+    # Oldest files first
+    for filename in test_files.pending():
+        if model is None:
+            model = load_model(model_name)
+            sketches = drift.load_sketches(metadata.local_path)
+        file_drift = drift.StreamingDrift(sketches) if sketches is not None else None
+        try:
+            file_errors[filename] = evaluation.evaluate_file(
+                model, test_files.path(filename), feature_names, target_names, drift=file_drift
+            )
+        except ValueError as e:
+            logging.info(f"Could not evaluate model {model_name} with {filename}, make sure it contains columns {feature_names}, {target_names}: {e}")
+            test_files.mark_invalid(filename, str(e))
+            continue
+        if not file_errors[filename].count:
+            test_files.mark_invalid(filename, "The file does not contain any row.")
+            del file_errors[filename]
+            continue
+        if file_drift is not None:
+            file_drifts[filename] = file_drift
+        logging.debug(f"Evaluated model {model_name} with {filename}: {file_errors[filename].to_dict()}")
+    return file_errors, file_drifts
+
 
-def update_testing_date(model_name: str):
+def get_drift_report(drifts: dict) -> str:
     """
-    Update the last testing date in the database.
+    Returns the part of the report that describes the drift of each feature,
+    given the StreamingDrift of each test file.
     """
+    total = None
+    for file_drift in drifts.values():
+        if total is None:
+            total = drift.StreamingDrift({"features": file_drift.sketches})
+        total.merge(file_drift)
+    features = total.to_dict() if total is not None else {}
+    if not features:
+        return ""
+    report = "\n\nDrift of the features compared to the training data (PSI above "
+    report += f"{drift.PSI_THRESHOLD} or KS above {drift.KS_THRESHOLD} means the data changed significantly):"
+    for name, statistics in features.items():
+        report += f"\n- {name}: PSI {statistics['psi']:.3f}, KS {statistics['ks']:.3f}"
+        if statistics["drifted"]:
+            report += " (drifted)"
+    drifted = [name for name, statistics in features.items() if statistics["drifted"]]
+    if drifted:
+        logging.info(f"Features {drifted} drifted")
+    return report
 
-    logging.debug(f"Updated last training date for model {model_name}")
-    with mysql.connector.connect(
-        host="localhost",
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="mathfinder"
-    ) as db:
-        with db.cursor() as c:
-            today = date.today()
-            query = f"""UPDATE Models SET last_testing_date="{today.strftime('%Y-%m-%d')}" WHERE name="{model_name}";"""
-            c.execute(query)
-            db.commit()
+def load_model(model_name: str):
+    """
+    Loads the last version of the mode lreferenced by model_name.
+    """
+
+    return model_cache.load_model(model_name)
 
-def get_test_data(model_name: str) -> tuple:
+def get_original_metrics(model_name: str) -> float:
     """
-    Retrieves, loads and returns the test data for a specific model.
+    Retrieves and returns the Mean Absolute Error of the model's first run.
+    """
+    return model_metadata.cache.get(model_name).original_mae
 
-    Returns a tuple (X, y, filename) if the data was found, False otherwise.
+@metrics.span("check_model")
+def check_model(model_name: str, email: str) -> dict:
     """
+    Tests a single model using all its pending test files.
 
-    # First we retrieve the name of each feature and target values so we know ehat columns we should use in the CSV
-    client = mlflow.MlflowClient()
-    model_versions = client.search_model_versions(f"name='{model_name}'")
-    last_version = model_versions[0].version
-    model_uri = client.get_model_version_download_uri(model_name, last_version)
-    model_info = mlflow.models.get_model_info(model_uri)
-    schema = model_info._signature_dict
-
-    feature_names = []
-    target_names = []
-    feature_data_json = json.loads(schema["inputs"])
-    target_data_json = json.loads(schema["outputs"])
-    for feature in feature_data_json:
-        feature_names.append(feature["name"])
-    for target in target_data_json:
-        target_names.append(target["name"])
-    
-    # Loading the oldest CSV in the test data folder
-    oldest_csv_file_name = None
-    oldest_modification_time= None
-    
-    subdir = os.path.join("./autotest", model_name)
-    for filename in os.listdir(subdir):
-        if not filename.endswith(".csv"):
-            continue
-        modification_time = os.path.getmtime(os.path.join(subdir, filename))
-        if not oldest_modification_time:
-            oldest_modification_time = modification_time
-            oldest_csv_file_name = filename
-        elif modification_time < oldest_modification_time:
-            oldest_modification_time = modification_time
-            oldest_csv_file_name = filename
-    
-    if not oldest_csv_file_name:
-        return False
-    
-    test_csv = pd.read_csv(os.path.join(subdir, oldest_csv_file_name))
-    
+    The files are read one chunk at a time, then the errors measured on each
+    file are stored in the manifest of the test files and the files are archived.
+
+    Returns a dict with the model name, the email address the report should be
+    sent to, the title and the body of that report. The 'tested' key is False
+    if an unexpected error prevented the test, in which case no report should
+    be sent and the model will be tested again during the next run.
+    """
+    logging.debug(f"Processing model {model_name}")
+    result = {"model_name": model_name, "email": email, "tested": True}
+    test_files = autotest.TestFiles(model_name)
     try:
-        X = test_csv[feature_names]
-        y = test_csv[target_names]
-        return X, y, oldest_csv_file_name
-    
-    except KeyError:
-        print(f"ERROR: Could not find columns {feature_names}, {target_names} in {oldest_csv_file_name}.")
-        return False
+        file_errors, file_drifts = evaluate_test_files(model_name, test_files)
+        if not file_errors:
+            logging.info(f"Model {model_name} should be tested but test data could not be loaded. This means they are either missing or do not follow the right formatting.")
+            title = "Mathfinder did not find your test data"
+            report = f"""Mathfinder tried to test your model {model_name} to ensure it still retains good performance, but no testing data was found. Please ensure that:\n- there is at least one CSV, Parquet or Arrow file that contains test data in the 'autotest/<your model name> folder, in Mathfinder's directory\n- this file contains one column for each input data used in your model, and one for each target value. The column names must be the same as those of the data used to train the model."""
+        else:
+            logging.debug(f"Test data loaded for model {model_name}")
+            errors = evaluation.StreamingErrors()
+            for file_error in file_errors.values():
+                errors.merge(file_error)
+            mae = errors.mae
 
-def load_model(model_name: str):
+            original_mae = get_original_metrics(model_name)
+
+            if mae < 1.05 * original_mae:
+                logging.info(f"MAE computed for model {model_name}: {mae}. Original MAE: {original_mae}. Performance metrics are still acceptable")
+                title = "Your model passed the test"
+                report = f"""Congratulations, your model {model_name} is doing well!\nMathfinder tested your model automatically using the testing data your provided, and its performance is still good."""
+
+            else:
+                logging.info(f"MAE computed for model {model_name}: {mae}. Original MAE: {original_mae}. Error metrics are above the acceptability threshold, the model must be retrained")
+                title = "Your model failed the test"
+                report = f"""Your model {model_name} needs to be retrained!\nMathfinder tested your model automatically using the testing data your provided, and its performance metrics went down. Please retrain your model using recent data whenever you have the chance."""
+
+            report += "\n"
+            report += f"Original mean absolute error (MAE): {original_mae}\n"
+            report += f"MAE with the latest test: {mae}\n"
+            report += f"Root mean squared error (RMSE) with the latest test: {errors.rmse}\n"
+            report += f"Maximum error with the latest test: {errors.max_error}\n"
+            report += f"Number of rows tested: {errors.count}\n"
+            report += "Acceptability threshold: 105% of the original MAE"
+            if len(file_errors) > 1:
+                report += "\n\nMAE for each test file:"
+                for filename, file_error in file_errors.items():
+                    report += f"\n- {filename} ({file_error.count} rows): {file_error.mae}"
+            report += get_drift_report(file_drifts)
+            logging.info(f"Tested model {model_name} on {errors.count} rows at {errors.rows_per_second:.0f} rows/s")
+
+            for filename, file_error in file_errors.items():
+                file_result = file_error.to_dict()
+                file_result["original_mae"] = original_mae
+                file_result["passed"] = bool(file_error.mae < 1.05 * original_mae)
+                if filename in file_drifts:
+                    file_result["drift"] = file_drifts[filename].to_dict()
+                test_files.mark_processed(filename, file_result)
+
+    except Exception:
+        logging.exception(f"An unexpected error occured while testing model {model_name}")
+        result["tested"] = False
+        return result
+    finally:
+        test_files.save()
+
+    result["title"] = title
+    result["report"] = report
+    return result
+
+
+def init_worker(tracking_uri: str, metadata: dict):
     """
-    Loads the last version of the mode lreferenced by model_name.
+    Sets up a worker process used to test the models concurrently.
     """
+    mlflow.set_tracking_uri(tracking_uri)
+    model_metadata.cache.load(metadata)
 
-    client = mlflow.MlflowClient()
-    model_versions = client.search_model_versions(f"name='{model_name}'")
-    last_version = model_versions[0].version
-    model_uri = client.get_model_version_download_uri(name=model_name, version=last_version)
-    # Reconstituting the model local path
-    splitted_uri = model_uri.split("/")[1:]
-    model_uri = "mlartifacts/" + "/".join(splitted_uri)
-    model = mlflow.pyfunc.load_model(model_uri)
-    return model
 
-def get_original_metrics(model_name: str) -> float:
+def check_model_in_worker(model_name: str, email: str) -> tuple:
     """
-    Retrieves and returns the Mean Absolute Error of the model's first run.
+    Runs check_model in a worker process. Returns a tuple (result, metrics
+    snapshot of the test), so the main process can merge the metrics.
+    """
+    metrics.registry.reset()
+    result = check_model(model_name, email)
+    return result, metrics.registry.snapshot()
+
+
+def run_checks(models: list, executor: ProcessPoolExecutor = None) -> list:
     """
-    client = mlflow.tracking.MlflowClient()
-    experiment = client.get_experiment_by_name(f"/{model_name}")
-    runs = client.search_runs(experiment.experiment_id, order_by=["end_time"])
-    first_run = runs[0].data.to_dictionary()
-    return first_run["metrics"]["mean absolute error"]
+    Tests every model in 'models'.
 
-def give_report(title: str, report: str, email: str):
+    'models' holds rows of the Models table. If an executor is given, the models
+    are tested concurrently in its worker processes.
+    Returns the results of check_model, in the same order as 'models'.
     """
-    Conveys the test report to the user.
+    model_names = [model[0] for model in models]
+    emails = [model[1] for model in models]
+    if executor is None or len(models) <= 1:
+        return list(map(check_model, model_names, emails))
+    results = []
+    for result, snapshot in executor.map(check_model_in_worker, model_names, emails):
+        metrics.registry.merge(snapshot)
+        results.append(result)
+    return results
+
+
+def run_monitoring(
+    db: database.Database,
+    today: date,
+    workers: int = 1,
+    page_size: int = PAGE_SIZE,
+    report_sender: reports.ReportSender = None,
+):
     """
-    print(f"Report given to {email}:")
-    print(report)
+    Tests every model that is due for testing on 'today'.
 
-    #TODO: enlever 'smtp.gmail.com' du code, utiliser la variable d'environnement à la place
-    # Some environment variables need to be set, depending on the SMTP server you use
-    subject = title
-    body = report
-    sender = os.environ["SMTP_LOGIN"]
-    recipients = [email]
-    password = os.environ["SMTP_PWD"]
-    smtp_server = os.environ["SMTP_SERVER"]
+    The models are retrieved from the database one page of 'page_size' models at
+    a time. Each page is tested, then the reports are queued and the testing dates
+    are updated before the next page is retrieved. If 'workers' is greater than 1,
+    the models are tested concurrently in a pool of 'workers' processes.
 
-    msg = MIMEText(body)
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = ', '.join(recipients)
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp_server:
-       smtp_server.login(sender, password)
-       smtp_server.sendmail("papelardvincent@gmail.com", recipients, msg.as_string())
-    print("Message sent!")
+    The reports are sent once every model was tested, with one email for each
+    user, by 'report_sender' (a ReportSender using the SMTP server set in the
+    environment by default).
+    """
+    if report_sender is None:
+        report_sender = reports.ReportSender()
 
+    # Retrieving the metadata of every model at once is much faster than
+    # retrieving them model by model
+    try:
+        model_metadata.cache.warm()
+    except Exception:
+        logging.exception("Could not retrieve the metadata of the models, they will be retrieved one by one")
 
-if __name__ == "__main__":
+    executor = None
+    if workers > 1:
+        logging.info(f"Testing models with {workers} worker processes")
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(mlflow.get_tracking_uri(), model_metadata.cache.export()),
+        )
 
-    setup_logging()
-    logging.info("Starting the monitoring script")
+    try:
+        for models in db.get_due_models(today, page_size):
+            logging.info(f"Retrieved {len(models)} model(s) due for testing")
+            results = run_checks(models, executor)
+            for result in results:
+                report_sender.add(result)
+            tested_models = [result["model_name"] for result in results if result["tested"]]
+            metrics.increment("models_tested", len(tested_models))
+            db.update_testing_dates(tested_models, today)
+            logging.debug(f"Updated last testing date for models {tested_models}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        report_sender.close()
 
-    mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
 
-    
-    with mysql.connector.connect(
-        host="localhost",
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="mathfinder"
-    ) as db:
-        
-        logging.info("Established connection with the database")
-        with db.cursor() as c:
-            
-            query = """SELECT * FROM Models;"""
-            c.execute(query)
-            models = c.fetchall()
-            logging.info("Retrieved models list")
-            for model in models:
-                model_name = model[0]
-                email = model[1]
-                logging.debug(f"Processing model {model_name}")
-                if testing_is_necessary(last_testing_date=model[3], test_frequency=model[2]):
-                    
-                    report = "" # Stores the report that will be conveyed to the user
-                    test_data = get_test_data(model_name)
-                    if not test_data:
-                        logging.info(f"Model {model_name} should be tested but test data could not be loaded. This means they are either missing or do not follow the right formatting.")
-                        title = "Mathfinder did not find your test data"
-                        report = f"""Mathfinder tried to test your model {model_name} to ensure it still retains good performance, but no testing data was found. Please ensure that:\n- there is at least one CSV file that contains test data in the 'autotest/<your model name> folder, in Mathfinder's directory\n- this CSV file contains one column for each input data used in your model, and one for each target value. The column names must be the same as those of the data used to train the model."""
-                    else:
-                        logging.debug(f"Test data loaded for model {model_name}")
-                        model = load_model(model_name)
-                        X_test = test_data[0]
-                        y_test = test_data[1]
-                        filename = test_data[2]
-                        y_pred = model.predict(X_test)
-                        mae = mean_absolute_error(y_test, y_pred)
-                    
-                        subdir = os.path.join("./autotest", model_name)
-                        os.remove(os.path.join(subdir, filename))
-
-                        original_mae = get_original_metrics(model_name)
-
-                        
-                        
-                        if mae < 1.05 * original_mae:
-                            logging.info(f"MAE computed for model {model_name}: {mae}. Original MAE: {original_mae}. Performance metrics are still acceptable")
-                            title = "Your model passed the test"
-                            report = f"""Congratulations, your model {model_name} is doing well!\nMathfinder tested your model automatically using the testing data your provided, and its performance is still good."""
-                                
-                        else:
-                            logging.info(f"MAE computed for model {model_name}: {mae}. Original MAE: {original_mae}. Error metrics are above the acceptability threshold, the model must be retrained")
-                            title = "Your model failed the test"
-                            report = f"""Your model {model_name} needs to be retrained!\nMathfinder tested your model automatically using the testing data your provided, and its performance metrics went down. Please retrain your model using recent data whenever you have the chance."""
-                                
-                        report += "\n"
-                        report += f"Original mean absolute error (MAE): {original_mae}\n"
-                        report += f"MAE with the latest test: {mae}\n"
-                        report += "Acceptability threshold: 105% of the original MAE"
-                    
-                    logging.info(f"Sending report to the email address registered for model {model_name}")
-                    give_report(title, report, email)
-                    update_testing_date(model_name)
-                    
-            
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Tests the models registered in Mathfinder.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to test the models concurrently (default: 1)",
+    )
+    parser.add_argument(
+        "--date",
+        type=date.fromisoformat,
+        default=date.today(),
+        help="date of the run, in YYYY-MM-DD format (default: today)",
+    )
+    args = parser.parse_args()
 
+    log_file = setup_logging()
+    logging.info("Starting the monitoring script")
+
+    try:
+        with metrics.span("monitoring"):
+            db = database.get_database()
+            if db.has_due_models(args.date):
+                mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
+                run_monitoring(db, today=args.date, workers=args.workers)
+            else:
+                logging.info("No model is due for testing")
+    finally:
+        # The time spent in each step of the run, next to its logs
+        metrics_file = os.path.splitext(log_file)[0] + "_metrics.json"
+        metrics.write_summary(metrics_file)
+        logging.info(f"Metrics of the run written to {metrics_file}")
+    logging.info("Monitoring complete")
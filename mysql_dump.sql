@@ -27,7 +27,9 @@ CREATE TABLE `Models` (
   `email` varchar(100) NOT NULL,
   `test_every_nth_day` int NOT NULL,
   `last_testing_date` date NOT NULL,
-  PRIMARY KEY (`name`)
+  `next_testing_date` date NOT NULL,
+  PRIMARY KEY (`name`),
+  KEY `idx_next_testing_date` (`next_testing_date`,`name`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -1,85 +1,123 @@
-import pickle
+import os
+import tempfile
 
 import streamlit as st
-import mlflow
-from mlflow import MlflowClient
+import numpy as np
 import pandas as pd
-from sblearn.models import SymbolicRegressor
+
+import app_setup
+import datasets
+import dataset_cache
+import metrics
+from lazy_imports import lazy_import
+
+# These modules import mlflow, which is only needed once the user makes predictions
+model_cache = lazy_import("model_cache")
+model_metadata = lazy_import("model_metadata")
+
+CHUNK_SIZE = 100000  # Number of rows processed at once when making predictions
 
 st.set_page_config(layout="wide")
+app_setup.set_up_process()
 
 left_co, cent_co, last_co = st.columns(3)
 with cent_co:
     st.title("Use a trained model to make predictions")
 
 uploaded_file = st.file_uploader(
-    label="Upload the CSV file that contains your data here"
+    label="Upload the CSV, Parquet or Arrow file that contains your data here",
+    type=list(datasets.EXTENSIONS),
 )
 
 
-def predict(dataframe: pd.DataFrame, feature_columns: str, model_name: str):
+def predict(uploaded_file, feature_columns: str, model_name: str):
     """
     Uses the trained model identified by 'model_name' to perform predictions
     on the data stored in the columns 'feature_columns'.
+
+    The uploaded file is processed in chunks of CHUNK_SIZE rows, and the
+    predictions are written to a temporary file as soon as each chunk is done,
+    so that large files never have to fit in memory at once.
     """
 
-    client = MlflowClient()
-    model_versions = client.search_model_versions(f"name='{model_name}'")
-    last_version = model_versions[0].version
-    model_uri = client.get_model_version_download_uri(
-        name=model_name, version=last_version
-    )
-    # Reconstituting the model local path
-    splitted_uri = model_uri.split("/")[1:]
-    model_uri = "mlartifacts/" + "/".join(splitted_uri)
-    model = mlflow.pyfunc.load_model(model_uri)
+    model = model_cache.load_model(model_name)
+    target_names = model_metadata.cache.get(model_name).target_names
+
+    # Removing the file generated by the previous predictions, if any
+    previous_file = st.session_state.get("predictions_file")
+    if previous_file and os.path.exists(previous_file):
+        os.remove(previous_file)
 
-    X = prepare_data(dataframe, feature_columns)
-    if type(X) != bool:
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(
+        mode="w", suffix=".csv", delete=False, encoding="utf-8"
+    ) as output:
+        st.session_state["predictions_file"] = output.name
         with st.spinner(
             "The model is predicting values based on the data you uploaded. This might take a few seconds, please do not close this page."
         ):
-            y_pred = model.predict(X)
-
-        dataframe["predictions"] = y_pred
-        csv = dataframe.to_csv(index=False).encode("utf-8")
-        st.info(f"Predictions complete! You can download the data in CSV format below:")
+            for i, chunk in enumerate(datasets.iter_chunks(uploaded_file, chunk_size=CHUNK_SIZE)):
+                chunk = chunk.loc[:, ~chunk.columns.str.contains("^Unnamed")]
+                X = prepare_data(chunk, feature_columns)
+                if type(X) == bool:
+                    return
+                with metrics.span("predict"):
+                    add_predictions(chunk, model.predict(X), target_names)
+                metrics.increment("rows_processed", len(X), stage="predict")
+                chunk.to_csv(output, index=False, header=(i == 0))
+
+    st.info(f"Predictions complete! You can download the data in CSV format below:")
+    with open(output.name, "rb") as csv:
         st.download_button(
             "Download CSV", csv, "predictions.csv", "text/csv", key="download-csv"
         )
 
 
+def add_predictions(chunk: pd.DataFrame, predictions, target_names: list):
+    """
+    Adds the predictions of the model to the chunk, in a 'predictions' column,
+    or in a 'predictions_<target name>' column for each target of a model that
+    predicts several targets.
+    """
+    predictions = np.reshape(np.asarray(predictions), (len(chunk), -1))
+    if predictions.shape[1] == 1:
+        chunk["predictions"] = predictions[:, 0]
+        return
+    for i, target_name in enumerate(target_names):
+        chunk[f"predictions_{target_name}"] = predictions[:, i]
+
+
+@metrics.span("prepare_data")
 def prepare_data(dataframe: pd.DataFrame, feature_columns: str):
     """
     Retrieves the data in the columns required by the user.
     """
-    f_headers = feature_columns.split(";")
-    for i in range(len(f_headers)):
-        f_headers[i] = f_headers[i].strip()
+    f_headers = datasets.parse_column_names(feature_columns)
 
     try:
         X = dataframe[f_headers]
     except KeyError:
         msg_error = "An error occured while retrieving the data from the columns you specified. Make sure you entered the column names properly."
         st.error(msg_error)
-        return False, False
+        return False
 
     return X
 
 
 if uploaded_file:
 
-    df = pd.read_csv(uploaded_file)
-    df = df.loc[:, ~df.columns.str.contains("^Unnamed")]  # Dropping unnamed columns
+    # Only the first rows are needed for the preview, the whole file is
+    # read in chunks when making predictions
+    df = dataset_cache.read_preview(uploaded_file, st.session_state)
     with st.expander("Data preview"):
         st.subheader("Your data (preview might be truncated):")
-        st.table(df.head(20))
+        st.table(df)
     feature_column_names = st.text_input(
         label="Enter the names of the columns you want to use to make predictions"
     )
     model_name = st.text_input(label="Enter the name of the model you want to use")
     kwargs = {
-        "dataframe": df,
+        "uploaded_file": uploaded_file,
         "feature_columns": feature_column_names,
         "model_name": model_name,
     }
@@ -1,115 +1,92 @@
-import os
 from datetime import date
 
 import streamlit as st
-import mysql.connector
-import mlflow
-from mlflow import MlflowClient
-import pandas as pd
-from sklearn.metrics import mean_absolute_error
+
+import app_setup
+import datasets
+import dataset_cache
+import evaluation
+from lazy_imports import lazy_import
+
+# These modules import mlflow or the MySQL connector, which are only needed once the model is tested
+database = lazy_import("database")
+model_cache = lazy_import("model_cache")
+model_metadata = lazy_import("model_metadata")
 
 
 def get_original_metrics(model_name: str) -> float:
     """
     Retrieves and returns the Mean Absolute Error of the model's first run.
     """
-    client = mlflow.tracking.MlflowClient()
-    experiment = client.get_experiment_by_name(f"/{model_name}")
-    runs = client.search_runs(experiment.experiment_id, order_by=["end_time"])
-    first_run = runs[0].data.to_dictionary()
-    return first_run["metrics"]["mean absolute error"]
+    return model_metadata.cache.get(model_name).original_mae
 
 
 def update_testing_date(model_name: str):
     """
     Update the last testing date in the database.
     """
-    with mysql.connector.connect(
-        host="localhost",
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="mathfinder",
-    ) as db:
-        with db.cursor() as c:
-            today = date.today()
-            query = f"""UPDATE Models SET last_testing_date="{today.strftime('%Y-%m-%d')}" WHERE name="{model_name}";"""
-            c.execute(query)
-            db.commit()
-
-
-def test(
-    dataframe: pd.DataFrame, feature_columns: list, target_column: str, model_name: str
-):
+    database.get_database().update_testing_dates([model_name], date.today())
+
+
+def test(uploaded_file, feature_columns: str, target_column: str, model_name: str):
     """
     Computes the MAE for the model identified by 'model_name' using the testing data provided.
-    """
 
-    client = MlflowClient()
-    model_versions = client.search_model_versions(f"name='{model_name}'")
-    last_version = model_versions[0].version
-    model_uri = client.get_model_version_download_uri(
-        name=model_name, version=last_version
-    )
-    # Reconstituting the model local path
-    splitted_uri = model_uri.split("/")[1:]
-    model_uri = "mlartifacts/" + "/".join(splitted_uri)
-    model = mlflow.pyfunc.load_model(model_uri)
-
-    X_test, y_test = prepare_data(dataframe, feature_columns, target_column)
-    if type(X_test) != bool:
-        with st.spinner(
-            "The model is predicting values based on the data you uploaded. This might take a few seconds, please do not close this page."
-        ):
-            y_pred = model.predict(X_test)
-            mae = mean_absolute_error(y_test, y_pred)
-            original_mae = get_original_metrics(model_name)
-
-        if mae < 1.05 * original_mae:
-            msg = f"""Congratulations, your model {model_name} is doing well!\nYour model reached a Mean Absolute Error (MAE) of {mae}, which is under the threshold set at 105% of the MAE obtained after the model was trained for the first time. The original MAE was {original_mae}."""
-            st.balloons()
-        else:
-            msg = f"""Your model failed the test, as its Mean Absolute Error (MAE) reached {mae}, which is over the threshold set at 105% of the MAE obtained after the model was trained for the first time. The original MAE was {original_mae}. It is strongly recommended to retrain your model."""
-        st.info(msg)
-        update_testing_date(model_name)
-
-
-def prepare_data(dataframe: pd.DataFrame, feature_columns: list, target_columns: list):
-    """
-    Retrieves the data in the columns required by the user.
+    The uploaded file is read one chunk at a time, and only the columns used
+    are read, so files of any size can be used.
     """
-    f_headers = feature_columns.split(";")
-    for i in range(len(f_headers)):
-        f_headers[i] = f_headers[i].strip()
 
-    t_headers = target_columns.split(";")
-    for i in range(len(t_headers)):
-        t_headers[i] = t_headers[i].strip()
+    model = model_cache.load_model(model_name)
+
+    feature_names, target_names = get_column_names(feature_columns, target_column)
+    with st.spinner(
+        "The model is predicting values based on the data you uploaded. This might take a few seconds, please do not close this page."
+    ):
+        uploaded_file.seek(0)
+        try:
+            errors = evaluation.evaluate_file(model, uploaded_file, feature_names, target_names)
+        except ValueError:
+            msg_error = "An error occured while retrieving the data from the columns you specified. Make sure you entered the column names properly."
+            st.error(msg_error)
+            return
+        mae = errors.mae
+        original_mae = get_original_metrics(model_name)
+
+    if mae < 1.05 * original_mae:
+        msg = f"""Congratulations, your model {model_name} is doing well!\nYour model reached a Mean Absolute Error (MAE) of {mae}, which is under the threshold set at 105% of the MAE obtained after the model was trained for the first time. The original MAE was {original_mae}."""
+        st.balloons()
+    else:
+        msg = f"""Your model failed the test, as its Mean Absolute Error (MAE) reached {mae}, which is over the threshold set at 105% of the MAE obtained after the model was trained for the first time. The original MAE was {original_mae}. It is strongly recommended to retrain your model."""
+    st.info(msg)
+    st.write(
+        f"Root mean squared error (RMSE): {errors.rmse}. Maximum error: {errors.max_error}. "
+        f"{errors.count} rows were tested at {errors.rows_per_second:.0f} rows per second."
+    )
+    update_testing_date(model_name)
 
-    try:
-        X = dataframe[f_headers]
-        y = dataframe[t_headers]
-    except KeyError:
-        msg_error = "An error occured while retrieving the data from the columns you specified. Make sure you entered the column names properly."
-        st.error(msg_error)
-        return False, False
 
-    return X, y
+def get_column_names(feature_columns: str, target_columns: str) -> tuple:
+    """
+    Returns the lists of feature and target column names entered by the user.
+    """
+    return datasets.parse_column_names(feature_columns), datasets.parse_column_names(target_columns)
 
 
 st.set_page_config(layout="wide")
+app_setup.set_up_process()
 
 left_co, cent_co, last_co = st.columns(3)
 with cent_co:
     st.title("Test the performance of a model")
 
 uploaded_file = st.file_uploader(
-    label="Upload the CSV file that contains your testing data here"
+    label="Upload the CSV, Parquet or Arrow file that contains your testing data here",
+    type=list(datasets.EXTENSIONS),
 )
 
 if uploaded_file:
 
-    df = pd.read_csv(uploaded_file)
-    df = df.loc[:, ~df.columns.str.contains("^Unnamed")]  # Dropping unnamed columns
+    df = dataset_cache.read_preview(uploaded_file, st.session_state)
     with st.expander("Data preview"):
         st.subheader("Your data (preview might be truncated):")
         st.table(df.head(20))
@@ -122,7 +99,7 @@ if uploaded_file:
     model_name = st.text_input(label="Enter the name of the model you want to use")
 
     kwargs = {
-        "dataframe": df,
+        "uploaded_file": uploaded_file,
         "feature_columns": feature_column_names,
         "model_name": model_name,
         "target_column": target_column_name,
@@ -1,15 +1,37 @@
-import pickle
 import os
+import logging
 from datetime import date
+from functools import partial
+from typing import TYPE_CHECKING
 
-import mysql.connector
 import streamlit as st
-import mlflow
-from mlflow.models import infer_signature
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_absolute_error
-from sblearn.models import SymbolicRegressor
+
+import app_setup
+import datasets
+import dataset_cache
+import drift
+import fit_store
+import metrics
+import sampling
+import training_profiles
+import validation
+from lazy_imports import lazy_import
+
+if TYPE_CHECKING:
+    from sblearn.models import SymbolicRegressor
+
+# These modules import mlflow, scikit-learn or sblearn, they are only imported
+# once the user needs them so the page is displayed sooner
+mlflow = lazy_import("mlflow")
+sklearn_metrics = lazy_import("sklearn.metrics")
+model_selection = lazy_import("sklearn.model_selection")
+database = lazy_import("database")
+formula = lazy_import("formula")
+model_cache = lazy_import("model_cache")
+model_metadata = lazy_import("model_metadata")
+monitoring = lazy_import("monitoring")
+training_queue = lazy_import("training_queue")
 
 
 def format_testing_frequency_display(option: str):
@@ -42,7 +64,7 @@ def model_exists(model_name: str) -> bool:
     return False
 
 
-def display_formula(model: SymbolicRegressor, X: pd.DataFrame, y):
+def display_formula(model: "SymbolicRegressor", X: pd.DataFrame, y):
     """
     Displays the formula found by the model.
     """
@@ -71,26 +93,108 @@ def display_formula(model: SymbolicRegressor, X: pd.DataFrame, y):
 
 
 def update_mlflow(
-    model: SymbolicRegressor, model_name: str, X_test, y_test, X_train, y_train
+    model: "SymbolicRegressor", model_name: str, X_test, y_test, X_train, y_train, parent_version: str = None
 ):
     """
-    Updates MLFlow with the newly-trained model.
+    Updates MLFlow with the newly-trained model. Returns a tuple (run ID,
+    registered model version).
+
+    'parent_version' is the version of the model that was retrained, if the
+    search started from its formulas. The candidates of a multi-start search
+    are logged as child runs of the run of the model.
     """
     mlflow.set_experiment(f"/{model_name}")
     with mlflow.start_run():
-        params = model.get_params()
-        y_pred = model.predict(X_test)
-        mae = mean_absolute_error(y_test, y_pred)
+        if parent_version is not None:
+            mlflow.set_tag("parent_version", parent_version)
+            mlflow.log_param("warm_start", getattr(model, "warm_start_", "none"))
+        # Models searched on a sample of the data keep the parameters of the search
+        params = getattr(model, "search_params_", None) or model.get_params()
+        with metrics.span("predict"):
+            y_pred = model.predict(X_test)
+        with metrics.span("mae"):
+            mae = sklearn_metrics.mean_absolute_error(y_test, y_pred)
         mlflow.log_params(params)
-        mlflow.log_metric("mean absolute error", mae)
-        signature = infer_signature(X_train, y_train)
-        model_info = mlflow.sklearn.log_model(
-            sk_model=model,
-            artifact_path=model_name,
-            signature=signature,
-            input_example=X_train,
-            registered_model_name=model_name,
+        mlflow.log_params(
+            {
+                "training_rows": len(X_train),
+                "sample_rows": getattr(model, "sample_rows_", len(X_train)),
+                "sampling_method": getattr(model, "sampling_method_", "none"),
+            }
         )
+        mlflow.log_metric("mean absolute error", mae)
+        candidates = getattr(model, "candidates_", [])
+        if candidates:
+            mlflow.log_param("candidates", len(candidates))
+            log_candidates(candidates)
+        signature = mlflow.models.infer_signature(X_train, y_train)
+        with metrics.span("mlflow_log_model"):
+            model_info = mlflow.sklearn.log_model(
+                sk_model=model,
+                artifact_path=model_name,
+                signature=signature,
+                input_example=X_train,
+                registered_model_name=model_name,
+            )
+        # The compiled formulas let the model be used without unpickling it
+        formulas = formula.compile_model(model, X_train, y_train)
+        mlflow.log_dict(formulas.to_dict(), formula.FORMULAS_ARTIFACT)
+        # The monitoring script compares the test data to these sketches to detect drift
+        with metrics.span("feature_sketches"):
+            mlflow.log_dict(drift.build_sketches(X_train), drift.SKETCHES_ARTIFACT)
+    model_versions = mlflow.MlflowClient().search_model_versions(
+        f"name='{model_name}' and run_id='{model_info.run_id}'"
+    )
+    return model_info.run_id, model_versions[0].version
+
+
+def log_candidates(candidates: list):
+    """
+    Logs each candidate of a multi-start search as a child of the active MLflow run.
+    """
+    for i, candidate in enumerate(candidates):
+        with mlflow.start_run(run_name=f"candidate-{i}", nested=True):
+            mlflow.log_params({"target": candidate["target"], **candidate["params"]})
+            mlflow.set_tag("selected", candidate.get("selected", False))
+            if "error" in candidate:
+                mlflow.set_tag("error", candidate["error"])
+            else:
+                mlflow.set_tag("formula", candidate["formula"])
+                mlflow.log_metric("validation mean absolute error", candidate["validation_mae"])
+
+
+def is_latest_version(model_name: str, version: str) -> bool:
+    """
+    Returns True if 'version' is the latest version of the model referenced by model_name.
+    """
+    if version is None:
+        return False
+    try:
+        return str(model_metadata.get_latest_version(model_name)[0]) == str(version)
+    except Exception:
+        # The model was deleted from MLflow
+        return False
+
+
+def get_warm_start(model_name: str, X: pd.DataFrame, y: pd.DataFrame) -> tuple:
+    """
+    Returns a tuple (formulas, version, baseline MAE) for the latest version of
+    the model, so that retraining can start from its formulas.
+
+    Returns None if the model does not exist yet, or if it was trained on other
+    columns: its formulas would not use the same variables.
+    """
+    try:
+        if not model_exists(model_name):
+            return None
+        metadata = model_metadata.cache.get(model_name)
+        if metadata.feature_names != list(X.columns) or metadata.target_names != list(y.columns):
+            return None
+        formulas = model_cache.load_model(model_name).formulas
+        return list(formulas), metadata.version, monitoring.get_original_metrics(model_name)
+    except Exception:
+        logging.exception(f"Could not retrieve the previous version of model {model_name}")
+        return None
 
 
 def find_formula(
@@ -101,9 +205,29 @@ def find_formula(
     email: str,
     testing_frequency: int,
     overwrite: bool,
+    profile: str = "default",
+    max_rows: int = None,
+    sampling_method: str = sampling.STRATIFIED,
+    warm_start: bool = True,
+    validation_mode: str = validation.STRICT,
 ):
     """
-    Uses the model to find the formula that best fits the data.
+    Uses the model to find the formula that best fits the data. With several
+    target columns, a formula is searched for each target, in parallel, and
+    they are saved as a single model.
+
+    'profile' is the name of the training profile that sets the hyperparameters
+    of the model. If the training data has more than 'max_rows' rows, the
+    formula is searched on a sample drawn with 'sampling_method' (0 uses all
+    the rows, None uses training_profiles.MAX_TRAINING_ROWS). When a model is
+    overwritten and 'warm_start' is True, the search starts from the formulas
+    of its latest version, and stops as soon as they beat its original Mean
+    Absolute Error. The data is checked before the fit is submitted,
+    'validation_mode' deciding what happens to invalid values (see the
+    validation module).
+
+    The fit is submitted to the training queue and runs in the background.
+    Returns the ID of the training job, or None if the data was rejected.
     """
     if not overwrite and model_exists(model_name):
         st.error(
@@ -112,27 +236,148 @@ def find_formula(
         return
 
     X, y = prepare_data(dataframe, feature_columns, target_columns)
-    X_train, X_test, y_train, y_test = train_test_split(
+    if type(X) == bool:
+        return
+    try:
+        X, y, warnings = validation.validate(X, y, validation_mode)
+    except validation.ValidationError as e:
+        st.error(
+            "Your dataset contains some data that cannot be processed:\n"
+            + "\n".join(f"- {issue}" for issue in e.issues)
+        )
+        return
+    for issue in warnings:
+        st.warning(str(issue))
+
+    if max_rows is None:
+        max_rows = training_profiles.MAX_TRAINING_ROWS
+    X_train, X_test, y_train, y_test = model_selection.train_test_split(
         X, y, test_size=0.2, random_state=42
     )
-    if type(X) != bool:
-        model = train_model(X, y, model_name)
-        if not model:
-            st.error("An error occured while training the model.")
-            return
-        display_formula(model, X, y)
-
-        test_every_nth_day = testing_frequency * 7  # Need to convert weeks into days
-        update_mlflow(model, model_name, X_test, y_test, X_train, y_train)
-        update_db(model_name, email, test_every_nth_day)
-
-        # Creating an empty folder in the 'autotest' directory where the
-        # user can put their testing data (if that subfolder does not
-        # already exists)
-        if not os.path.exists("./autotest"):
-            os.mkdir("./autotest")
-        if not os.path.exists(os.path.join("./autotest", model_name)):
-            os.mkdir(os.path.join("./autotest", model_name))
+    test_every_nth_day = testing_frequency * 7  # Need to convert weeks into days
+    initial_formulas = parent_version = baseline_mae = None
+    if overwrite and warm_start:
+        previous = get_warm_start(model_name, X, y)
+        if previous is not None:
+            initial_formulas, parent_version, baseline_mae = previous
+    params = training_profiles.get_profile_params(profile)
+    # An identical request reuses the model found the first time instead of fitting again
+    fit_key = fit_store.get_fingerprint(
+        X_train, y_train, params, max_rows, sampling_method, initial_formulas, baseline_mae
+    )
+    on_complete = partial(
+        complete_training,
+        model_name=model_name,
+        email=email,
+        test_every_nth_day=test_every_nth_day,
+        X_test=X_test,
+        y_test=y_test,
+        X_train=X_train,
+        y_train=y_train,
+        parent_version=parent_version,
+        fit_key=fit_key,
+    )
+    try:
+        job_id = training_queue.queue.submit(
+            X_train,
+            y_train,
+            params,
+            model_name,
+            on_complete,
+            max_rows,
+            sampling_method,
+            initial_formulas,
+            baseline_mae,
+            fit_key,
+        )
+    except training_queue.QueueFullError:
+        st.error("Too many models are being trained at the moment. Please try again in a few minutes.")
+        return
+    st.session_state.setdefault("training_jobs", []).append(job_id)
+    if parent_version is not None:
+        st.info(f"The search starts from the formula of version {parent_version} of your model.")
+    st.info(
+        f"The model is looking for the math formula that best describes your data (job {job_id}). This might take a few minutes, you can follow its progress below."
+    )
+    return job_id
+
+
+def complete_training(
+    model: "SymbolicRegressor",
+    model_name: str,
+    email: str,
+    test_every_nth_day: int,
+    X_test,
+    y_test,
+    X_train,
+    y_train,
+    parent_version: str = None,
+    fit_key: str = None,
+):
+    """
+    Saves the newly-trained model. Runs once the training job is done.
+
+    If the model was stored under 'fit_key' and is already the latest version
+    of this model on MLflow, it is not registered again.
+    """
+    stored_fit = fit_store.store.read(fit_key) if fit_key is not None else None
+    if (
+        stored_fit is not None
+        and stored_fit.get("model_name") == model_name
+        and is_latest_version(model_name, stored_fit.get("version"))
+    ):
+        logging.info(f"Model {model_name} is already registered as version {stored_fit['version']} (run {stored_fit['run_id']})")
+    else:
+        run_id, version = update_mlflow(model, model_name, X_test, y_test, X_train, y_train, parent_version)
+        if fit_key is not None:
+            fit_store.store.update(fit_key, model_name=model_name, run_id=run_id, version=str(version))
+    model_metadata.cache.invalidate(model_name)
+    update_db(model_name, email, test_every_nth_day)
+
+    # Creating an empty folder in the 'autotest' directory where the
+    # user can put their testing data (if that subfolder does not
+    # already exists)
+    if not os.path.exists("./autotest"):
+        os.mkdir("./autotest")
+    if not os.path.exists(os.path.join("./autotest", model_name)):
+        os.mkdir(os.path.join("./autotest", model_name))
+
+
+def display_training_jobs(job_ids: list):
+    """
+    Displays the status of the training jobs submitted during this session.
+    """
+    st.subheader("Your training jobs")
+    st.button("Refresh")
+    for job_id in reversed(job_ids):
+        job = training_queue.queue.get(job_id)
+        if job is None:
+            continue
+        with st.container(border=True):
+            st.write(f"**{job.model_name}** (job {job.id}, submitted at {job.submitted_at:%H:%M:%S}): {job.status}")
+            if job.status in (training_queue.QUEUED, training_queue.RUNNING):
+                st.button(
+                    "Cancel",
+                    key=f"cancel-{job.id}",
+                    on_click=training_queue.queue.cancel,
+                    args=(job.id,),
+                )
+            elif job.status == training_queue.DONE:
+                if job.stored_fit is not None:
+                    st.caption(
+                        "The same data was already trained with the same parameters, the formula found then was reused."
+                    )
+                else:
+                    st.caption(f"The search took {metrics.get_total_seconds(job.metrics, 'training'):.1f} seconds.")
+                if getattr(job.model, "candidates_", None):
+                    st.caption(
+                        f"{len(job.model.candidates_)} candidate formulas were compared, the one with the lowest validation error was kept."
+                    )
+                X = pd.DataFrame(columns=job.feature_names)
+                y = pd.DataFrame(columns=job.target_names)
+                display_formula(job.model, X, y)
+            elif job.status == training_queue.FAILED:
+                st.error(get_training_error_message(job.error))
 
 
 def update_db(model_name: str, email: str, test_every_nth_day: int):
@@ -140,42 +385,27 @@ def update_db(model_name: str, email: str, test_every_nth_day: int):
     Updates the database that contains the list of models with their associated email and testing frequence information.
     """
 
-    # MYSQL username and password need to be set as environment variables
     # PENSER À AJOUTER UNE GESTION DES ERREURS !!!
-    with mysql.connector.connect(
-        host="localhost",
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database=os.environ["MYSQL_DB_NAME"],
-    ) as db:
-        with db.cursor() as c:
-            today = date.today()
-            query = f"""INSERT INTO Models (name, email, test_every_nth_day, last_testing_date) VALUES("{model_name}", "{email}", {test_every_nth_day}, "{today.strftime('%Y-%m-%d')}")\
-                ON DUPLICATE KEY UPDATE email="{email}",  test_every_nth_day={test_every_nth_day}, last_testing_date="{today.strftime('%Y-%m-%d')}" """
-            c.execute(query)
-            db.commit()
+    database.get_database().save_model(model_name, email, test_every_nth_day, date.today())
 
 
+@metrics.span("prepare_data")
 def prepare_data(dataframe: pd.DataFrame, feature_columns: str, target_columns: str):
     """
     Retrieves the data in the columns required by the user.
     """
-    f_headers = feature_columns.split(";")
-    for i in range(len(f_headers)):
-        f_headers[i] = f_headers[i].strip()
+    f_headers = datasets.parse_column_names(feature_columns)
+    t_headers = datasets.parse_column_names(target_columns)
 
-    t_headers = target_columns.split(";")
-    for i in range(len(t_headers)):
-        t_headers[i] = t_headers[i].strip()
-
-    try:
-        X = dataframe[f_headers]
-        y = dataframe[t_headers]
-    except KeyError:
+    issues = validation.check_columns(dataframe.columns, f_headers, t_headers)
+    if issues:
         msg_error = "An error occured while retrieving the data from the columns you specified. Make sure you entered the column names properly."
-        st.error(msg_error)
+        st.error(msg_error + "\n" + "\n".join(f"- {issue}" for issue in issues))
         return False, False
 
+    X = dataframe[f_headers]
+    y = dataframe[t_headers]
+
     return X, y
 
 
@@ -192,43 +422,27 @@ def convert_str_to_latex(formula: str) -> str:
     return latex_formula
 
 
-def train_model(X, y, model_name):
+def get_training_error_message(error: Exception) -> str:
     """
-    Trains the model with the data provided by the user.
+    Returns the message displayed to the user when a training job failed.
     """
+    if isinstance(error, (ValueError, TypeError)):
+        # Issues with non-numerical or nan values
+        return "Your dataset contains some data that cannot be processed. Please ensure it contains only numerical values and make sure no value is missing."
+    return "An error occured while training the model."
 
-    left_co, cent_co, last_co = st.columns(3)
-    with cent_co:
-        with st.spinner(
-            "The model is looking for the math formula that best describes your data. This might take a few minutes, do not close this page"
-        ):
-            try:
-                model.fit(X, y)
-                st.balloons()
-
-            except ValueError:
-                # Is there more than one target?
-                print(y.shape)
-                if len(y.shape) != 1 and y.shape[1] != 1 :
-                    msg_error = "Mathfinder can only work with one target value at a time. Please spcecify only one target column."
-                else:
-                    msg_error = "Your dataset contains some data that cannot be processed. Please ensure it contains only numerical values and make sure no value is missing."
-                st.error(msg_error)
-                return False
 
-            except TypeError:
-                # Issues with nan values
-                msg_error = "Your dataset contains some data that cannot be processed. Please ensure it contains only numerical values and make sure no value is missing."
-                st.error(msg_error)
-                return False
-
-        return model
+@st.cache_data(ttl=60)
+def get_profile_names() -> list:
+    """
+    Returns the names of the training profiles, which are read again every minute at most.
+    """
+    return list(training_profiles.load_profiles())
 
 
-# Setting up the model and MLFlow
-model = SymbolicRegressor()
-mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
+# Setting up MLFlow
 st.set_page_config(layout="wide")
+app_setup.set_up_process()
 
 
 # Setting up the web page
@@ -237,21 +451,24 @@ with cent_co:
     st.title("Mathfinder - Discover the math behind your data!")
 
 uploaded_file = st.file_uploader(
-    label="Upload the CSV file that contains your data here"
+    label="Upload the CSV, Parquet or Arrow file that contains your data here",
+    type=list(datasets.EXTENSIONS),
 )
 
 
 if uploaded_file:
 
-    df = pd.read_csv(uploaded_file)
-    df = df.loc[:, ~df.columns.str.contains("^Unnamed")]  # Dropping unnamed columns
+    # The file is only parsed again if its content changes, not on every rerun of the page
+    df = dataset_cache.read_upload(uploaded_file, st.session_state)
     with st.expander("Data preview"):
         st.subheader("Your data (preview might be truncated):")
         st.table(df.head(20))
     feature_column_names = st.text_input(
         label="Enter the names of the features columns, separated by semi-columns (;)"
     )
-    target_column_names = st.text_input(label="Enter the name of the target column")
+    target_column_names = st.text_input(
+        label="Enter the names of the target columns, separated by semi-columns (;). A formula is searched for each of them"
+    )
     model_name = st.text_input(label="Enter the name you want to give to your model")
     email = st.text_input(label="Enter your email address")
     testing_frequency = st.selectbox(
@@ -259,7 +476,31 @@ if uploaded_file:
         (1, 4, 12, 24),
         format_func=format_testing_frequency_display,
     )
+    profile = st.selectbox(
+        "Training profile (a more thorough search takes longer but might find a better formula, a multi-start search compares several searches run in parallel)",
+        get_profile_names(),
+        index=get_profile_names().index("default"),
+    )
+    max_rows = st.number_input(
+        "Maximum number of rows used to search the formula (larger datasets are sampled, 0 uses all rows)",
+        min_value=0,
+        value=training_profiles.MAX_TRAINING_ROWS,
+        step=1000,
+    )
+    sampling_method = st.selectbox(
+        "Sampling method (stratified keeps the distribution of the target, coreset favours rare values)",
+        sampling.METHODS,
+    )
+    validation_mode = st.selectbox(
+        "Invalid values (strict rejects the dataset, coerce drops the rows that contain them, impute replaces them by the median of their feature)",
+        validation.MODES,
+    )
     overwrite = st.checkbox("Overwrite model")
+    warm_start = st.checkbox(
+        "Start from the formula of the current version when overwriting the model (faster retraining)",
+        value=True,
+        disabled=not overwrite,
+    )
     kwargs = {
         "dataframe": df,
         "feature_columns": feature_column_names,
@@ -268,5 +509,13 @@ if uploaded_file:
         "email": email,
         "testing_frequency": testing_frequency,
         "overwrite": overwrite,
+        "profile": profile,
+        "max_rows": max_rows,
+        "sampling_method": sampling_method,
+        "warm_start": warm_start,
+        "validation_mode": validation_mode,
     }
     st.button(label="Train the model", on_click=find_formula, kwargs=kwargs)
+
+if st.session_state.get("training_jobs"):
+    display_training_jobs(st.session_state["training_jobs"])
@@ -0,0 +1,29 @@
+"""
+Checks the directories where Mathfinder writes files that other users of the
+machine must not be able to modify, e.g. pickles or cached datasets.
+"""
+import os
+
+
+def is_private(directory: str) -> bool:
+    """
+    Returns True if 'directory' belongs to the user running Mathfinder and
+    nobody else can write to it, so its files can be trusted.
+    """
+    try:
+        stat = os.stat(directory)
+    except FileNotFoundError:
+        return False
+    if hasattr(os, "getuid") and stat.st_uid != os.getuid():
+        return False
+    return not stat.st_mode & 0o022
+
+
+def make_private(directory: str) -> bool:
+    """
+    Creates 'directory' with permissions that only let the user running
+    Mathfinder access it, if it does not exist yet. Returns True if the
+    directory is private.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return is_private(directory)
@@ -0,0 +1,183 @@
+"""
+Delivers the reports of the monitoring script by email.
+
+Reports are queued while the models are tested, and grouped into a single
+digest for each email address. The digests are sent by a background thread
+over one SMTP connection, which is opened and authenticated once and reused
+for every message. Failed deliveries are retried with an exponential backoff.
+
+The SMTP server is set with the following environment variables:
+- SMTP_SERVER: address of the server
+- SMTP_PORT: port of the server (465 by default)
+- SMTP_SSL: set it to 0 to connect without SSL
+- SMTP_LOGIN and SMTP_PWD: credentials, no authentication is made without them
+- SMTP_SENDER: address the reports are sent from (SMTP_LOGIN by default)
+"""
+import os
+import time
+import queue
+import logging
+import smtplib
+import threading
+from email.mime.text import MIMEText
+
+import metrics
+
+
+# Number of attempts made to send a digest before giving up
+MAX_ATTEMPTS = 5
+# Delay before the first retry, in seconds. It doubles after each attempt.
+RETRY_DELAY = 2.0
+
+
+def smtp_connect() -> smtplib.SMTP:
+    """
+    Opens an authenticated connection to the SMTP server set in the environment.
+    """
+    server = os.environ["SMTP_SERVER"]
+    port = int(os.environ.get("SMTP_PORT", 465))
+    if os.environ.get("SMTP_SSL", "1") == "0":
+        connection = smtplib.SMTP(server, port)
+    else:
+        connection = smtplib.SMTP_SSL(server, port)
+    if os.environ.get("SMTP_LOGIN"):
+        connection.login(os.environ["SMTP_LOGIN"], os.environ["SMTP_PWD"])
+    return connection
+
+
+def build_digest(sender: str, email: str, results: list) -> MIMEText:
+    """
+    Builds the message that gathers the reports of all the models of a user.
+
+    'results' holds the results of monitoring.check_model for these models.
+    """
+    if len(results) == 1:
+        subject = results[0]["title"]
+        body = results[0]["report"]
+    else:
+        subject = f"Mathfinder tested {len(results)} of your models"
+        body = ""
+        for result in results:
+            heading = f"{result['model_name']}: {result['title']}"
+            body += f"{heading}\n{'=' * len(heading)}\n{result['report']}\n\n"
+
+    message = MIMEText(body)
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = email
+    return message
+
+
+class ReportSender:
+    """
+    Queues the reports of the tested models and delivers them in the background.
+
+    'connect' returns an authenticated SMTP connection, which is reused until
+    it fails.
+    """
+
+    def __init__(
+        self,
+        connect=smtp_connect,
+        sender: str = None,
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_delay: float = RETRY_DELAY,
+    ):
+        self._connect = connect
+        self.sender = sender or os.environ.get("SMTP_SENDER") or os.environ.get("SMTP_LOGIN", "")
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self._reports = {}
+        self._queue = queue.Queue()
+        self._connection = None
+        self._thread = None
+
+    def add(self, result: dict):
+        """
+        Queues the report of a tested model, given as returned by monitoring.check_model.
+        """
+        if not result["tested"]:
+            return
+        self._reports.setdefault(result["email"], []).append(result)
+
+    def flush(self):
+        """
+        Hands the digests of the queued reports over to the delivery thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._deliver, daemon=True)
+            self._thread.start()
+        for email, results in self._reports.items():
+            self._queue.put(build_digest(self.sender, email, results))
+        self._reports = {}
+
+    def close(self):
+        """
+        Sends the remaining reports and waits until every digest was delivered.
+        """
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        logging.info(f"{self.sent} report(s) sent, {self.failed} could not be sent")
+
+    def _deliver(self):
+        """
+        Sends the digests of the queue until None is received. Runs in the delivery thread.
+        """
+        try:
+            while True:
+                message = self._queue.get()
+                if message is None:
+                    return
+                try:
+                    with metrics.span("email_send"):
+                        delivered = self._send(message)
+                except Exception:
+                    logging.exception(f"An unexpected error occured while sending the report to {message['To']}")
+                    delivered = False
+                if delivered:
+                    self.sent += 1
+                    metrics.increment("reports_sent")
+                else:
+                    self.failed += 1
+                    metrics.increment("reports_failed")
+        finally:
+            self._disconnect()
+
+    def _send(self, message: MIMEText) -> bool:
+        """
+        Sends a message, reconnecting and retrying after a failure.
+
+        Returns False if the message could not be sent.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                if self._connection is None:
+                    self._connection = self._connect()
+                self._connection.sendmail(self.sender, [message["To"]], message.as_string())
+                logging.info(f"Report sent to {message['To']}")
+                return True
+            except smtplib.SMTPRecipientsRefused:
+                logging.exception(f"The address {message['To']} was refused by the SMTP server")
+                return False
+            except (smtplib.SMTPException, OSError):
+                logging.warning(
+                    f"Could not send the report to {message['To']} (attempt {attempt + 1}/{self.max_attempts})",
+                    exc_info=True,
+                )
+                self._disconnect()
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self.retry_delay * 2**attempt)
+        return False
+
+    def _disconnect(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._connection = None
@@ -0,0 +1,96 @@
+"""
+Draws the samples of the training data used to search the formulas.
+
+The cost of the symbolic regression grows with the number of rows, so large
+datasets are searched on a sample whose size is set by the user. Two methods
+are available:
+- 'stratified' keeps the distribution of the target, by drawing the same
+  proportion of rows from each of its quantiles
+- 'coreset' favours the rows that are far away from the bulk of the data
+  (a lightweight coreset), so rare values are more likely to be kept
+"""
+import numpy as np
+import pandas as pd
+
+
+STRATIFIED = "stratified"
+CORESET = "coreset"
+METHODS = (STRATIFIED, CORESET)
+
+# Number of quantiles of the target used by the stratified sampling
+STRATA_COUNT = 10
+
+
+def stratified_indices(y, n_rows: int, random_state: int = None) -> np.ndarray:
+    """
+    Returns the indices of n_rows rows drawn with the same proportion in each
+    quantile of the target y (the first target if there are several).
+    """
+    rng = np.random.default_rng(random_state)
+    target = np.asarray(y, dtype="float64")
+    if target.ndim > 1:
+        target = target[:, 0]
+
+    edges = np.unique(np.nanquantile(target, np.linspace(0, 1, STRATA_COUNT + 1)))
+    strata = np.searchsorted(edges[1:-1], target, side="right")
+    counts = np.bincount(strata)
+
+    # Each stratum gets its share of the sample, the rows left over by the
+    # rounding go to the strata with the largest remainders
+    shares = counts * n_rows / len(target)
+    allocation = np.floor(shares).astype(int)
+    leftover = n_rows - allocation.sum()
+    allocation[np.argsort(allocation - shares)[:leftover]] += 1
+
+    # Shuffling the rows, then grouping them by stratum, gives a random
+    # selection of rows at the start of each group
+    order = rng.permutation(len(target))
+    order = order[np.argsort(strata[order], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    indices = [order[start:start + size] for start, size in zip(starts, allocation)]
+    return np.sort(np.concatenate(indices))
+
+
+def coreset_indices(X, y, n_rows: int, random_state: int = None) -> np.ndarray:
+    """
+    Returns the indices of n_rows rows drawn with a probability that grows
+    with their distance to the mean of the data.
+
+    Half of the probability is spread uniformly, so that dense regions are
+    still represented.
+    """
+    rng = np.random.default_rng(random_state)
+    data = np.column_stack([np.asarray(X, dtype="float64"), np.asarray(y, dtype="float64")])
+    std = data.std(axis=0)
+    std[std == 0] = 1
+    distances = (((data - data.mean(axis=0)) / std) ** 2).sum(axis=1)
+    total = distances.sum()
+    probabilities = np.full(len(data), 1 / len(data))
+    if total > 0 and np.isfinite(total):
+        probabilities = 0.5 * probabilities + 0.5 * distances / total
+
+    # Weighted sampling without replacement (Efraimidis and Spirakis): the
+    # rows with the largest random keys are kept
+    with np.errstate(divide="ignore"):
+        keys = np.log(rng.random(len(data))) / probabilities
+    return np.sort(np.argpartition(keys, -n_rows)[-n_rows:])
+
+
+def sample_rows(X, y, n_rows: int, method: str = STRATIFIED, random_state: int = None) -> tuple:
+    """
+    Returns a tuple (X, y) with a sample of n_rows rows drawn with the given method.
+
+    The data is returned as-is if it does not have more than n_rows rows.
+    """
+    if len(X) <= n_rows:
+        return X, y
+    if method == STRATIFIED:
+        indices = stratified_indices(y, n_rows, random_state)
+    elif method == CORESET:
+        indices = coreset_indices(X, y, n_rows, random_state)
+    else:
+        raise ValueError(f"Unknown sampling method '{method}'.")
+
+    if isinstance(X, (pd.DataFrame, pd.Series)):
+        return X.iloc[indices], y.iloc[indices]
+    return np.asarray(X)[indices], np.asarray(y)[indices]
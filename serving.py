@@ -0,0 +1,269 @@
+"""
+Serves the predictions of the trained models over HTTP.
+
+This script runs alongside the Streamlit app, for the services that need to
+score a few rows at a time. Send a POST request to /predict/<model name> with
+a JSON body such as:
+
+    {"rows": [{"Price": 12, "Temperature": 4.5}, {"Price": 15, "Temperature": 6}]}
+
+or {"columns": ["Price", "Temperature"], "data": [[12, 4.5], [15, 6]]}. The
+feature columns are those of the model's signature, unless they are given in
+"features" (a list, or names separated by semicolons as on the predict page).
+The features given are matched by position with those of the signature.
+The response contains the predictions, in the same order as the rows.
+
+Models are loaded once and kept in memory by the model cache. Concurrent
+requests for the same model are gathered into micro-batches of at most
+MAX_BATCH_SIZE rows, waiting at most MAX_WAIT_MS milliseconds for other
+requests, so that the model is called once for the whole batch.
+"""
+import os
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from urllib.parse import unquote
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mlflow
+import numpy as np
+import pandas as pd
+
+import datasets
+import metrics
+import model_cache
+import model_metadata
+
+
+# Maximum number of rows predicted at once
+MAX_BATCH_SIZE = int(os.environ.get("SERVING_MAX_BATCH_SIZE", 1024))
+# Maximum time a request waits for other requests to join its batch
+MAX_WAIT_MS = float(os.environ.get("SERVING_MAX_WAIT_MS", 5))
+
+
+class MicroBatcher:
+    """
+    Gathers the rows submitted by concurrent requests, and predicts them with
+    a single call to 'predict'.
+
+    A batch is predicted as soon as it holds 'max_batch_size' rows, or
+    'max_wait' seconds after its first request arrived.
+    """
+
+    def __init__(self, predict, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT_MS / 1000):
+        self._predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Returns the predictions for the rows of X, once its batch was predicted.
+        """
+        future = Future()
+        self._requests.put((X, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            rows = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            self._predict_batch(batch)
+
+    def _predict_batch(self, batch: list):
+        """
+        Predicts all the rows of a batch, then gives each request its predictions.
+        """
+        self.batches += 1
+        try:
+            X = pd.concat([X for X, _ in batch], ignore_index=True)
+            with metrics.span("predict"):
+                y_pred = np.reshape(np.asarray(self._predict(X)), (len(X), -1))
+            metrics.increment("rows_processed", len(X), stage="serving")
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One of the requests might be invalid, they are predicted separately
+            # so that it does not make the others fail
+            for request in batch:
+                self._predict_batch([request])
+            return
+
+        start = 0
+        for X, future in batch:
+            future.set_result(y_pred[start:start + len(X)])
+            start += len(X)
+
+
+def parse_rows(body: dict) -> pd.DataFrame:
+    """
+    Returns the rows sent in the body of a request.
+    """
+    if "rows" in body:
+        return pd.DataFrame(body["rows"])
+    if "data" in body:
+        return pd.DataFrame(body["data"], columns=body.get("columns"))
+    raise ValueError("The body of the request must contain 'rows', or 'columns' and 'data'.")
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    An HTTP server that predicts with the models of the model cache.
+
+    Each model has its own MicroBatcher, which receives the feature columns
+    under the names of the model's signature.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT_MS / 1000):
+        super().__init__(address, PredictionHandler)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def get_batcher(self, model_name: str) -> MicroBatcher:
+        with self._lock:
+            if model_name not in self._batchers:
+                # The model is retrieved for every batch. load_model checks its last version in
+                # the registry at most every few seconds, so a new version is used soon after it
+                # is registered, without a request to the registry for every batch
+                predict = lambda X: model_cache.load_model(model_name).predict(X)
+                self._batchers[model_name] = MicroBatcher(predict, self.max_batch_size, self.max_wait)
+            return self._batchers[model_name]
+
+    def predict(self, model_name: str, body: dict) -> dict:
+        """
+        Returns the response to a prediction request for the model referenced by model_name.
+        """
+        metadata = model_metadata.cache.get(model_name)
+        features = body.get("features") or metadata.feature_names
+        if isinstance(features, str):
+            features = datasets.parse_column_names(features)
+        if len(features) != len(metadata.feature_names):
+            raise ValueError(f"The model uses {len(metadata.feature_names)} features, {len(features)} were given.")
+        X = parse_rows(body)[features]
+        # The rows of every request of a batch must have the same columns
+        X.columns = metadata.feature_names
+        y_pred = self.get_batcher(model_name).submit(X)
+        if y_pred.shape[1] == 1:
+            y_pred = y_pred[:, 0]
+        return {"model": model_name, "version": metadata.version, "predictions": y_pred.tolist()}
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests sent to the PredictionServer.
+    """
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            body = metrics.registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._respond(404, {"error": "Not found."})
+
+    def do_POST(self):
+        prefix = "/predict/"
+        if not self.path.startswith(prefix):
+            self._respond(404, {"error": "Not found."})
+            return
+        model_name = unquote(self.path[len(prefix):])
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._respond(400, {"error": "The body of the request must be valid JSON."})
+            return
+        if not isinstance(body, dict):
+            self._respond(400, {"error": "The body of the request must be a JSON object."})
+            return
+        try:
+            model_metadata.cache.get(model_name)
+        except Exception:
+            self._respond(404, {"error": f"The model {model_name} does not exist."})
+            return
+
+        try:
+            response = self.server.predict(model_name, body)
+        except KeyError as e:
+            self._respond(400, {"error": f"Missing columns: {e}."})
+        except (ValueError, TypeError) as e:
+            self._respond(400, {"error": str(e)})
+        except Exception:
+            logging.exception(f"An error occured while predicting with model {model_name}")
+            self._respond(500, {"error": "An error occured while making the predictions."})
+        else:
+            self._respond(200, response)
+
+    def _respond(self, status: int, content: dict):
+        metrics.increment("http_requests", status=status)
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serves the predictions of the models trained with Mathfinder.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the server listens on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port the server listens on.")
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=MAX_BATCH_SIZE,
+        help="Maximum number of rows predicted at once.",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=MAX_WAIT_MS,
+        help="Maximum time a request waits for others to join its batch, in milliseconds.",
+    )
+    parser.add_argument("--models", nargs="*", default=[], help="Models loaded when the server starts.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s : %(message)s")
+    mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
+
+    # Loading the models in advance, so that the first requests are not slower
+    for model_name in args.models:
+        model_cache.load_model(model_name)
+        logging.info(f"Loaded model {model_name}")
+
+    server = PredictionServer((args.host, args.port), args.max_batch_size, args.max_wait_ms / 1000)
+    logging.info(f"Serving predictions on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -1,12 +1,46 @@
 """
-Unit tests written before fixing the bugs reported by issues #1, 2, 3, 4
+Unit tests for Mathfinder.
+
+The first tests were written before fixing the bugs reported by issues #1, 2, 3, 4.
 """
 
+import io
+import os
+import json
+import multiprocessing
+import urllib.request
+import urllib.error
+import socketserver
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
 import pytest
+import numpy as np
 import pandas as pd
 import mlflow
+from sklearn.metrics import mean_absolute_error
+from sblearn.models import SymbolicRegressor
 
-from pages import train
+import autotest
+import benchmark
+import database
+import dataset_cache
+import datasets
+import drift
+import evaluation
+import fit_store
+import formula
+import metrics
+import model_cache
+import model_metadata
+import monitoring
+import reports
+import sampling
+import serving
+import training_queue
+import validation
+from pages import predict, train
 
 mlflow.set_tracking_uri(uri="http://127.0.0.1:8080")
 
@@ -59,7 +93,7 @@ def test_column_names_splitting(dummy_data):
     """
     features = "Temperature; Price"  # Notice the extra white space
     targets = "Sales"
-    train.find_formula(
+    job_id = train.find_formula(
         dummy_data,
         features,
         targets,
@@ -68,6 +102,8 @@ def test_column_names_splitting(dummy_data):
         testing_frequency=0,
         overwrite=True,
     )
+    job = training_queue.queue.wait(job_id)
+    assert job.status == training_queue.DONE, job.error
 
 
 def test_nan_handling(dummy_data_with_nan):
@@ -78,7 +114,7 @@ def test_nan_handling(dummy_data_with_nan):
     """
     features = "Temperature;Price"
     targets = "Sales"
-    train.find_formula(
+    job_id = train.find_formula(
         dummy_data_with_nan,
         features,
         targets,
@@ -87,6 +123,8 @@ def test_nan_handling(dummy_data_with_nan):
         testing_frequency=0,
         overwrite=True,
     )
+    if job_id:
+        training_queue.queue.wait(job_id)
 
 
 def test_invalid_column_name_handling(dummy_data):
@@ -106,3 +144,986 @@ def test_invalid_column_name_handling(dummy_data):
         testing_frequency=0,
         overwrite=True,
     )
+
+
+def test_data_validation(dummy_data, dummy_data_with_nan):
+    """
+    Checks that invalid training data is reported before any fit, and that the
+    coerce and impute modes clean it instead.
+    """
+    X, y = dummy_data_with_nan[["Temperature", "Price"]], dummy_data_with_nan[["Sales"]]
+    with pytest.raises(validation.ValidationError) as e:
+        validation.validate(X, y)
+    assert [(issue.column, issue.rows) for issue in e.value.issues] == [("Sales", 2)]
+    assert train.find_formula(
+        dummy_data_with_nan, "Temperature;Price", "Sales", "test_validation_model", "test@test.com", 0, overwrite=True
+    ) is None
+
+    X_clean, y_clean, warnings = validation.validate(X, y, validation.COERCE)
+    assert len(X_clean) == len(y_clean) == 6
+    assert y_clean["Sales"].dtype == "float64"
+    assert warnings
+
+    data = dummy_data.assign(Price=dummy_data["Price"].astype(object), Constant=1)
+    data.loc[0, "Price"] = "twelve"
+    X, y = data[["Price", "Constant"]], data[["Sales"]]
+    with pytest.raises(validation.ValidationError, match="twelve"):
+        validation.validate(X, y)
+    X_clean, _, warnings = validation.validate(X, y, validation.IMPUTE)
+    assert X_clean["Price"].iloc[0] == np.median(dummy_data["Price"].iloc[1:])
+    assert any(issue.column == "Constant" for issue in warnings)
+    with pytest.raises(validation.ValidationError, match="single value"):
+        validation.validate(X, data[["Constant"]], validation.IMPUTE)
+
+    # The data of the caller is not modified when invalid values are replaced
+    X = pd.DataFrame({"a": [1.0, np.nan, 3.0, 4.0, 5.0, 6.0]})
+    X_clean, _, _ = validation.validate(X, pd.DataFrame({"b": np.arange(6.0)}), validation.IMPUTE)
+    assert X_clean["a"].iloc[1] == 4.0 and np.isnan(X["a"].iloc[1])
+
+    # Valid numerical data is used as it is
+    X, y = dummy_data[["Temperature"]], dummy_data[["Sales"]]
+    X_checked, y_checked, warnings = validation.validate(X, y)
+    assert X_checked is X and y_checked is y and not warnings
+
+    issues = validation.check_columns(dummy_data.columns, ["Price", "Date"], ["Price"])
+    assert len(issues) == 2
+
+
+def test_model_cache_eviction(monkeypatch):
+    """
+    Checks that the model cache reuses loaded models, replaces stale versions
+    and evicts the least recently used models when it is full.
+    """
+    monkeypatch.setattr(model_cache, "get_model_size", lambda path: 10)
+    cache = model_cache.ModelCache(max_size=20, loader=lambda path: object())
+
+    first = cache.get("a", "1", "path_a_1")
+    assert cache.get("a", "1", "path_a_1") is first
+    assert cache.get("a", "2", "path_a_2") is not first  # Retrained model
+    cache.get("b", "1", "path_b_1")
+    cache.get("c", "1", "path_c_1")  # Evicts model 'a'
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 4
+    assert stats["evictions"] == 2
+    assert stats["models"] == 2
+
+    # The last version is only checked again once VERSION_CHECK_SECONDS have
+    # passed, and the cached model is used while the registry is unreachable
+    versions = []
+
+    def get_latest_version(model_name):
+        versions.append(model_name)
+        if len(versions) > 1:
+            raise ConnectionError()
+        return "1", "path_a_1"
+
+    monkeypatch.setattr(model_cache, "cache", model_cache.ModelCache(loader=lambda path: path))
+    monkeypatch.setattr(model_metadata, "get_latest_version", get_latest_version)
+    assert model_cache.load_model("a") == model_cache.load_model("a") == "path_a_1"
+    assert len(versions) == 1
+    monkeypatch.setattr(model_cache, "VERSION_CHECK_SECONDS", 0)
+    assert model_cache.load_model("a") == "path_a_1"
+    assert len(versions) == 2
+    with pytest.raises(ConnectionError):
+        model_cache.load_model("b")
+
+
+def test_metadata_cache(monkeypatch):
+    """
+    Checks that the metadata of a model are retrieved from MLflow once, until
+    they expire or the model is retrained.
+    """
+    requests = []
+
+    def get_latest_version(model_name):
+        requests.append(model_name)
+        return str(len(requests)), f"mlartifacts/0/run/artifacts/{model_name}"
+
+    monkeypatch.setattr(model_metadata, "get_latest_version", get_latest_version)
+    monkeypatch.setattr(model_metadata, "get_signature_names", lambda source: (["x"], ["y"]))
+    monkeypatch.setattr(model_metadata, "get_original_mae", lambda model_name: 0.5)
+    cache = model_metadata.MetadataCache(ttl=60)
+
+    metadata = cache.get("a")
+    assert cache.get("a") is metadata
+    assert metadata.local_path == "mlartifacts/0/run/artifacts/a"
+    assert (metadata.feature_names, metadata.target_names, metadata.original_mae) == (["x"], ["y"], 0.5)
+    cache.invalidate("a")  # Retrained model
+    assert cache.get("a").version == "2"
+
+    cache.ttl = 0
+    assert cache.get("a").version == "3"
+    assert requests == ["a", "a", "a"]
+
+    other_cache = model_metadata.MetadataCache(ttl=60)
+    other_cache.load(cache.export())
+    assert other_cache.get("a").version == "3"
+
+    # Loading a model checks its last version, so a model retrained by another
+    # process is used before its cached metadata expire
+    monkeypatch.setattr(model_metadata, "cache", other_cache)
+    monkeypatch.setattr(model_cache, "cache", model_cache.ModelCache(loader=lambda path: path))
+    assert model_cache.load_model("a") == "mlartifacts/0/run/artifacts/a"
+    assert model_cache.cache.get("a", "4", "unused") == "mlartifacts/0/run/artifacts/a"
+    assert "a" not in other_cache.export()
+
+
+def test_compiled_formula_parity(dummy_data):
+    """
+    Checks that the compiled formulas give the same predictions as the model.
+    """
+    X = dummy_data[["Temperature", "Price"]]
+    y = dummy_data[["Sales"]]
+    model = SymbolicRegressor(population_size=500, n_iter=5, random_state=42, n_jobs=1)
+    model.fit(X, y)
+
+    compiled = formula.compile_model(model, X, y)
+    np.testing.assert_allclose(compiled.predict(X), model.predict(X), rtol=1e-4)
+    # Columns are matched by name, like MLflow does with the model signature
+    np.testing.assert_allclose(compiled.predict(X[["Price", "Temperature"]]), model.predict(X), rtol=1e-4)
+
+
+def test_formula_parsing():
+    """
+    Checks that only arithmetic expressions are accepted as formulas.
+    """
+    compiled = formula.CompiledFormulas(["y0 = 2*x0 + x1**2 - 1/x0", "y1 = 3"])
+    X = np.array([[1.0, 2.0], [2.0, 3.0]])
+    np.testing.assert_allclose(compiled.predict(X), [[5.0, 3.0], [12.5, 3.0]])
+    with pytest.raises(ValueError):
+        formula.CompiledFormulas(["y0 = __import__('os').getcwd()"])
+
+
+def test_training_queue_policy(dummy_data):
+    """
+    Checks that fits are rejected once all the workers are busy and the queue is full.
+    """
+    queue = training_queue.TrainingQueue(max_workers=1, max_queued_jobs=0)
+    X = dummy_data[["Temperature"]]
+    y = dummy_data[["Sales"]]
+    params = {"population_size": 100, "n_iter": 2, "n_jobs": 1}
+
+    job_id = queue.submit(X, y, params, "test_training_queue_policy_model")
+    with pytest.raises(training_queue.QueueFullError):
+        queue.submit(X, y, params, "test_training_queue_policy_model")
+
+    job = queue.wait(job_id)
+    assert job.status == training_queue.DONE
+    assert job.model.formulas
+
+
+def test_training_completion(tmp_path, monkeypatch):
+    """
+    Checks that jobs finishing at the same time save their models to MLflow
+    without mixing up their experiments and runs.
+    """
+    queue = training_queue.TrainingQueue(max_workers=2, max_queued_jobs=2)
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 100)})
+    params = {"population_size": 100, "n_iter": 2, "n_jobs": 1}
+    saved = {}
+
+    def save(model, model_name, y):
+        saved[model_name] = train.update_mlflow(model, model_name, X, y, X, y)
+
+    monkeypatch.chdir(tmp_path)
+    tracking_uri = mlflow.get_tracking_uri()
+    mlflow.set_tracking_uri(f"file:{tmp_path / 'mlruns'}")
+    try:
+        job_ids = []
+        for i in range(4):
+            y = pd.DataFrame({"b": (i + 1) * X["a"]})
+            on_complete = lambda model, model_name=f"race_{i}", y=y: save(model, model_name, y)
+            job_ids.append(queue.submit(X, y, dict(params, random_state=i), f"race_{i}", on_complete))
+        for job_id in job_ids:
+            assert queue.wait(job_id, timeout=120).status == training_queue.DONE
+
+        client = mlflow.MlflowClient()
+        for i in range(4):
+            run_id, version = saved[f"race_{i}"]
+            run = client.get_run(run_id)
+            assert client.get_experiment(run.info.experiment_id).name == f"/race_{i}"
+            assert run.data.params["random_state"] == str(i)
+            assert client.get_model_version(f"race_{i}", version).run_id == run_id
+    finally:
+        mlflow.set_tracking_uri(tracking_uri)
+
+
+def test_multi_target_training():
+    """
+    Checks that a formula is searched for each target column, and that they are
+    combined into a single model that predicts every target.
+    """
+    queue = training_queue.TrainingQueue(max_workers=2, max_queued_jobs=0)
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 200), "b": rng.uniform(1, 10, 200)})
+    y = pd.DataFrame({"c": 2 * X["a"], "d": X["b"] + 3})
+    params = {"population_size": 200, "n_iter": 3, "n_jobs": 1, "random_state": 42}
+
+    job = queue.wait(queue.submit(X, y, params, "test_multi_target_training_model"), timeout=120)
+    assert job.status == training_queue.DONE, job.error
+    assert [f.split("=")[0].strip() for f in job.model.formulas] == ["y0", "y1"]
+    assert job.model.predict(X).shape == (200, 2)
+    assert job.model.search_params_["population_size"] == params["population_size"]
+
+    # The formulas are those found by fitting each target on its own
+    for i, target_name in enumerate(y.columns):
+        model = training_queue.fit_model(X, y[[target_name]], params)
+        assert np.allclose(job.model.predict(X)[:, i], model.predict(X))
+
+
+def test_multi_target_predictions():
+    """
+    Checks that the predict page writes a column for each target of a model
+    that predicts several targets.
+    """
+    chunk = pd.DataFrame({"a": [1.0, 2.0], "b": [3.0, 4.0]})
+    model = formula.CompiledFormulas(["y0 = 2*x0", "y1 = x0 + x1"])
+    predict.add_predictions(chunk, model.predict(chunk[["a", "b"]]), ["c", "d"])
+    assert chunk["predictions_c"].tolist() == [2.0, 4.0]
+    assert chunk["predictions_d"].tolist() == [4.0, 6.0]
+
+    chunk = pd.DataFrame({"a": [1.0, 2.0]})
+    predict.add_predictions(chunk, formula.CompiledFormulas(["y0 = 2*x0"]).predict(chunk), ["c"])
+    assert chunk.columns.tolist() == ["a", "predictions"]
+
+
+def test_multi_start_training(monkeypatch):
+    """
+    Checks that a multi-start search runs a fit for each seed and grid value,
+    keeps the candidate with the lowest validation error, and stops waiting
+    for the candidates once its budget is spent.
+    """
+    pickled = []
+    pickle_data = training_queue.pickle_data
+    monkeypatch.setattr(training_queue, "pickle_data", lambda data: pickled.append(data) or pickle_data(data))
+    params = {"population_size": 200, "n_iter": 2, "n_jobs": 1, "starts": 2, "grid": {"mutation_chance": [0.2, 0.4]}}
+    candidates = training_queue.get_candidates(params)
+    assert [(candidate["mutation_chance"], candidate["random_state"]) for candidate in candidates] == [
+        (0.2, 0), (0.2, 1), (0.4, 0), (0.4, 1)
+    ]
+    assert "starts" not in candidates[0] and "grid" not in candidates[0]
+    assert training_queue.get_candidates({"n_iter": 2}) == [{"n_iter": 2}]
+
+    queue = training_queue.TrainingQueue(max_workers=2, max_queued_jobs=0)
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 200), "b": rng.uniform(1, 10, 200)})
+    y = pd.DataFrame({"c": 2 * X["a"] + X["b"]})
+    job = queue.wait(queue.submit(X, y, params, "test_multi_start_training_model"), timeout=120)
+    assert job.status == training_queue.DONE, job.error
+    assert len(job.model.candidates_) == 4
+    assert [candidate["selected"] for candidate in job.model.candidates_].count(True) == 1
+    assert job.model.validation_mae_ == min(candidate["validation_mae"] for candidate in job.model.candidates_)
+    assert job.model.candidates_[0]["params"] == {"random_state": 0, "mutation_chance": 0.2}
+    # The training data is pickled once for all the candidates
+    assert len(pickled) == 2
+
+    # The candidates that did not start before the deadline are cancelled
+    queue = training_queue.TrainingQueue(max_workers=1, max_queued_jobs=0)
+    job = queue.wait(queue.submit(X, y, dict(params, starts=3, max_seconds=0), "test_multi_start_training_model"), timeout=120)
+    assert job.status == training_queue.DONE, job.error
+    assert 1 <= len(job.model.candidates_) < 6
+
+
+def test_multi_start_original_metrics(tmp_path, monkeypatch):
+    """
+    Checks that the original Mean Absolute Error of a model trained with a
+    multi-start search is that of its run, not of the runs of its candidates.
+    """
+    params = {"population_size": 100, "n_iter": 2, "n_jobs": 1, "starts": 2}
+    queue = training_queue.TrainingQueue(max_workers=2, max_queued_jobs=0)
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 100)})
+    y = pd.DataFrame({"b": 2 * X["a"]})
+    job = queue.wait(queue.submit(X, y, params, "test_multi_start_metrics_model"), timeout=120)
+    assert job.status == training_queue.DONE, job.error
+
+    monkeypatch.chdir(tmp_path)
+    tracking_uri = mlflow.get_tracking_uri()
+    mlflow.set_tracking_uri(f"file:{tmp_path / 'mlruns'}")
+    try:
+        train.update_mlflow(job.model, "multi_start", X, y, X, y)
+        mae = mean_absolute_error(y, job.model.predict(X))
+        monkeypatch.setattr(model_metadata, "cache", model_metadata.MetadataCache())
+        assert monitoring.get_original_metrics("multi_start") == pytest.approx(mae)
+        model_metadata.cache = model_metadata.MetadataCache()
+        model_metadata.cache.warm()
+        assert model_metadata.cache.get("multi_start").original_mae == pytest.approx(mae)
+    finally:
+        mlflow.set_tracking_uri(tracking_uri)
+
+
+def test_fit_store(dummy_data, tmp_path, monkeypatch):
+    """
+    Checks that an identical fit reuses the stored model instead of running
+    again, and that the store evicts the least recently used fits.
+    """
+    store = fit_store.FitStore(directory=str(tmp_path))
+    monkeypatch.setattr(fit_store, "store", store)
+    queue = training_queue.TrainingQueue(max_workers=1, max_queued_jobs=0)
+    X = dummy_data[["Temperature"]]
+    y = dummy_data[["Sales"]]
+    params = {"population_size": 100, "n_iter": 2, "n_jobs": 1, "random_state": 0}
+    key = fit_store.get_fingerprint(X, y, params, 1000)
+
+    assert fit_store.get_fingerprint(X, y, dict(params, n_jobs=4), 1000) == key
+    assert fit_store.get_fingerprint(X, y, params, 500) != key
+    assert fit_store.get_fingerprint(X, y * 2, params, 1000) != key
+    assert fit_store.get_fingerprint(X.rename(columns={"Temperature": "t"}), y, params, 1000) != key
+
+    first = queue.wait(queue.submit(X, y, params, "test_fit_store_model", fit_key=key), timeout=60)
+    assert first.status == training_queue.DONE, first.error
+    assert first.stored_fit is None
+    store.update(key, run_id="run", version="1")
+
+    completed = []
+    second = queue.wait(queue.submit(X, y, params, "test_fit_store_model", completed.append, fit_key=key), timeout=5)
+    assert second.status == training_queue.DONE
+    assert second.stored_fit["run_id"] == "run"
+    assert second.model.formulas == first.model.formulas
+    assert completed and completed[0].formulas == first.model.formulas
+    assert store.stats() == {"hits": 1, "misses": 1}
+
+    # Only the most recent fit fits in a store the size of one fit
+    size = os.path.getsize(tmp_path / f"{key}.pkl")
+    small_store = fit_store.FitStore(directory=str(tmp_path / "small"), max_bytes=size)
+    small_store.put("a", first.model)
+    os.utime(tmp_path / "small" / "a.pkl", (0, 0))
+    small_store.put("b", first.model)
+    assert small_store.get("a") is None
+    assert small_store.get("b")["model"].formulas == first.model.formulas
+
+    # The fits are only read from a directory that other users cannot write to
+    assert os.stat(tmp_path / "small").st_mode & 0o777 == 0o700
+    os.chmod(tmp_path / "small", 0o777)
+    assert small_store.get("b") is None
+
+
+@pytest.fixture
+def sqlite_database(tmp_path):
+    """
+    A SQLite stand-in for Mathfinder's MySQL database.
+    """
+    return database.create_sqlite_database(tmp_path / "mathfinder.db")
+
+
+def test_database_queries(sqlite_database):
+    """
+    Checks the queries used to save the models and update their testing dates.
+    """
+    sqlite_database.save_model("model_a", "a@test.com", 7, date(2024, 1, 1))
+    sqlite_database.save_model("model_b", "b@test.com", 7, date(2024, 1, 1))
+    sqlite_database.save_model("model_a", "new@test.com", 28, date(2024, 1, 2))
+    sqlite_database.save_model('quote"d', "c@test.com", 7, date(2024, 1, 1))
+    sqlite_database.update_testing_dates(["model_b", 'quote"d'], date(2024, 2, 1))
+
+    models = sorted(sqlite_database.get_models())
+    assert models == [
+        ("model_a", "new@test.com", 28, date(2024, 1, 2)),
+        ("model_b", "b@test.com", 7, date(2024, 2, 1)),
+        ('quote"d', "c@test.com", 7, date(2024, 2, 1)),
+    ]
+    next_testing_dates = sqlite_database.fetchall(
+        "SELECT name, next_testing_date FROM Models ORDER BY name;"
+    )
+    assert next_testing_dates == [
+        ("model_a", date(2024, 1, 31)),
+        ("model_b", date(2024, 2, 9)),
+        ('quote"d', date(2024, 2, 9)),
+    ]
+    assert not sqlite_database.has_due_models(date(2024, 1, 30))
+    assert sqlite_database.has_due_models(date(2024, 1, 31))
+
+
+def test_due_models_pagination(sqlite_database):
+    """
+    Checks that only the models due for testing are retrieved, one page at a time,
+    and that they are the models whose last test is older than their testing frequency.
+    """
+    today = date(2024, 6, 16)
+    for i in range(7):
+        sqlite_database.save_model(f"model_{i}", "test@test.com", 7, date(2024, 6, 5 + i))
+
+    expected = sorted(
+        model[0]
+        for model in sqlite_database.get_models()
+        if (today - model[3]).days > model[2]
+    )
+
+    pages = []
+    for page in sqlite_database.get_due_models(today, page_size=2):
+        pages.append([model[0] for model in page])
+        # Testing the models while paginating must not skip any of them
+        sqlite_database.update_testing_dates(pages[-1], today)
+
+    assert pages == [["model_0", "model_1"], ["model_2", "model_3"]]
+    assert sorted(sum(pages, [])) == expected
+    assert list(sqlite_database.get_due_models(today)) == []
+
+
+def test_parallel_monitoring(tmp_path, monkeypatch):
+    """
+    Checks that testing the models in worker processes gives the same results,
+    reports and metrics as testing them one after the other.
+    """
+    monkeypatch.setattr(model_metadata, "cache", model_metadata.MetadataCache())
+    model_metadata.cache.load(
+        {
+            f"model_{i}": model_metadata.ModelMetadata(f"model_{i}", "1", "source", ["a"], ["b"], 0.5)
+            for i in range(3)
+        }
+    )
+    monkeypatch.setattr(monitoring, "load_model", lambda model_name: formula.CompiledFormulas(["y0 = 2*x0"]))
+    models = [(f"model_{i}", f"user_{i}@test.com") for i in range(3)]
+
+    def run(directory, executor=None):
+        for i, (model_name, _) in enumerate(models):
+            (directory / "autotest" / model_name).mkdir(parents=True)
+            pd.DataFrame({"a": [1, 2, 3], "b": [2, 4, 6 + 3 * i]}).to_csv(
+                directory / "autotest" / model_name / "test.csv", index=False
+            )
+        monkeypatch.chdir(directory)
+        metrics.registry.reset()
+        results = monitoring.run_checks(models, executor)
+        return results, metrics.registry.snapshot()
+
+    serial_results, serial_snapshot = run(tmp_path / "serial")
+    # The monkeypatched functions are inherited by forked workers
+    with ProcessPoolExecutor(
+        max_workers=2,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=monitoring.init_worker,
+        initargs=(mlflow.get_tracking_uri(), model_metadata.cache.export()),
+    ) as executor:
+        parallel_results, parallel_snapshot = run(tmp_path / "parallel", executor)
+
+    assert parallel_results == serial_results
+    assert [result["title"] for result in serial_results] == [
+        "Your model passed the test", "Your model failed the test", "Your model failed the test"
+    ]
+    assert parallel_snapshot["counters"] == serial_snapshot["counters"]
+    assert parallel_snapshot["counters"][("rows_processed", (("stage", "evaluate"),))] == 9
+    assert parallel_snapshot["spans"][("check_model", ())][0] == serial_snapshot["spans"][("check_model", ())][0] == 3
+
+
+def test_benchmark_dataset():
+    """
+    Checks that the synthetic datasets used by the benchmark follow their ground truth formula.
+    """
+    dataframe, feature_names, target_name, ground_truth = benchmark.make_dataset(100, 4)
+    assert feature_names == ["feature_0", "feature_1", "feature_2", "feature_3"]
+    assert ground_truth == "y0 = x0*x1 - 2*x2 + 5"
+    expected = dataframe["feature_0"] * dataframe["feature_1"] - 2 * dataframe["feature_2"] + 5
+    assert np.allclose(dataframe[target_name], expected, rtol=1e-5)
+
+    timings, result = benchmark.measure(lambda: 42, repeat=3)
+    assert result == 42
+    assert timings["runs"] == 3
+    assert timings["min_seconds"] <= timings["median_seconds"]
+
+
+def test_sampling():
+    """
+    Checks that the samples have the requested size and keep the range of the target.
+    """
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(0, 10, 1000), "b": rng.uniform(0, 10, 1000)})
+    y = pd.DataFrame({"c": X["a"] ** 3})
+
+    X_sample, y_sample = sampling.sample_rows(X, y, 100, sampling.STRATIFIED, random_state=0)
+    assert len(X_sample) == len(y_sample) == 100
+    assert X_sample.index.is_unique and (X_sample.index == y_sample.index).all()
+    # Each decile of the target keeps a tenth of the sample
+    deciles = np.quantile(y["c"], np.linspace(0, 1, 11))
+    assert (np.histogram(y_sample["c"], deciles)[0] == 10).all()
+
+    X_sample, y_sample = sampling.sample_rows(X, y, 100, sampling.CORESET, random_state=0)
+    assert len(X_sample) == 100 and X_sample.index.is_unique
+    assert y_sample["c"].max() > y["c"].quantile(0.9)
+
+    assert sampling.sample_rows(X, y, 5000)[0] is X
+
+
+def test_sampled_training():
+    """
+    Checks that the formula searched on a sample of the data is refined on all
+    its rows, and that the refined constants are better than the original ones.
+    """
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 2000), "b": rng.uniform(1, 10, 2000)})
+    y = pd.DataFrame({"c": 3 * X["a"] + 2})
+
+    assert formula.refine_constants("y0 = 2.5*x0 + 1", X, y["c"]) != "y0 = 2.5*x0 + 1"
+    model = formula.FormulaRegressor(["y0 = 2.5*x0 + 1"]).fit(X, y)
+    assert np.allclose(model.predict(X), y["c"], rtol=1e-4)
+    assert formula.FormulaRegressor(["y0 = x0 ** 2"]).fit(X, y).formulas == ["y0 = x0 ** 2"]
+
+    params = {"population_size": 200, "n_iter": 2, "n_jobs": 1, "random_state": 42}
+    model = training_queue.fit_model(X, y, params, max_rows=200)
+    assert model.sample_rows_ == 200
+    assert model.search_params_ == params
+    search = SymbolicRegressor(**params).fit(*sampling.sample_rows(X, y, 200, random_state=42))
+    assert mean_absolute_error(y, model.predict(X)) <= mean_absolute_error(y, search.predict(X)) + 1e-6
+
+
+def test_warm_start_training(monkeypatch):
+    """
+    Checks that retraining starts from the formulas of the previous version,
+    and only searches a new formula when they do not beat the baseline.
+    """
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.uniform(1, 10, 500), "b": rng.uniform(1, 10, 500)})
+    y = pd.DataFrame({"c": 3 * X["a"] + 2})
+    params = {"population_size": 200, "n_iter": 2, "n_jobs": 1, "random_state": 42}
+
+    searches = []
+    search_formula = training_queue.search_formula
+    monkeypatch.setattr(training_queue, "search_formula", lambda *args: searches.append(args) or search_formula(*args))
+
+    model = training_queue.fit_model(X, y, params, initial_formulas=["y0 = 2.5*x0 + 1"], baseline_mae=0.1)
+    assert model.warm_start_ == "refined"
+    assert np.allclose(model.predict(X), y["c"], rtol=1e-4)
+    assert not searches
+
+    # Data that the previous formula cannot describe anymore
+    y = pd.DataFrame({"c": X["a"] * X["b"]})
+    model = training_queue.fit_model(X, y, params, initial_formulas=["y0 = 2.5*x0 + 1"], baseline_mae=0.1)
+    assert len(searches) == 1
+    assert model.warm_start_ in ("refined", "searched")
+    # The formulas are compared on rows used neither to refine nor to search them
+    _, X_validation, _, y_validation = training_queue.split_validation(X, y)
+    assert len(searches[0][0]) == len(X) - len(X_validation)
+    refined = formula.FormulaRegressor(["y0 = 2.5*x0 + 1"]).fit(X.drop(X_validation.index), y.drop(X_validation.index))
+    assert model.validation_mae_ <= mean_absolute_error(y_validation, refined.predict(X_validation))
+
+
+def test_autotest_manifest(tmp_path, monkeypatch):
+    """
+    Checks that every pending test file is scored in one pass, then archived
+    with its result, and that a file already processed is not tested again.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_metadata, "cache", model_metadata.MetadataCache())
+    model_metadata.cache.load(
+        {"model": model_metadata.ModelMetadata("model", "1", "source", ["a"], ["b"], 0.5)}
+    )
+    monkeypatch.setattr(monitoring, "load_model", lambda model_name: formula.CompiledFormulas(["y0 = 2*x0"]))
+
+    directory = tmp_path / "autotest" / "model"
+    directory.mkdir(parents=True)
+    pd.DataFrame({"a": [1, 2], "b": [2, 4]}).to_csv(directory / "first.csv", index=False)
+    pd.DataFrame({"a": [1, 2], "b": [3, 7]}).to_csv(directory / "second.csv", index=False)
+    pd.DataFrame({"c": [1, 2]}).to_csv(directory / "invalid.csv", index=False)
+
+    result = monitoring.check_model("model", "test@test.com")
+    assert result["tested"] and result["title"] == "Your model failed the test"
+    assert sorted(os.listdir(directory)) == ["invalid.csv", "processed"]
+
+    test_files = autotest.TestFiles("model")
+    results = {entry["result"]["mae"] for entry in test_files.files.values() if entry["status"] == autotest.PROCESSED}
+    assert results == {0.0, 2.0}
+    assert test_files.files["invalid.csv"]["status"] == autotest.INVALID
+
+    # Nothing changed since the last scan, so the directory is not listed again
+    with monkeypatch.context() as m:
+        m.setattr(autotest, "MTIME_RESOLUTION_NS", 0)
+        assert autotest.TestFiles("model").pending() == []
+        m.setattr(autotest.TestFiles, "_scan", lambda self: pytest.fail("Unexpected scan"))
+        assert autotest.TestFiles("model").pending() == []
+
+    # A corrected file is tried again, even if the directory did not change
+    with monkeypatch.context() as m:
+        m.setattr(autotest, "MTIME_RESOLUTION_NS", 0)
+        pd.DataFrame({"a": [1, 2, 3], "b": [2, 4, 6]}).to_csv(directory / "invalid.csv", index=False)
+        assert autotest.TestFiles("model").pending() == ["invalid.csv"]
+
+    # A file that was already processed is archived without being tested
+    pd.DataFrame({"a": [1, 2], "b": [2, 4]}).to_csv(directory / "copy.csv", index=False)
+    test_files = autotest.TestFiles("model")
+    assert test_files.pending() == ["invalid.csv"]
+    assert "copy.csv" not in os.listdir(directory)
+    duplicates = [filename for filename, entry in test_files.files.items() if entry["status"] == autotest.DUPLICATE]
+    assert len(duplicates) == 1 and duplicates[0].endswith("_copy.csv")
+
+
+def test_feature_drift(tmp_path, monkeypatch):
+    """
+    Checks that the drift of the features is measured against their training
+    sketches one chunk at a time, and included in the monitoring report.
+    """
+    rng = np.random.default_rng(0)
+    train_data = pd.DataFrame({"a": rng.normal(0, 1, 5000), "b": rng.uniform(0, 1, 5000), "c": 1.0})
+    sketches = drift.build_sketches(train_data)
+    assert len(sketches["features"]["a"]["quantiles"]) == drift.QUANTILES + 1
+
+    test_data = pd.DataFrame({"a": rng.normal(1, 1, 3000), "b": rng.uniform(0, 1, 3000), "c": 1.0})
+    streaming = drift.StreamingDrift(sketches)
+    for start in range(0, 3000, 1000):
+        streaming.update(test_data.iloc[start:start + 1000])
+    results = streaming.to_dict()
+    assert results["a"]["drifted"] and not results["b"]["drifted"] and not results["c"]["drifted"]
+    # The KS statistic is close to the exact one
+    assert abs(results["a"]["ks"] - 0.38) < 0.03
+
+    merged = drift.StreamingDrift(sketches)
+    for start in range(0, 3000, 1500):
+        part = drift.StreamingDrift(sketches)
+        part.update(test_data.iloc[start:start + 1500])
+        merged.merge(part)
+    assert merged.to_dict() == results
+
+    # The monitoring script reads the sketches stored next to the model
+    monkeypatch.chdir(tmp_path)
+    with open(tmp_path / drift.SKETCHES_ARTIFACT, "w") as f:
+        json.dump(drift.build_sketches(train_data[["a"]]), f)
+    monkeypatch.setattr(model_metadata, "cache", model_metadata.MetadataCache())
+    model_metadata.cache.load(
+        {"model": model_metadata.ModelMetadata("model", "1", str(tmp_path / "model"), ["a"], ["y"], 1.0)}
+    )
+    monkeypatch.setattr(monitoring, "load_model", lambda model_name: formula.CompiledFormulas(["y0 = x0"]))
+    directory = tmp_path / "autotest" / "model"
+    directory.mkdir(parents=True)
+    test_data.assign(y=test_data["a"]).to_csv(directory / "test.csv", index=False)
+
+    result = monitoring.check_model("model", "test@test.com")
+    assert "- a: PSI" in result["report"] and "(drifted)" in result["report"]
+    [entry] = autotest.TestFiles("model").files.values()
+    assert entry["result"]["drift"]["a"]["drifted"]
+
+
+def test_streaming_evaluation(tmp_path):
+    """
+    Checks that the errors computed one chunk at a time are the same as those
+    computed on the whole file.
+    """
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({"a": rng.uniform(0, 10, 1000), "b": rng.uniform(0, 10, 1000), "other": 0})
+    data["c"] = 2 * data["a"] + rng.normal(0, 1, 1000)
+    data["d"] = data["b"] + rng.normal(0, 1, 1000)
+    data.to_csv(tmp_path / "test.csv", index=False)
+    model = formula.CompiledFormulas(["y0 = 2*x0", "y1 = x1"], ["a", "b"])
+
+    errors = evaluation.evaluate_file(model, tmp_path / "test.csv", ["a", "b"], ["c", "d"], chunk_size=300)
+    y_pred = model.predict(data[["a", "b"]])
+    assert errors.count == 1000 and errors.chunks == 4
+    assert errors.mae == pytest.approx(mean_absolute_error(data[["c", "d"]], y_pred))
+    assert errors.rmse == pytest.approx(np.sqrt(np.mean((data[["c", "d"]].to_numpy() - y_pred) ** 2)))
+    assert errors.max_error == pytest.approx(np.abs(data[["c", "d"]].to_numpy() - y_pred).max())
+
+    with pytest.raises(ValueError):
+        evaluation.evaluate_file(model, tmp_path / "test.csv", ["a", "missing"], ["c"])
+
+
+def test_columnar_formats(tmp_path):
+    """
+    Checks that Parquet and Arrow files are read like CSV files, with only the
+    columns requested.
+    """
+    data = pd.DataFrame({"a": np.arange(10.0), "b": np.arange(10), "c": list("abcdefghij")})
+    data.to_csv(tmp_path / "data.csv", index=False)
+    data.to_parquet(tmp_path / "data.parquet", row_group_size=4)
+    data.to_feather(tmp_path / "data.feather")
+
+    for filename in ("data.csv", "data.parquet", "data.feather"):
+        path = tmp_path / filename
+        chunks = list(datasets.iter_chunks(path, ["b", "a"], chunk_size=3))
+        assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+        assert pd.concat(chunks).columns.tolist() == ["b", "a"]
+        pd.testing.assert_frame_equal(datasets.read(path), data)
+        assert datasets.read(path, nrows=4).shape == (4, 3)
+        with pytest.raises(ValueError):
+            datasets.read(path, ["missing"])
+
+        # Uploaded files are file objects
+        with open(path, "rb") as f:
+            assert datasets.read(f, ["a"])["a"].sum() == 45
+
+        model = formula.CompiledFormulas(["y0 = x0"], ["a"])
+        errors = evaluation.evaluate_file(model, path, ["a"], ["b"])
+        assert errors.count == 10 and errors.mae == 0
+
+    assert not datasets.is_supported("data.txt")
+
+
+class _Upload(io.BytesIO):
+    """
+    Stands in for the files uploaded on Streamlit.
+    """
+
+    def __init__(self, content: bytes, name: str, file_id: str):
+        super().__init__(content)
+        self.name = name
+        self.file_id = file_id
+
+
+def test_dataset_cache(tmp_path, monkeypatch):
+    """
+    Checks that uploads are parsed once per content, and that the DataFrames
+    evicted from memory are reloaded from disk.
+    """
+    data = pd.DataFrame({"a": np.arange(100.0), "b": np.arange(100)})
+    size = dataset_cache.get_dataframe_size(data)
+    cache = dataset_cache.DatasetCache(max_bytes=size * 3 // 2, directory=str(tmp_path / "cache"))
+    monkeypatch.setattr(dataset_cache, "cache", cache)
+    content = data.to_csv().encode()  # With an unnamed index column
+
+    session = {}
+    first = dataset_cache.read_upload(_Upload(content, "data.csv", "1"), session)
+    assert first.columns.tolist() == ["a", "b"]
+    # The same content uploaded again, e.g. by another user, is not parsed again
+    assert dataset_cache.read_upload(_Upload(content, "other.csv", "2"), {}) is first
+    assert len(session[dataset_cache.SESSION_HASHES_KEY]) == 1
+
+    # A second dataset evicts the first one from memory, which is written to disk
+    other = dataset_cache.read_upload(_Upload((data * 2).to_csv(index=False).encode(), "other.csv", "3"))
+    assert other["b"].sum() == 2 * data["b"].sum()
+    reloaded = dataset_cache.read_upload(_Upload(content, "data.csv", "1"), session)
+    pd.testing.assert_frame_equal(reloaded, first)
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["disk_hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["frames"] == 1
+
+    # Previews are kept in the session while the same file is uploaded
+    upload = _Upload(content, "data.csv", "1")
+    preview = dataset_cache.read_preview(upload, session, nrows=5)
+    assert preview.shape == (5, 2)
+    assert dataset_cache.read_preview(upload, session, nrows=5) is preview
+
+    # The cache directory is only accessible to its owner
+    assert os.stat(cache.directory).st_mode & 0o777 == 0o700
+    # A directory others can write to is neither read nor written
+    spilled = [name[:-len(".parquet")] for name in os.listdir(cache.directory)]
+    other_cache = dataset_cache.DatasetCache(max_bytes=0, directory=cache.directory)
+    assert other_cache.get(spilled[0]) is not None
+    os.chmod(cache.directory, 0o777)
+    assert other_cache.get(spilled[0]) is None
+    other_cache.put("shared", data)
+    assert not os.path.exists(os.path.join(cache.directory, "shared.parquet"))
+
+    # Only the hashes of the latest uploads are kept in the session
+    monkeypatch.setattr(dataset_cache, "MAX_SESSION_HASHES", 2)
+    for file_id in ["4", "5", "1"]:
+        dataset_cache.read_upload(_Upload(content, "data.csv", file_id), session)
+    assert list(session[dataset_cache.SESSION_HASHES_KEY]) == ["5", "1"]
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to receive the reports of the monitoring script.
+    """
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.wfile.write(b"220 localhost\r\n")
+        for line in self.rfile:
+            verb = line[:4].decode().upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-localhost\r\n250 AUTH PLAIN\r\n")
+            elif verb == "AUTH":
+                server.logins += 1
+                self.wfile.write(b"235 Authentication successful\r\n")
+            elif verb == "MAIL" and server.failures:
+                server.failures -= 1
+                self.wfile.write(b"451 Try again later\r\n")
+            elif verb == "DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                server.messages.append(data.decode())
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    """
+    A local SMTP server that records the messages it receives.
+    """
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.connections = server.logins = server.failures = 0
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setenv("SMTP_PORT", str(server.server_address[1]))
+    monkeypatch.setenv("SMTP_SSL", "0")
+    monkeypatch.setenv("SMTP_LOGIN", "mathfinder@test.com")
+    monkeypatch.setenv("SMTP_PWD", "password")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_report_delivery(smtp_server):
+    """
+    Checks that the reports of a user are sent in a single digest, over a
+    single connection, and that failed deliveries are retried.
+    """
+    smtp_server.failures = 1
+    sender = reports.ReportSender(retry_delay=0.01)
+    for model_name, email, tested in (
+        ("model_a", "a@test.com", True),
+        ("model_b", "b@test.com", True),
+        ("model_c", "a@test.com", True),
+        ("model_d", "a@test.com", False),
+    ):
+        sender.add(
+            {"model_name": model_name, "email": email, "tested": tested, "title": "Your model passed the test", "report": f"Report of {model_name}"}
+        )
+    sender.close()
+
+    assert (sender.sent, sender.failed) == (2, 0)
+    assert len(smtp_server.messages) == 2
+    # The first attempt failed, so a second connection was opened
+    assert smtp_server.connections == smtp_server.logins == 2
+    digest = next(message for message in smtp_server.messages if "To: a@test.com" in message)
+    assert "Subject: Mathfinder tested 2 of your models" in digest
+    assert "Report of model_a" in digest and "Report of model_c" in digest
+    assert "model_d" not in digest
+
+
+def test_micro_batching():
+    """
+    Checks that concurrent requests are predicted in fewer batches, and that
+    each request gets the predictions of its own rows.
+    """
+    calls = []
+
+    def predict(X):
+        calls.append(len(X))
+        return X["x"].to_numpy() * 2
+
+    batcher = serving.MicroBatcher(predict, max_batch_size=1000, max_wait=0.05)
+    results = {}
+    threads = [
+        threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.submit(pd.DataFrame({"x": [i, i + 0.5]}))))
+        for i in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) < 20
+    assert sum(calls) == 40
+    for i in range(20):
+        assert results[i].ravel().tolist() == [2 * i, 2 * i + 1]
+
+    # A request that makes its batch fail does not make the others fail
+    failing = serving.MicroBatcher(lambda X: X["x"].to_numpy() * 2, max_wait=0.05)
+    with pytest.raises(KeyError):
+        failing.submit(pd.DataFrame({"z": [1]}))
+    assert failing.submit(pd.DataFrame({"x": [1]})).ravel().tolist() == [2]
+
+
+def test_prediction_server(monkeypatch):
+    """
+    Checks the predictions and errors returned by the prediction server.
+    """
+    metadata = model_metadata.ModelMetadata("sales", "3", "mlartifacts/0/run/artifacts/sales", ["Price", "Temperature"], ["Sales"], 0.5)
+
+    def get_metadata(model_name):
+        if model_name not in ("sales", "sales 2"):
+            raise mlflow.exceptions.MlflowException(f"Model {model_name} not found")
+        return metadata
+
+    monkeypatch.setattr(model_metadata.cache, "get", get_metadata)
+    monkeypatch.setattr(model_cache, "load_model", lambda model_name: formula.CompiledFormulas(["y0 = 2*x0 + x1"]))
+    server = serving.PredictionServer(("127.0.0.1", 0), max_wait=0.01)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def post(path, body):
+        request = urllib.request.Request(url + path, data=json.dumps(body).encode(), method="POST")
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    try:
+        rows = [{"Temperature": 4, "Price": 10}, {"Temperature": 1, "Price": 3}]
+        assert post("/predict/sales", {"rows": rows}) == (200, {"model": "sales", "version": "3", "predictions": [24, 7]})
+        status, response = post("/predict/sales", {"columns": ["T", "P"], "data": [[4, 10]], "features": "P; T"})
+        assert (status, response["predictions"]) == (200, [24])
+        # Requests with other column names share the batcher of the model
+        assert list(server._batchers) == ["sales"]
+        assert post("/predict/sales", {"columns": ["T", "P"], "data": [[4, 10]], "features": "P"})[0] == 400
+        assert post("/predict/sales", {"rows": [{"Price": 10}]})[0] == 400
+        assert post("/predict/sales", {"values": []})[0] == 400
+        assert post("/predict/sales", [rows])[0] == 400
+        assert post("/predict/sales%202", {"rows": rows})[0] == 200
+        assert post("/predict/unknown", {"rows": rows})[0] == 404
+        with urllib.request.urlopen(url + "/health") as response:
+            assert json.load(response) == {"status": "ok"}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_export():
+    """
+    Checks that spans and counters are exported, and that the metrics of a
+    worker process can be merged.
+    """
+    registry = metrics.Registry()
+    with registry.span("predict"):
+        pass
+    with pytest.raises(ValueError):
+        with registry.span("read", format="csv"):
+            raise ValueError()
+    registry.increment("rows_read", 10, format="csv")
+
+    worker = metrics.Registry()
+    worker.observe("predict", 2.0)
+    worker.increment("rows_read", 5, format="csv")
+    registry.merge(worker.snapshot())
+
+    summary = registry.summary()
+    assert summary["spans"][0]["name"] == "predict"
+    assert summary["spans"][0]["count"] == 2 and summary["spans"][0]["max_seconds"] == 2.0
+    assert summary["counters"] == [{"name": "rows_read", "labels": {"format": "csv"}, "value": 15}]
+    assert metrics.get_total_seconds(registry.snapshot(), "predict") >= 2.0
+
+    text = registry.to_prometheus()
+    assert 'mathfinder_span_seconds_count{span="read",format="csv"} 1' in text
+    assert 'mathfinder_rows_read_total{format="csv"} 15' in text
+
+
+def test_pipeline_metrics(tmp_path):
+    """
+    Checks that the evaluation of a test file records its reads, predictions and rows.
+    """
+    metrics.registry.reset()
+    dataframe = pd.DataFrame({"x": np.arange(250.0), "y": np.arange(250.0) * 2})
+    dataframe.to_csv(tmp_path / "test.csv", index=False)
+    model = formula.CompiledFormulas(["y0 = 2*x0"])
+    evaluation.evaluate_file(model, tmp_path / "test.csv", ["x"], ["y"], chunk_size=100)
+
+    snapshot = metrics.registry.snapshot()
+    assert snapshot["spans"][("read", (("format", "csv"),))][0] == 3
+    assert snapshot["spans"][("predict", ())][0] == 3
+    assert snapshot["counters"][("rows_processed", (("stage", "evaluate"),))] == 250
+
+
+def test_import_budget():
+    """
+    Checks that the monitoring script and the Streamlit pages start without
+    importing mlflow or scikit-learn.
+
+    Their import time is not checked here, as it depends on the load of the
+    machine, but benchmark.py compares it with their budget.
+    """
+    for module_name in benchmark.IMPORT_BUDGETS:
+        assert benchmark.measure_import(module_name)["heavy_modules"] == [], module_name
+    # The form displayed once a file is uploaded does not need them either
+    for module_name in benchmark.UPLOAD_PAGES:
+        assert benchmark.measure_import(module_name, upload=True)["heavy_modules"] == [], module_name
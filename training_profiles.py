@@ -0,0 +1,56 @@
+"""
+The training profiles, which set the hyperparameters of the formula searches.
+
+This module does not import the estimators, so that the train page can list
+the profiles without importing scikit-learn and sblearn.
+"""
+import os
+import json
+import multiprocessing
+
+
+# Number of fits that can run at the same time
+MAX_WORKERS = int(os.environ.get("TRAINING_WORKERS", 2))
+# Default number of rows used to search a formula. Larger datasets are sampled.
+MAX_TRAINING_ROWS = int(os.environ.get("TRAINING_MAX_ROWS", 10000))
+# Default wall-clock budget of a multi-start search, in seconds. It is a soft limit:
+# the candidates running when it is spent are not interrupted.
+MAX_SEARCH_SECONDS = float(os.environ.get("TRAINING_MAX_SEARCH_SECONDS", 600))
+
+# Hyperparameters of SymbolicRegressor for each training profile. They can be
+# overridden with a JSON file whose path is set in TRAINING_PROFILES_FILE.
+# A profile can also run a multi-start search (see training_queue.get_candidates) with:
+# - "starts": the number of random seeds tried for each set of parameters
+# - "grid": a dict with the list of values tried for some parameters
+# - "max_seconds": the wall-clock budget of the search (MAX_SEARCH_SECONDS by default)
+DEFAULT_PROFILES = {
+    "fast": {"population_size": 2000, "n_iter": 10},
+    "default": {},
+    "thorough": {"population_size": 20000, "n_iter": 40},
+    "multi-start": {"population_size": 5000, "starts": 4, "grid": {"mutation_chance": [0.2, 0.4]}},
+}
+# Keys of the profiles that are not parameters of SymbolicRegressor
+SEARCH_SETTINGS = ("starts", "grid", "max_seconds")
+
+
+def load_profiles() -> dict:
+    """
+    Returns the hyperparameters of every training profile.
+    """
+    profiles_file = os.environ.get("TRAINING_PROFILES_FILE")
+    if not profiles_file:
+        return DEFAULT_PROFILES
+    with open(profiles_file) as f:
+        return json.load(f)
+
+
+def get_profile_params(profile: str, max_workers: int = MAX_WORKERS) -> dict:
+    """
+    Returns the parameters of a SymbolicRegressor for the given training profile.
+
+    Unless the profile sets it, the number of cores used by each fit is chosen
+    so that 'max_workers' fits can run in parallel on separate cores.
+    """
+    params = dict(load_profiles()[profile])
+    params.setdefault("n_jobs", max(1, multiprocessing.cpu_count() // max_workers))
+    return params
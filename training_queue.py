@@ -0,0 +1,613 @@
+"""
+Runs the symbolic regression fits in the background.
+
+Finding a formula can take several minutes, so the train page submits its fits
+to this queue instead of running them inside the Streamlit session. The fits
+run in a pool of worker processes. Once a fit is done, the completion steps
+given with the job (saving the model to MLflow, updating the database...) run
+in a thread of the Streamlit server process, even if the user closed the page.
+The jobs are completed one at a time, as MLflow keeps the active experiment
+and run in global variables.
+"""
+import os
+import uuid
+import pickle
+import logging
+import itertools
+import multiprocessing
+from queue import SimpleQueue
+from datetime import datetime
+from threading import Event, Lock, Thread, Timer
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from sblearn.models import SymbolicRegressor
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import train_test_split
+
+import fit_store
+import metrics
+import sampling
+from formula import FormulaRegressor, combine_models, set_target_index
+# The profiles are defined in a light module, which the train page imports
+from training_profiles import (
+    MAX_WORKERS,
+    MAX_TRAINING_ROWS,
+    MAX_SEARCH_SECONDS,
+    SEARCH_SETTINGS,
+    load_profiles,
+    get_profile_params,
+)
+
+
+# Number of fits that can wait for a worker when all of them are busy.
+# Set it to 0 to reject new fits instead of queueing them.
+MAX_QUEUED_JOBS = int(os.environ.get("TRAINING_MAX_QUEUED_JOBS", 10))
+# Share of the training rows kept aside to compare the candidates of a multi-start search
+VALIDATION_FRACTION = 0.2
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a fit is submitted while the training queue is full.
+    """
+
+
+def get_candidates(params: dict) -> list:
+    """
+    Returns the parameters of each fit of a multi-start search, i.e. every
+    combination of the values in params["grid"], each with params["starts"]
+    random seeds. Returns [params] for a profile without multi-start settings.
+
+    The seeds start from params["random_state"] (0 by default), so the same
+    profile always tries the same candidates.
+    """
+    starts = params.get("starts", 1)
+    grid = params.get("grid", {})
+    params = {key: value for key, value in params.items() if key not in SEARCH_SETTINGS}
+    if starts <= 1 and not grid:
+        return [params]
+
+    first_seed = params.get("random_state") or 0
+    candidates = []
+    for values in itertools.product(*grid.values()):
+        for seed in range(first_seed, first_seed + starts):
+            candidates.append({**params, **dict(zip(grid, values)), "random_state": seed})
+    return candidates
+
+
+def search_formula(X, y, params: dict, max_rows: int = None, sampling_method: str = sampling.STRATIFIED):
+    """
+    Searches a new formula with a SymbolicRegressor.
+
+    If X has more than 'max_rows' rows, the formula is searched on a sample of
+    'max_rows' rows drawn with 'sampling_method', then its constants are refined
+    on all the rows. The model returned is then a FormulaRegressor, which
+    remembers the search parameters and the size of the sample.
+    """
+    if not max_rows or len(X) <= max_rows:
+        model = SymbolicRegressor(**params)
+        with metrics.span("fit", stage="search"):
+            model.fit(X, y)
+        return model
+
+    X_sample, y_sample = sampling.sample_rows(
+        X, y, max_rows, sampling_method, random_state=params.get("random_state")
+    )
+    search = SymbolicRegressor(**params)
+    with metrics.span("fit", stage="search"):
+        search.fit(X_sample, y_sample)
+    model = FormulaRegressor(search.formulas)
+    with metrics.span("fit", stage="refine"):
+        model.fit(X, y)
+    model.search_params_ = params
+    model.sampling_method_ = sampling_method
+    model.sample_rows_ = len(X_sample)
+    return model
+
+
+def fit_model(
+    X,
+    y,
+    params: dict,
+    max_rows: int = None,
+    sampling_method: str = sampling.STRATIFIED,
+    initial_formulas: list = None,
+    baseline_mae: float = None,
+):
+    """
+    Trains a new model with the data provided. Runs in a worker process.
+
+    See search_formula for 'max_rows' and 'sampling_method'.
+
+    When retraining a model, 'initial_formulas' are the formulas of its
+    previous version: their constants are refined on the new data first. If
+    the refined formulas have a Mean Absolute Error below 'baseline_mae', they
+    are returned without searching a new formula. Otherwise a new formula is
+    searched as with fit_candidate, and the best of both is returned. The
+    'warm_start_' attribute of the model returned tells which one was kept.
+
+    'baseline_mae' is measured on rows that were not used to train the
+    previous version, so the formulas are compared on VALIDATION_FRACTION of
+    the rows that are not used to refine or search them, then the constants of
+    the formulas kept are refined on all the rows.
+    """
+    if not initial_formulas:
+        return search_formula(X, y, params, max_rows, sampling_method)
+
+    X_fit, X_validation, y_fit, y_validation = split_validation(X, y)
+    warm_model = FormulaRegressor(initial_formulas)
+    with metrics.span("fit", stage="warm_start"):
+        warm_model.fit(X_fit, y_fit)
+    warm_mae = mean_absolute_error(y_validation, warm_model.predict(X_validation))
+    if baseline_mae is None or warm_mae > baseline_mae:
+        model = fit_candidate(X, y, params, max_rows, sampling_method)
+        if model.validation_mae_ <= warm_mae:
+            model.warm_start_ = "searched"
+            return model
+    else:
+        logging.info(f"The refined formulas beat the baseline ({warm_mae} <= {baseline_mae}), no search needed")
+
+    with metrics.span("fit", stage="refine"):
+        warm_model.fit(X, y)
+    warm_model.validation_mae_ = warm_mae
+    warm_model.warm_start_ = "refined"
+    return warm_model
+
+
+def pickle_data(data) -> bytes:
+    """
+    Returns the pickled training data of a job, which the queue sends to the
+    worker processes. The DataFrames are pickled once per job: each fit then
+    only copies the bytes instead of pickling the DataFrames again.
+    """
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def run_fit(X_data: bytes, y_data: bytes, *args) -> tuple:
+    """
+    Runs fit_model in a worker process, with X and y pickled by pickle_data.
+    Returns a tuple (trained model, metrics snapshot of the fit), as the
+    metrics of the worker are not visible from the Streamlit server process.
+    """
+    X, y = pickle.loads(X_data), pickle.loads(y_data)
+    metrics.registry.reset()
+    with metrics.span("training"):
+        model = fit_model(X, y, *args)
+    metrics.increment("rows_processed", len(X), stage="fit")
+    return model, metrics.registry.snapshot()
+
+
+def split_validation(X, y) -> tuple:
+    """
+    Returns a tuple (X_fit, X_validation, y_fit, y_validation), keeping the
+    same VALIDATION_FRACTION of the rows aside for every fit of a dataset.
+    """
+    return train_test_split(X, y, test_size=VALIDATION_FRACTION, random_state=0)
+
+
+def fit_candidate(X, y, params: dict, max_rows: int = None, sampling_method: str = sampling.STRATIFIED):
+    """
+    Fits a candidate of a multi-start search. Runs in a worker process.
+
+    The formula is searched on part of the rows, and its Mean Absolute Error on
+    the other VALIDATION_FRACTION of the rows, the same for every candidate, is
+    kept in the 'validation_mae_' attribute of the model. The constants of the
+    formula are then refined on all the rows.
+    """
+    X_fit, X_validation, y_fit, y_validation = split_validation(X, y)
+    search = search_formula(X_fit, y_fit, params, max_rows, sampling_method)
+    validation_mae = mean_absolute_error(y_validation, search.predict(X_validation))
+
+    model = FormulaRegressor(search.formulas)
+    with metrics.span("fit", stage="refine"):
+        model.fit(X, y)
+    model.search_params_ = getattr(search, "search_params_", params)
+    for attribute in ("sampling_method_", "sample_rows_"):
+        if hasattr(search, attribute):
+            setattr(model, attribute, getattr(search, attribute))
+    model.validation_mae_ = validation_mae
+    return model
+
+
+def run_candidate(X_data: bytes, y_data: bytes, *args) -> tuple:
+    """
+    Runs fit_candidate in a worker process, see run_fit.
+    """
+    X, y = pickle.loads(X_data), pickle.loads(y_data)
+    metrics.registry.reset()
+    with metrics.span("training"):
+        model = fit_candidate(X, y, *args)
+    metrics.increment("rows_processed", len(X), stage="fit")
+    return model, metrics.registry.snapshot()
+
+
+def get_varied_params(candidates: list) -> list:
+    """
+    Returns the names of the parameters that differ between candidates.
+    """
+    return [key for key in candidates[0] if len({repr(candidate.get(key)) for candidate in candidates}) > 1]
+
+
+def combine_target_models(models: list, feature_names: list) -> FormulaRegressor:
+    """
+    Combines the models trained for each target column into a single model,
+    which keeps the search parameters of the fits.
+    """
+    model = combine_models(models, feature_names)
+    model.search_params_ = getattr(models[0], "search_params_", None) or models[0].get_params()
+    for attribute in ("sampling_method_", "sample_rows_"):
+        if hasattr(models[0], attribute):
+            setattr(model, attribute, getattr(models[0], attribute))
+    warm_starts = {getattr(target_model, "warm_start_", None) for target_model in models} - {None}
+    if warm_starts:
+        model.warm_start_ = "+".join(sorted(warm_starts))
+    if hasattr(models[0], "candidates_"):
+        model.candidates_ = [candidate for target_model in models for candidate in target_model.candidates_]
+    return model
+
+
+class TrainingJob:
+    """
+    A fit submitted to the training queue.
+
+    With several target columns, one formula is searched for each target by a
+    separate fit, and the job is done once all of them are. With a multi-start
+    profile, each target has several candidate fits, the best of which is
+    kept. 'on_complete' is called with the trained model once the fit is done.
+
+    Jobs submitted with a 'fit_key' store their model in the fit store, and
+    'stored_fit' holds the stored result when the fit was not run again.
+    """
+
+    def __init__(
+        self, model_name: str, feature_names: list, target_names: list, on_complete=None, fit_key: str = None
+    ):
+        self.id = uuid.uuid4().hex[:8]
+        self.model_name = model_name
+        self.feature_names = feature_names
+        self.target_names = target_names
+        self.submitted_at = datetime.now()
+        self.finished_at = None
+        self.model = None
+        self.metrics = None
+        self.error = None
+        self.cancel_requested = False
+        self.deadline_passed = False
+        self.fit_key = fit_key
+        self.stored_fit = None
+        self._status = QUEUED
+        self._on_complete = on_complete
+        self._futures = []
+        self._targets = []  # Index of the target of each future
+        self._candidates = []  # Parameters of the fit of each future
+        self._timer = None
+        self._completing = False
+        self._finished = Event()
+
+    @property
+    def status(self) -> str:
+        if self._status == QUEUED and any(future.running() or future.done() for future in self._futures):
+            return RUNNING
+        return self._status
+
+    def is_finished(self) -> bool:
+        return self._finished.is_set()
+
+    def get_targets(self) -> list:
+        """
+        Returns the indices of the targets fitted separately. A stored model
+        combines all the targets, so it counts as a single one.
+        """
+        return sorted(set(self._targets))
+
+    def get_fits(self, target: int) -> list:
+        """
+        Returns a list of tuples (future, parameters) with the fits of a target.
+        """
+        return [
+            (future, params)
+            for future, future_target, params in zip(self._futures, self._targets, self._candidates)
+            if future_target == target
+        ]
+
+
+def _succeeded(future) -> bool:
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+class TrainingQueue:
+    """
+    A queue of fits executed by a pool of 'max_workers' processes.
+
+    At most 'max_queued_jobs' fits can wait for a worker, new fits are
+    rejected with a QueueFullError beyond that.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_queued_jobs: int = MAX_QUEUED_JOBS):
+        self.max_workers = max_workers
+        self.max_queued_jobs = max_queued_jobs
+        self._jobs = {}
+        self._executor = None
+        self._completions = SimpleQueue()
+        self._completion_thread = None
+        self._lock = Lock()
+
+    def submit(
+        self,
+        X,
+        y,
+        params: dict,
+        model_name: str,
+        on_complete=None,
+        max_rows: int = None,
+        sampling_method: str = sampling.STRATIFIED,
+        initial_formulas: list = None,
+        baseline_mae: float = None,
+        fit_key: str = None,
+    ) -> str:
+        """
+        Submits a fit to the queue and returns the ID of the job.
+
+        Each job trains its own SymbolicRegressor built from 'params'. See
+        fit_model for the other parameters.
+
+        'fit_key' is the fingerprint of the fit (see fit_store.get_fingerprint).
+        If a model was already stored under it, the job is done right away
+        with that model, otherwise the model found is stored under it.
+
+        If y has several columns, the fits of the targets are submitted
+        separately, so they run in parallel on several workers. The previous
+        formula of each target is refined as with a single target, but the
+        search never stops early as 'baseline_mae' covers all the targets.
+
+        If 'params' sets up a multi-start search (see get_candidates), the
+        candidates of each target run in parallel, and the one with the lowest
+        validation Mean Absolute Error is kept. Once params["max_seconds"] have
+        passed since the submission, the candidates still waiting for a worker
+        are cancelled and the best of the finished ones is kept. This budget
+        is a soft limit: the job is completed on time, but the candidates
+        already running cannot be interrupted, so they keep their worker busy
+        until they finish and their result is discarded. Retraining from
+        'initial_formulas' runs a single fit.
+        """
+        job = TrainingJob(model_name, list(X.columns), list(y.columns), on_complete, fit_key)
+        if fit_key is not None:
+            job.stored_fit = fit_store.store.get(fit_key)
+        if job.stored_fit is not None:
+            logging.info(f"Reusing the stored fit {fit_key} for model {model_name} (job {job.id})")
+            future = Future()
+            future.set_result((job.stored_fit["model"], job.stored_fit["metrics"]))
+            job._futures.append(future)
+            job._targets.append(0)
+            job._candidates.append(params)
+            with self._lock:
+                self._jobs[job.id] = job
+            self._on_fit_done(job)
+            return job.id
+
+        candidates = get_candidates(params)
+        with self._lock:
+            if self.count_active_jobs() >= self.max_workers + self.max_queued_jobs:
+                raise QueueFullError(
+                    f"{self.max_workers} fits are running and {self.max_queued_jobs} are waiting already."
+                )
+            if self._executor is None:
+                # Forking the Streamlit server, which runs several threads, is not safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            self._jobs[job.id] = job
+            X_data = pickle_data(X)
+            for i, target_name in enumerate(y.columns):
+                y_data = pickle_data(y if y.shape[1] == 1 else y[[target_name]])
+                if initial_formulas or len(candidates) == 1:
+                    target_formulas = initial_formulas
+                    target_baseline = baseline_mae
+                    if initial_formulas and y.shape[1] > 1:
+                        target_formulas = [set_target_index(initial_formulas[i], 0)]
+                        target_baseline = None
+                    fits = [(candidates[0], (run_fit, candidates[0], max_rows, sampling_method, target_formulas, target_baseline))]
+                else:
+                    fits = [(candidate, (run_candidate, candidate, max_rows, sampling_method)) for candidate in candidates]
+                for candidate, (function, *args) in fits:
+                    job._futures.append(self._executor.submit(function, X_data, y_data, *args))
+                    job._targets.append(i)
+                    job._candidates.append(candidate)
+            if len(job._futures) > len(job.target_names):
+                job._timer = Timer(params.get("max_seconds", MAX_SEARCH_SECONDS), self._on_deadline, (job,))
+                job._timer.daemon = True
+                job._timer.start()
+        logging.info(f"Submitted training job {job.id} for model {model_name} ({len(job._futures)} fit(s))")
+        for future in job._futures:
+            future.add_done_callback(lambda future: self._on_fit_done(job))
+        return job.id
+
+    def get(self, job_id: str) -> TrainingJob:
+        """
+        Returns the job referenced by job_id, or None if it does not exist.
+        """
+        return self._jobs.get(job_id)
+
+    def count_active_jobs(self) -> int:
+        """
+        Returns the number of jobs that are running or waiting for a worker.
+        """
+        return sum(1 for job in self._jobs.values() if not job.is_finished())
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a job. Returns False if the job was already finished.
+
+        A fit that already started cannot be interrupted: it runs until the
+        end, but its result is discarded and the completion steps are skipped.
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.is_finished():
+            return False
+        job.cancel_requested = True
+        for future in job._futures:
+            future.cancel()
+        logging.info(f"Cancelled training job {job.id}")
+        return True
+
+    def wait(self, job_id: str, timeout: float = None) -> TrainingJob:
+        """
+        Waits until the job referenced by job_id is finished and returns it.
+        """
+        job = self._jobs[job_id]
+        job._finished.wait(timeout)
+        return job
+
+    def _on_deadline(self, job: TrainingJob):
+        """
+        Stops waiting for the candidates of a multi-start search once its budget is spent.
+
+        The candidates waiting for a worker are cancelled, but those already
+        running go on until they finish: a worker process cannot be stopped
+        without breaking the pool shared by all the jobs.
+        """
+        job.deadline_passed = True
+        for target in job.get_targets():
+            fits = job.get_fits(target)
+            # A target without any finished candidate still waits for the next one
+            if any(_succeeded(future) for future, _ in fits):
+                for future, _ in fits:
+                    future.cancel()
+        self._on_fit_done(job)
+
+    def _is_ready(self, job: TrainingJob) -> bool:
+        """
+        Returns True once the job can be completed: all its fits are finished,
+        one of its targets failed, or the budget of the search is spent and
+        every target has a fit that succeeded.
+        """
+        if all(future.done() for future in job._futures):
+            return True
+        targets_done = []
+        for target in job.get_targets():
+            fits = [future for future, _ in job.get_fits(target)]
+            succeeded = any(_succeeded(future) for future in fits)
+            if not succeeded and all(future.done() for future in fits):
+                return True
+            targets_done.append(succeeded)
+        return job.deadline_passed and all(targets_done)
+
+    def _on_fit_done(self, job: TrainingJob):
+        """
+        Hands the job over to the completion thread once it is ready, see _is_ready.
+
+        This runs in the thread of the executor that collects the results of
+        the fits, which must not wait while the model is saved to MLflow.
+        """
+        with self._lock:
+            if job._completing or not self._is_ready(job):
+                return
+            job._completing = True
+            if self._completion_thread is None:
+                self._completion_thread = Thread(target=self._run_completions, name="training-completions", daemon=True)
+                self._completion_thread.start()
+        # The fits that are still waiting for a worker are not needed anymore
+        for future in job._futures:
+            future.cancel()
+        if job._timer is not None:
+            job._timer.cancel()
+        self._completions.put(job)
+
+    def _run_completions(self):
+        """
+        Completes the jobs handed over by _on_fit_done, one at a time.
+        """
+        while True:
+            self._complete(self._completions.get())
+
+    def _select_model(self, job: TrainingJob, target: int) -> tuple:
+        """
+        Returns a tuple (model, metrics snapshots) with the best fit of a
+        target. With several candidates, the model keeps the results of all of
+        them in its 'candidates_' attribute.
+        """
+        fits = job.get_fits(target)
+        succeeded = [(future.result(), params) for future, params in fits if _succeeded(future)]
+        snapshots = [snapshot for (_, snapshot), _ in succeeded]
+        if len(fits) == 1:
+            return succeeded[0][0][0], snapshots
+
+        best = min((model for (model, _), _ in succeeded), key=lambda model: model.validation_mae_)
+        varied_params = get_varied_params(job._candidates)
+        best.candidates_ = []
+        for future, params in fits:
+            if not future.done() or future.cancelled():
+                continue
+            candidate = {
+                "target": job.target_names[target],
+                "params": {key: params[key] for key in varied_params},
+            }
+            if future.exception() is not None:
+                candidate["error"] = repr(future.exception())
+            else:
+                model = future.result()[0]
+                candidate["formula"] = model.formulas[0]
+                candidate["validation_mae"] = model.validation_mae_
+                candidate["selected"] = model is best
+            best.candidates_.append(candidate)
+        unfinished = len(fits) - len(best.candidates_)
+        logging.info(
+            f"Kept the best of {len(succeeded)} candidates for target {job.target_names[target]} of job {job.id} "
+            f"(validation MAE {best.validation_mae_}), {unfinished} did not finish in time"
+        )
+        return best, snapshots
+
+    def _complete(self, job: TrainingJob):
+        """
+        Runs the completion steps of a job once its fits are finished.
+        """
+        try:
+            failed_targets = [
+                target for target in job.get_targets()
+                if not any(_succeeded(future) for future, _ in job.get_fits(target))
+            ]
+            if job.cancel_requested:
+                job._status = CANCELLED
+            elif failed_targets:
+                fits = job.get_fits(failed_targets[0])
+                errors = [future.exception() for future, _ in fits if future.done() and not future.cancelled()]
+                job.error = errors[0] if errors else RuntimeError("No fit could run.")
+                job._status = FAILED
+                logging.info(f"Training job {job.id} failed: {job.error!r}")
+            else:
+                selected = [self._select_model(job, target) for target in job.get_targets()]
+                job_metrics = metrics.Registry()
+                for _, snapshots in selected:
+                    for snapshot in snapshots:
+                        job_metrics.merge(snapshot)
+                        if job.stored_fit is None:
+                            # The fit did not run again, its time was already recorded
+                            metrics.registry.merge(snapshot)
+                job.metrics = job_metrics.snapshot()
+                if len(selected) == 1:
+                    job.model = selected[0][0]
+                else:
+                    job.model = combine_target_models([model for model, _ in selected], job.feature_names)
+                if job.fit_key is not None and job.stored_fit is None:
+                    fit_store.store.put(job.fit_key, job.model, metrics=job.metrics)
+                if job._on_complete:
+                    job._on_complete(job.model)
+                job._status = DONE
+                seconds = metrics.get_total_seconds(job.metrics, "training")
+                logging.info(f"Training job {job.id} is done, the fit took {seconds:.1f} s")
+        except Exception as e:
+            logging.exception(f"An error occured while completing training job {job.id}")
+            job.error = e
+            job._status = FAILED
+        finally:
+            job.finished_at = datetime.now()
+            job._finished.set()
+
+queue = TrainingQueue()
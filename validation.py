@@ -0,0 +1,187 @@
+"""
+Checks the training data before a formula is searched.
+
+The symbolic regression only accepts finite numerical values, and it used to
+reject the other ones when the fit started, or failed after several minutes.
+The data is now checked column by column with vectorized operations, which
+takes a few milliseconds even on millions of rows, and every problem found is
+reported with the number of rows affected and a few of the values involved.
+
+Three modes decide what happens to the invalid values:
+- 'strict' rejects the data if any value is missing, infinite or not numerical
+- 'coerce' converts the text columns to numbers, and drops the rows where a
+  value is missing, infinite or could not be converted
+- 'impute' does the same, but replaces the invalid values of the features by
+  the median of their column. Rows with an invalid target are still dropped.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api import types
+
+import metrics
+
+
+STRICT = "strict"
+COERCE = "coerce"
+IMPUTE = "impute"
+MODES = (STRICT, COERCE, IMPUTE)
+
+# Number of invalid values shown for each problem
+SAMPLE_SIZE = 5
+# Minimum number of rows left to search a formula, some being kept to test it
+MIN_ROWS = 5
+
+
+class Issue:
+    """
+    A problem found in a column of the training data. Fatal issues prevent
+    the formula from being searched, the other ones are warnings.
+    """
+
+    def __init__(self, column: str, message: str, rows: int = 0, samples: list = None, fatal: bool = True):
+        self.column = column
+        self.message = message
+        self.rows = rows
+        self.samples = samples or []
+        self.fatal = fatal
+
+    def __str__(self) -> str:
+        text = f"Column '{self.column}': {self.message}" if self.column is not None else self.message
+        if self.rows:
+            text += f" ({self.rows} rows"
+            if self.samples:
+                text += f", e.g. {', '.join(repr(sample) for sample in self.samples)}"
+            text += ")"
+        return text
+
+
+class ValidationError(ValueError):
+    """
+    Raised when the training data cannot be used to search a formula.
+    """
+
+    def __init__(self, issues: list):
+        self.issues = issues
+        super().__init__("\n".join(str(issue) for issue in issues if issue.fatal))
+
+
+def check_columns(available, feature_names: list, target_names: list) -> list:
+    """
+    Returns the issues with the names of the columns requested by the user.
+    """
+    issues = []
+    available = set(available)
+    requested = feature_names + target_names
+    missing = [name for name in dict.fromkeys(requested) if name not in available]
+    if missing:
+        issues.append(Issue(None, f"Columns {missing} not found in the data."))
+    duplicated = [name for name in dict.fromkeys(requested) if requested.count(name) > 1]
+    for name in duplicated:
+        if name in feature_names and name in target_names:
+            issues.append(Issue(name, "is both a feature and a target."))
+        else:
+            issues.append(Issue(name, "is entered more than once."))
+    return issues
+
+
+def _to_float(column: pd.Series) -> tuple:
+    """
+    Returns a tuple (values, non-numerical mask) with the values of a column
+    as a float64 array, the values that are not numbers being NaN. The array
+    is a copy, as the invalid values might be replaced.
+    """
+    if types.is_bool_dtype(column) or (types.is_numeric_dtype(column) and not types.is_complex_dtype(column)):
+        return column.to_numpy(dtype="float64", na_value=np.nan, copy=True), None
+    if types.is_object_dtype(column) or types.is_string_dtype(column) or isinstance(column.dtype, pd.CategoricalDtype):
+        converted = pd.to_numeric(column.astype(object), errors="coerce")
+        values = converted.to_numpy(dtype="float64", na_value=np.nan)
+    else:
+        # Dates, durations, complex numbers...
+        values = np.full(len(column), np.nan)
+    non_numerical = np.isnan(values) & column.notna().to_numpy()
+    return values, non_numerical
+
+
+def _get_samples(column: pd.Series, mask: np.ndarray) -> list:
+    return column[mask].head(SAMPLE_SIZE).tolist()
+
+
+def _check_column(column: pd.Series, mode: str, issues: list) -> tuple:
+    """
+    Returns a tuple (values, invalid mask) for a column, adding the issues
+    found to 'issues'.
+    """
+    fatal = mode == STRICT
+    values, non_numerical = _to_float(column)
+    invalid = ~np.isfinite(values)
+    if non_numerical is not None and non_numerical.any():
+        issues.append(
+            Issue(column.name, "contains values that are not numbers", int(non_numerical.sum()), _get_samples(column, non_numerical), fatal)
+        )
+        missing = invalid & ~non_numerical
+    else:
+        missing = invalid
+    infinite = np.isinf(values)
+    if infinite.any():
+        issues.append(Issue(column.name, "contains infinite values", int(infinite.sum()), _get_samples(column, infinite), fatal))
+        missing = missing & ~infinite
+    if missing.any():
+        issues.append(Issue(column.name, "contains missing values", int(missing.sum()), fatal=fatal))
+    return values, invalid
+
+
+def validate(X: pd.DataFrame, y: pd.DataFrame, mode: str = STRICT) -> tuple:
+    """
+    Checks the features X and targets y before a formula is searched.
+
+    Returns a tuple (X, y, warnings), where X and y are converted to float64
+    and cleaned according to 'mode' if needed, and 'warnings' lists the issues
+    that do not prevent the search. Raises a ValidationError listing all the
+    issues found if the data cannot be used.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown validation mode '{mode}'.")
+
+    with metrics.span("validate"):
+        issues = []
+        feature_values = [_check_column(X.iloc[:, i], mode, issues) for i in range(X.shape[1])]
+        target_values = [_check_column(y.iloc[:, i], mode, issues) for i in range(y.shape[1])]
+        # Numerical columns are kept as they are if no value is invalid
+        converted = not all(types.is_numeric_dtype(dtype) for dtype in list(X.dtypes) + list(y.dtypes))
+
+        dropped = np.zeros(len(X), dtype=bool)
+        for _, invalid in target_values:
+            dropped |= invalid
+        for i, (values, invalid) in enumerate(feature_values):
+            if not invalid.any():
+                continue
+            if mode == IMPUTE and not invalid.all():
+                values[invalid] = np.median(values[~invalid])
+                issues.append(
+                    Issue(X.columns[i], "has its invalid values replaced by the median of the column", int(invalid.sum()), fatal=False)
+                )
+            else:
+                dropped |= invalid
+
+        if mode != STRICT and dropped.any():
+            issues.append(Issue(None, "Rows with invalid values are dropped", int(dropped.sum()), fatal=False))
+        # Avoiding copies of the columns when all the rows are kept
+        kept = ~dropped if dropped.any() else slice(None)
+        if len(X) - dropped.sum() < MIN_ROWS:
+            issues.append(Issue(None, f"At least {MIN_ROWS} rows with valid values are needed to search a formula."))
+        else:
+            for i, (values, _) in enumerate(feature_values):
+                if np.ptp(values[kept]) == 0:
+                    issues.append(Issue(X.columns[i], "has a single value, it cannot help finding the formula.", fatal=False))
+            for i, (values, _) in enumerate(target_values):
+                if np.ptp(values[kept]) == 0:
+                    issues.append(Issue(y.columns[i], "has a single value, there is no formula to search."))
+
+    if any(issue.fatal for issue in issues):
+        raise ValidationError(issues)
+    warnings = [issue for issue in issues if not issue.fatal]
+    if warnings or converted:
+        # Only the rows kept are copied
+        X = pd.DataFrame(np.column_stack([values[kept] for values, _ in feature_values]), index=X.index[kept], columns=X.columns)
+        y = pd.DataFrame(np.column_stack([values[kept] for values, _ in target_values]), index=y.index[kept], columns=y.columns)
+    return X, y, warnings